@@ -1,54 +1,326 @@
 import os
 import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from email.message import EmailMessage
+from google.api_core import exceptions as gexc
 from google.cloud import firestore
 
-def send_email(to_email, subject, body):
-    smtp_server = os.environ.get('SMTP_SERVER')
-    smtp_port = int(os.environ.get('SMTP_PORT', 587))
-    smtp_user = os.environ.get('SMTP_USER')
-    smtp_password = os.environ.get('SMTP_PASSWORD')
-    from_email = os.environ.get('FROM_EMAIL', smtp_user)
+# Hàng đợi thông báo vắng mặt:
+# - firestore_trigger: mỗi sự kiện "absent" chỉ ghi một document vào outbox (absence_notifications, id = id bản ghi
+#   attendance nên sự kiện lặp lại không tạo trùng), không gửi mail trong trigger.
+# - flush_absence_digests (Cloud Scheduler -> Pub/Sub, chạy mỗi vài phút): gom các sự kiện chờ theo sinh viên,
+#   sinh viên có sự kiện chờ lâu hơn ABSENCE_DIGEST_WINDOW_SECONDS nhận MỘT email tổng hợp,
+#   tất cả gửi qua một phiên SMTP dùng lại (STARTTLS + login một lần).
+# ABSENCE_DIGEST_WINDOW_SECONDS=0: trigger gửi ngay phần đang chờ của sinh viên đó (lease theo từng sinh viên,
+#   nhiều trigger song song không chặn nhau). Vẫn nên triển khai flush_absence_digests theo lịch ở mọi chế độ:
+#   đó là đường duy nhất thử gửi lại các email lỗi (attempts < ABSENCE_MAX_ATTEMPTS).
+# Chạy thử với SMTP giả lập tại máy:
+#   python -m aiosmtpd -n -l localhost:1025
+#   SMTP_SERVER=localhost SMTP_PORT=1025 SMTP_SECURITY=none python main.py flush
+OUTBOX_COLLECTION = 'absence_notifications'
+LEASE_COLLECTION = 'absence_notification_locks'
+ABSENCE_DIGEST_WINDOW_SECONDS = int(os.environ.get('ABSENCE_DIGEST_WINDOW_SECONDS', 300))
+ABSENCE_FLUSH_MAX_EVENTS = int(os.environ.get('ABSENCE_FLUSH_MAX_EVENTS', 2000))
+ABSENCE_MAX_ATTEMPTS = int(os.environ.get('ABSENCE_MAX_ATTEMPTS', 5))
+FLUSH_LEASE_SECONDS = int(os.environ.get('ABSENCE_FLUSH_LEASE_SECONDS', 300))
+SMTP_IDLE_SECONDS = int(os.environ.get('SMTP_IDLE_SECONDS', 60))
+FIRESTORE_BATCH_SIZE = 500
+GET_ALL_CHUNK = 300
 
-    msg = MIMEMultipart()
-    msg['From'] = from_email
-    msg['To'] = to_email
-    msg['Subject'] = subject
-    msg.attach(MIMEText(body, 'plain'))
+# Client dùng lại giữa các lần gọi khi instance còn ấm
+_db = None
+_db_lock = threading.Lock()
+
+
+def get_db():
+    global _db
+    if _db is None:
+        with _db_lock:
+            if _db is None:
+                _db = firestore.Client()
+    return _db
+
+
+class SmtpSession:
+    # Một kết nối SMTP dùng chung: mở khi cần, dùng lại cho nhiều email (và giữa các lần gọi khi instance ấm),
+    # kiểm tra NOOP nếu đã rảnh lâu, mở lại một lần nếu server đã ngắt.
+    def __init__(self):
+        self.server = os.environ.get('SMTP_SERVER')
+        self.port = int(os.environ.get('SMTP_PORT', 587))
+        self.user = os.environ.get('SMTP_USER')
+        self.password = os.environ.get('SMTP_PASSWORD')
+        self.from_email = os.environ.get('FROM_EMAIL', self.user)
+        # starttls | ssl | none (none dùng cho SMTP giả lập tại máy)
+        self.security = os.environ.get('SMTP_SECURITY', 'starttls')
+        self._lock = threading.Lock()
+        self._conn = None
+        self._last_used = 0
+        self.connects = 0
+
+    def _connect(self):
+        if self.security == 'ssl':
+            conn = smtplib.SMTP_SSL(self.server, self.port, timeout=30)
+        else:
+            conn = smtplib.SMTP(self.server, self.port, timeout=30)
+            if self.security == 'starttls':
+                conn.starttls()
+        if self.user:
+            conn.login(self.user, self.password)
+        self.connects += 1
+        return conn
+
+    def _alive(self):
+        if self._conn is None:
+            return False
+        if time.monotonic() - self._last_used < SMTP_IDLE_SECONDS:
+            return True
+        try:
+            return self._conn.noop()[0] == 250
+        except smtplib.SMTPException:
+            return False
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _close(self):
+        if self._conn is not None:
+            try:
+                self._conn.quit()
+            except Exception:
+                pass
+            self._conn = None
+
+    def send(self, to_email, subject, body):
+        msg = EmailMessage()
+        msg['From'] = self.from_email
+        msg['To'] = to_email
+        msg['Subject'] = subject
+        msg.set_content(body)
+        with self._lock:
+            for attempt in range(2):
+                if not self._alive():
+                    self._close()
+                    self._conn = self._connect()
+                try:
+                    self._conn.send_message(msg)
+                    self._last_used = time.monotonic()
+                    return
+                except (smtplib.SMTPServerDisconnected, ConnectionError):
+                    # Kết nối cũ bị server đóng: mở lại và thử thêm một lần
+                    self._conn = None
+                    if attempt:
+                        raise
+
+
+smtp_session = SmtpSession()
+
+
+def _field(fields, *names):
+    for name in names:
+        value = fields.get(name, {})
+        if value:
+            return value.get('stringValue') or value.get('timestampValue') or ''
+    return ''
+
+
+def enqueue_absence(db, attendance_id, student_id, class_id, absent_at=''):
+    try:
+        db.collection(OUTBOX_COLLECTION).document(attendance_id).create({
+            'studentId': student_id,
+            'classId': class_id,
+            'absentAt': absent_at,
+            'status': 'pending',
+            'attempts': 0,
+            'createdAt': datetime.now(timezone.utc),
+        })
+        return True
+    except gexc.AlreadyExists:
+        # Sự kiện lặp lại (Cloud Functions giao ít nhất một lần) hoặc bản ghi được sửa lại
+        return False
+
+
+def _lease_ref(db, name):
+    return db.collection(LEASE_COLLECTION).document(name)
+
+
+def _acquire_lease(db, name, holder):
+    # Lease theo tên: 'flush' cho lần quét định kỳ, 'student__{id}' cho việc gửi thư của một sinh viên
+    lease_ref = _lease_ref(db, name)
+    now = datetime.now(timezone.utc)
+
+    @firestore.transactional
+    def take(transaction):
+        snap = lease_ref.get(transaction=transaction)
+        lease_until = snap.to_dict().get('leaseUntil') if snap.exists else None
+        if lease_until and lease_until > now:
+            return False
+        transaction.set(lease_ref, {'holder': holder, 'leaseUntil': now + timedelta(seconds=FLUSH_LEASE_SECONDS)})
+        return True
+
+    return take(db.transaction())
+
+
+def _release_lease(db, name, holder):
+    # Chỉ xoá khi lease vẫn thuộc về mình (chạy quá FLUSH_LEASE_SECONDS thì lease có thể đã sang người khác)
+    lease_ref = _lease_ref(db, name)
+
+    @firestore.transactional
+    def release(transaction):
+        snap = lease_ref.get(transaction=transaction)
+        if snap.exists and snap.to_dict().get('holder') == holder:
+            transaction.delete(lease_ref)
+
+    release(db.transaction())
+
+
+def _load_users(db, student_ids):
+    users = {}
+    users_ref = db.collection('users')
+    for i in range(0, len(student_ids), GET_ALL_CHUNK):
+        refs = [users_ref.document(sid) for sid in student_ids[i:i + GET_ALL_CHUNK]]
+        for snap in db.get_all(refs, field_paths=['email', 'name']):
+            if snap.exists:
+                users[snap.id] = snap.to_dict() or {}
+    return users
+
+
+def digest_body(name, events):
+    lines = [f'Chào {name},', '', 'Bạn đã bị điểm danh vắng ở:']
+    for event in sorted(events, key=lambda e: str(e.get('absentAt') or e.get('createdAt'))):
+        when = event.get('absentAt') or ''
+        lines.append(f"- Lớp {event.get('classId')}" + (f' ({when})' if when else ''))
+    lines += ['', 'Nếu có thắc mắc, vui lòng liên hệ giáo viên.']
+    return '\n'.join(lines)
+
+
+def _pending_events(db, student_id):
+    query = db.collection(OUTBOX_COLLECTION).where('studentId', '==', student_id).where('status', '==', 'pending')
+    return [(snap.reference, snap.to_dict()) for snap in query.limit(ABSENCE_FLUSH_MAX_EVENTS).stream()]
+
+
+def _is_ready(events, window_seconds):
+    # Chỉ gửi khi sự kiện cũ nhất đã chờ hết cửa sổ (các sự kiện tới sau trong cửa sổ được gộp)
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=window_seconds)
+    return bool(events) and min(e.get('createdAt') or cutoff for _, e in events) <= cutoff
+
+
+def _commit_updates(db, updates):
+    for i in range(0, len(updates), FIRESTORE_BATCH_SIZE):
+        batch = db.batch()
+        for ref, update in updates[i:i + FIRESTORE_BATCH_SIZE]:
+            batch.update(ref, update)
+        batch.commit()
+
+
+def _flush_student(db, student_id, user, holder, window_seconds, sender, totals):
+    # Gửi digest của một sinh viên dưới lease riêng của sinh viên đó.
+    # Trigger khác của cùng sinh viên gặp lease bận chỉ để sự kiện lại trong outbox; người giữ lease
+    # kiểm tra lại outbox SAU khi trả lease và gửi tiếp nên sự kiện đó không bị bỏ quên.
+    lease_name = f'student__{student_id}'
+    while True:
+        if not _acquire_lease(db, lease_name, holder):
+            totals['busy'] += 1
+            return
+        try:
+            # Đọc lại trong lease: lần quét trước có thể đã cũ
+            events = _pending_events(db, student_id)
+            if not _is_ready(events, window_seconds):
+                return
+            to_email = (user or {}).get('email')
+            now = datetime.now(timezone.utc)
+            if not to_email:
+                print(f"Không tìm thấy email cho sinh viên {student_id}")
+                _commit_updates(db, [(ref, {'status': 'skipped', 'sentAt': now}) for ref, _ in events])
+                return
+            try:
+                sender.send(to_email, 'Thông báo vắng mặt',
+                            digest_body(user.get('name', student_id), [e for _, e in events]))
+            except Exception as e:
+                totals['emails_failed'] += 1
+                print(f"[ERROR] Gửi email tới {to_email}: {e}")
+                updates = []
+                for ref, event in events:
+                    attempts = event.get('attempts', 0) + 1
+                    updates.append((ref, {'attempts': attempts, 'error': str(e),
+                                          'status': 'failed' if attempts >= ABSENCE_MAX_ATTEMPTS else 'pending'}))
+                _commit_updates(db, updates)
+                return
+            _commit_updates(db, [(ref, {'status': 'sent', 'sentAt': now}) for ref, _ in events])
+            totals['emails_sent'] += 1
+            totals['events'] += len(events)
+            print(f"Đã gửi email vắng mặt ({len(events)} buổi) tới {to_email}")
+        finally:
+            _release_lease(db, lease_name, holder)
+        if not _is_ready(_pending_events(db, student_id), window_seconds):
+            return
+
+
+def flush_digests(db, student_ids=None, window_seconds=ABSENCE_DIGEST_WINDOW_SECONDS, sender=None):
+    # student_ids=None: quét toàn bộ outbox (Scheduler), giữ lease 'flush' để hai lần quét không chồng nhau.
+    # Có student_ids (trigger): chỉ dùng lease theo sinh viên nên nhiều trigger chạy song song được.
+    sender = sender or smtp_session
+    holder = f"{os.environ.get('K_REVISION', 'local')}:{uuid.uuid4().hex}"
+    scan_all = not student_ids
+    if scan_all and not _acquire_lease(db, 'flush', holder):
+        print("[INFO] Another flush is running, skip")
+        return {'skipped': True}
+    try:
+        if scan_all:
+            pending = {}
+            query = db.collection(OUTBOX_COLLECTION).where('status', '==', 'pending')
+            for snap in query.limit(ABSENCE_FLUSH_MAX_EVENTS).stream():
+                event = snap.to_dict()
+                pending.setdefault(event.get('studentId'), []).append((snap.reference, event))
+            candidates = sorted(sid for sid, events in pending.items() if sid and _is_ready(events, window_seconds))
+        else:
+            candidates = sorted(set(student_ids))
+        users = _load_users(db, candidates)
+        totals = {'students': len(candidates), 'emails_sent': 0, 'emails_failed': 0, 'events': 0, 'busy': 0}
+        for student_id in candidates:
+            _flush_student(db, student_id, users.get(student_id), holder, window_seconds, sender, totals)
+        totals['smtp_connects'] = smtp_session.connects
+        return totals
+    finally:
+        if scan_all:
+            _release_lease(db, 'flush', holder)
 
-    with smtplib.SMTP(smtp_server, smtp_port) as server:
-        server.starttls()
-        server.login(smtp_user, smtp_password)
-        server.sendmail(from_email, to_email, msg.as_string())
 
 # Cloud Function entry point
 # Trigger: Firestore document create/update in 'attendance' collection
 def firestore_trigger(event, context):
     # event['value']['fields'] contains the new document fields
-    value = event.get('value', {})
-    fields = value.get('fields', {})
-    status = fields.get('status', {}).get('stringValue', '')
-    student_id = fields.get('student_id', {}).get('stringValue', '')
-    class_id = fields.get('class_id', {}).get('stringValue', '')
-
-    if status == 'absent' and student_id:
-        # Lấy email sinh viên từ Firestore
-        db = firestore.Client()
-        user_ref = db.collection('users').document(student_id)
-        user_doc = user_ref.get()
-        if user_doc.exists:
-            user_data = user_doc.to_dict()
-            to_email = user_data.get('email')
-            student_name = user_data.get('name', student_id)
-            if to_email:
-                subject = 'Thông báo vắng mặt'
-                body = f'Chào {student_name},\nBạn đã bị điểm danh vắng ở lớp {class_id}. Nếu có thắc mắc, vui lòng liên hệ giáo viên.'
-                send_email(to_email, subject, body)
-                print(f"Đã gửi email vắng mặt tới {to_email}")
-            else:
-                print(f"Không tìm thấy email cho sinh viên {student_id}")
-        else:
-            print(f"Không tìm thấy user {student_id}")
-    else:
+    fields = event.get('value', {}).get('fields', {})
+    old_fields = event.get('oldValue', {}).get('fields', {})
+    status = _field(fields, 'status')
+    student_id = _field(fields, 'studentId', 'student_id')
+    class_id = _field(fields, 'classId', 'class_id')
+
+    if status != 'absent' or not student_id:
         print("Không phải trường hợp vắng mặt hoặc thiếu student_id")
+        return
+    if _field(old_fields, 'status') == 'absent':
+        print("Bản ghi đã vắng mặt từ trước, bỏ qua")
+        return
+    attendance_id = context.resource.split('/')[-1]
+    db = get_db()
+    if enqueue_absence(db, attendance_id, student_id, class_id, _field(fields, 'createdAt', 'timestamp')):
+        print(f"Đã xếp hàng thông báo vắng mặt cho {student_id} (lớp {class_id})")
+    if ABSENCE_DIGEST_WINDOW_SECONDS == 0:
+        print(flush_digests(db, student_ids=[student_id], window_seconds=0))
+
+
+# Cloud Function entry point
+# Trigger: Pub/Sub topic do Cloud Scheduler đẩy định kỳ (vd. mỗi 5 phút)
+def flush_absence_digests(event, context):
+    print(f"[INFO] Absence digest flush: {flush_digests(get_db())}")
+
+
+if __name__ == '__main__':
+    import sys
+    if sys.argv[1:2] == ['flush']:
+        print(flush_digests(get_db(), window_seconds=int(sys.argv[2]) if len(sys.argv) > 2 else 0))
+        smtp_session.close()
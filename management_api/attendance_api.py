@@ -1,106 +1,409 @@
 from flask import Blueprint, request, jsonify
 import os
-import base64
-import boto3
-from google.cloud import storage, firestore
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from face_cache import load_reference_image
+from face_index import index_student_face, largest_face_box, match_group_photo
+from image_utils import IMAGE_GROUP_MAX_DIMENSION, decode_base64_image, is_truthy, normalize_image, read_image_request
+from job_queue import job_queue
+from face_matcher import FACE_MATCHER, create_matcher
+from idempotency import IDEMPOTENCY_RETRY_AFTER_SECONDS, attendance_idempotency_keys, create_store
+from clients import get_firestore, get_rekognition, get_storage
+from rollups import add_rollups, write_attendance
+from doc_cache import classes_cache, invalidate_user
+from etag import versions
+from metrics import counted, get_document, stage
 
 load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '.env'))
 
 attendance_api = Blueprint('attendance_api', __name__)
 
-# AWS Rekognition config
-rekognition = boto3.client(
-    'rekognition',
-    region_name=os.environ.get('AWS_REGION'),
-    aws_access_key_id=os.environ.get('AWS_ACCESS_KEY_ID'),
-    aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY')
-)
-
-# Google Cloud config
-storage_client = storage.Client()
-# Đường dẫn mới tới file service account key
-SERVICE_ACCOUNT_KEY_PATH = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS")
-FIREBASE_PROJECT_ID = os.environ.get("FIREBASE_PROJECT_ID")
-# Khi khởi tạo Firestore client:
-db = firestore.Client.from_service_account_json(SERVICE_ACCOUNT_KEY_PATH, project=FIREBASE_PROJECT_ID)
+# Bật chế độ không upload-rồi-tải-lại: bytes ảnh được đưa thẳng vào so khớp,
+# việc lưu ảnh lên GCS chạy nền và image_url được điền sau
+ATTENDANCE_DEFERRED_UPLOAD = os.environ.get('ATTENDANCE_DEFERRED_UPLOAD', '1') == '1'
+ATTENDANCE_ARCHIVE_WORKERS = int(os.environ.get('ATTENDANCE_ARCHIVE_WORKERS', 4))
+# Số lần chạy lại job đăng ký khuôn mặt (face_enroll) khi backend so khớp lỗi
+FACE_ENROLL_RETRIES = int(os.environ.get('FACE_ENROLL_RETRIES', 5))
+FIRESTORE_BATCH_SIZE = 500
+archive_executor = ThreadPoolExecutor(max_workers=ATTENDANCE_ARCHIVE_WORKERS, thread_name_prefix='attendance-archive')
 
-def save_attendance_image(student_id, image_base64):
+# Lưu kết quả điểm danh theo idempotency key (memory | firestore)
+idempotency_store = create_store(get_firestore)
+
+def locate_face(image_bytes):
+    return largest_face_box(get_rekognition(), image_bytes)
+
+def prepare_attendance_image(image_bytes):
+    # Chuẩn hoá (xoay EXIF, thu nhỏ, nén lại) trước khi so khớp và lưu trữ
+    with stage('image_normalize'):
+        return normalize_image(image_bytes, label='attendance', face_locator=locate_face)
+
+def decode_attendance_image(image_base64):
+    return prepare_attendance_image(decode_base64_image(image_base64))
+
+def attendance_image_name(student_id):
+    return f'attendance_photos/{student_id}_{int(datetime.utcnow().timestamp())}.jpg'
+
+def attendance_image_url(file_name):
+    return f'https://storage.googleapis.com/{os.environ.get("GCS_BUCKET_NAME")}/{file_name}'
+
+def upload_attendance_image(file_name, image_bytes):
     bucket_name = os.environ.get('GCS_BUCKET_NAME')
-    file_name = f'attendance_photos/{student_id}_{int(datetime.utcnow().timestamp())}.jpg'
-    bucket = storage_client.bucket(bucket_name)
+    bucket = get_storage().bucket(bucket_name)
     blob = bucket.blob(file_name)
-    image_bytes = base64.b64decode(image_base64.split(',')[-1])
-    blob.upload_from_string(image_bytes, content_type='image/jpeg')
+    with stage('gcs_upload'):
+        blob.upload_from_string(image_bytes, content_type='image/jpeg')
     return file_name
 
-def compare_faces_with_rekognition(student_id, attendance_file_name):
-    bucket_name = os.environ.get('GCS_BUCKET_NAME')
-    # Ảnh gốc
-    source_blob = storage_client.bucket(bucket_name).blob(f'students/{student_id}.jpg')
-    source_bytes = source_blob.download_as_bytes()
-    # Ảnh điểm danh
-    target_blob = storage_client.bucket(bucket_name).blob(attendance_file_name)
-    target_bytes = target_blob.download_as_bytes()
-    response = rekognition.compare_faces(
-        SourceImage={'Bytes': source_bytes},
-        TargetImage={'Bytes': target_bytes},
-        SimilarityThreshold=80
-    )
-    recognized = False
-    similarity = 0
-    if response['FaceMatches']:
-        recognized = True
-        similarity = response['FaceMatches'][0]['Similarity']
-    return recognized, similarity
+def save_attendance_image(student_id, image_base64):
+    image_bytes = decode_attendance_image(image_base64)
+    return upload_attendance_image(attendance_image_name(student_id), image_bytes)
+
+def archive_attendance_image(doc_ref, file_name, image_bytes):
+    # Chạy trong archive_executor: lưu ảnh điểm danh rồi điền image_url vào bản ghi
+    try:
+        upload_attendance_image(file_name, image_bytes)
+        doc_ref.update({'image_url': attendance_image_url(file_name), 'image_status': 'stored'})
+        print(f"[INFO] Archived attendance image: doc_ref={doc_ref.id}, file={file_name}")
+    except Exception as e:
+        print(f"[ERROR] Archive attendance image error: doc_ref={doc_ref.id}, file={file_name}, error={e}")
+        try:
+            doc_ref.update({'image_status': 'failed'})
+        except Exception:
+            pass
+
+def archive_group_image(doc_refs, file_name, image_bytes):
+    # Ảnh cả lớp chỉ lưu một lần, sau đó điền image_url cho toàn bộ bản ghi của buổi điểm danh
+    try:
+        upload_attendance_image(file_name, image_bytes)
+        image_url = attendance_image_url(file_name)
+        db = get_firestore()
+        for i in range(0, len(doc_refs), FIRESTORE_BATCH_SIZE):
+            batch = db.batch()
+            for doc_ref in doc_refs[i:i + FIRESTORE_BATCH_SIZE]:
+                batch.update(doc_ref, {'image_url': image_url, 'image_status': 'stored'})
+            batch.commit()
+        print(f"[INFO] Archived class photo: file={file_name}, records={len(doc_refs)}")
+    except Exception as e:
+        print(f"[ERROR] Archive class photo error: file={file_name}, error={e}")
+
+def ensure_roster_indexed(roster):
+    # Đọc face_id của cả lớp bằng get_all, index bổ sung những sinh viên chưa có trong collection
+    db = get_firestore()
+    users_ref = db.collection('users')
+    face_ids = {}
+    existing = set()
+    for i in range(0, len(roster), FIRESTORE_BATCH_SIZE):
+        refs = [users_ref.document(sid) for sid in roster[i:i + FIRESTORE_BATCH_SIZE]]
+        for snap in counted(db.get_all(refs, field_paths=['face_id'])):
+            if snap.exists:
+                existing.add(snap.id)
+                face_id = (snap.to_dict() or {}).get('face_id')
+                if face_id:
+                    face_ids[snap.id] = face_id
+    missing = [sid for sid in roster if sid not in face_ids]
+    if not missing:
+        return face_ids
+    bucket = get_storage().bucket(os.environ.get('GCS_BUCKET_NAME'))
+
+    def index_one(sid):
+        try:
+            return sid, index_student_face(get_rekognition(), sid, load_reference_image(bucket, sid))
+        except Exception as e:
+            print(f"[ERROR] Index face for {sid}: {e}")
+            return sid, None
+
+    with ThreadPoolExecutor(max_workers=min(8, len(missing))) as pool:
+        indexed = [(sid, face_id) for sid, face_id in pool.map(index_one, missing) if face_id]
+    batch = db.batch()
+    pending = 0
+    for sid, face_id in indexed:
+        face_ids[sid] = face_id
+        if sid in existing:
+            batch.update(users_ref.document(sid), {'face_id': face_id})
+            pending += 1
+        if pending == FIRESTORE_BATCH_SIZE:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+    if pending:
+        batch.commit()
+    return face_ids
+
+def load_student_reference(student_id):
+    return load_reference_image(get_storage().bucket(os.environ.get('GCS_BUCKET_NAME')), student_id)
+
+def enroll_student_face(student_id):
+    # Đăng ký ảnh gốc (students/{id}.jpg trên GCS) với bộ so khớp rồi lưu face_id/face_embedding vào users
+    user_ref = get_firestore().collection('users').document(student_id)
+    user_doc = get_document(user_ref)
+    if not user_doc.exists:
+        return {'student_id': student_id, 'skipped': 'user not found'}
+    fields = face_matcher.enroll(student_id, load_student_reference(student_id), user_doc.to_dict())
+    if fields:
+        user_ref.update(fields)
+        invalidate_user(student_id)
+        # Backend local: ma trận lớp dựng lại sau khi embedding đã nằm trong users
+        if hasattr(face_matcher, 'invalidate_student'):
+            face_matcher.invalidate_student(student_id)
+    print(f"[INFO] Face enrolled: student_id={student_id}, matcher={face_matcher.name}")
+    return {'student_id': student_id, 'fields': sorted(fields)}
+
+def run_face_enroll_job(payload):
+    return enroll_student_face(payload['student_id'])
+
+job_queue.register('face_enroll', run_face_enroll_job, retries=FACE_ENROLL_RETRIES)
+
+def enroll_face_later(student_id):
+    # Đăng ký khuôn mặt lỗi (hoặc chưa có) thì đưa vào hàng đợi để worker thử lại, không bỏ qua
+    job_id = job_queue.submit('face_enroll', {'student_id': student_id})
+    print(f"[INFO] Face enroll queued: student_id={student_id}, job_id={job_id}")
+    return job_id
+
+# Bộ so khớp dùng cho /attendance (rekognition | local), xem face_matcher.py
+face_matcher = create_matcher(FACE_MATCHER, rekognition=get_rekognition, db=get_firestore,
+                              reference_loader=load_student_reference, enroll_later=enroll_face_later)
+# Sĩ số lớp thay đổi thì ma trận embedding của lớp (backend local) cũng phải dựng lại
+if hasattr(face_matcher, 'invalidate_class'):
+    classes_cache.on_invalidate(face_matcher.invalidate_class)
+rekognition_matcher = face_matcher if face_matcher.name == 'rekognition' else create_matcher(
+    'rekognition', rekognition=get_rekognition, reference_loader=load_student_reference)
+
+def compare_faces_with_rekognition(student_id, attendance_file_name=None, target_bytes=None):
+    # Ảnh điểm danh: dùng bytes có sẵn nếu được truyền vào, nếu không thì tải từ GCS
+    if target_bytes is None:
+        target_blob = get_storage().bucket(os.environ.get('GCS_BUCKET_NAME')).blob(attendance_file_name)
+        with stage('gcs_download'):
+            target_bytes = target_blob.download_as_bytes()
+    # Ảnh gốc lấy qua cache, chỉ tải lại khi ảnh trên GCS đổi generation
+    return rekognition_matcher.verify(student_id, None, target_bytes)
+
+class AttendanceError(Exception):
+    # Lỗi ở một bước của pipeline điểm danh, mang sẵn mã HTTP để handler trả về
+    def __init__(self, error, details=None, status_code=500):
+        super().__init__(f'{error}: {details}' if details else error)
+        self.error = error
+        self.details = details
+        self.status_code = status_code
+
+    def body(self):
+        body = {'error': self.error}
+        if self.details:
+            body['details'] = self.details
+        return body
+
+    def to_response(self):
+        return jsonify(self.body()), self.status_code
+
+def process_attendance(student_id, class_id, image_bytes):
+    # Pipeline điểm danh một sinh viên: so khớp khuôn mặt, ghi Firestore, lưu ảnh.
+    # Dùng chung cho request đồng bộ và worker của hàng đợi job.
+    attendance_file_name = attendance_image_name(student_id)
+
+    # Chế độ cũ: lưu ảnh điểm danh vào GCS trước khi so sánh
+    if not ATTENDANCE_DEFERRED_UPLOAD:
+        try:
+            upload_attendance_image(attendance_file_name, image_bytes)
+        except Exception as e:
+            print(f"[ERROR] Lỗi lưu ảnh điểm danh: {e}")
+            raise AttendanceError('Save image error', str(e))
+
+    # So khớp khuôn mặt (dùng thẳng bytes đã giải mã, không tải lại từ GCS)
+    try:
+        with stage('face_match'):
+            recognized, similarity = face_matcher.verify(student_id, class_id, image_bytes)
+    except Exception as e:
+        print(f"[ERROR] Face matcher ({face_matcher.name}) error: {e}")
+        raise AttendanceError('Rekognition error' if face_matcher.name == 'rekognition' else 'Face matcher error', str(e))
+
+    # Lưu kết quả vào collection 'attendance' với schema mới
+    try:
+        attendance_doc = {
+            'classId': class_id,
+            'studentId': student_id,
+            'image_url': None if ATTENDANCE_DEFERRED_UPLOAD else attendance_image_url(attendance_file_name),
+            'image_status': 'pending' if ATTENDANCE_DEFERRED_UPLOAD else 'stored',
+            'similarity': similarity,
+            'status': 'present' if recognized else 'absent',
+            'createdAt': datetime.utcnow(),
+            'verifiedBy': face_matcher.name
+        }
+        # Bản ghi và bộ đếm tổng hợp (rollups) được ghi trong cùng một commit
+        with stage('firestore_write', service='firestore'):
+            doc_ref = write_attendance(get_firestore(), attendance_doc)
+        versions.bump('attendance')
+        print(f"[INFO] Firestore log success: doc_ref={doc_ref}")
+    except Exception as e:
+        print(f"[ERROR] Firestore log error: {e}")
+        raise AttendanceError('Firestore log error', str(e))
+
+    # Lưu ảnh lên GCS ngoài luồng request, image_url được cập nhật khi xong
+    if ATTENDANCE_DEFERRED_UPLOAD:
+        archive_executor.submit(archive_attendance_image, doc_ref, attendance_file_name, image_bytes)
+
+    print(f"[INFO] Attendance success: studentId={student_id}, classId={class_id}, recognized={recognized}, similarity={similarity}")
+    return recognized, similarity, doc_ref
+
+def run_attendance_job(payload):
+    recognized, similarity, doc_ref = process_attendance(payload['student_id'], payload['class_id'], payload['image_bytes'])
+    return {'recognized': recognized, 'similarity': similarity, 'doc_ref': doc_ref.id}
+
+job_queue.register('attendance', run_attendance_job)
 
 @attendance_api.route('/attendance', methods=['POST'])
 def attendance():
     try:
-        data = request.get_json()
-        print(f"[INFO] API /attendance payload: {data}")
-        image_base64 = data.get('imageBase64')
+        # Nhận ảnh dạng multipart, body image/jpeg hoặc JSON base64 (dạng cũ)
+        try:
+            data, raw_image = read_image_request(request, 'imageBase64')
+        except Exception as e:
+            print(f"[ERROR] Lỗi đọc ảnh điểm danh: {e}")
+            return jsonify({'error': 'Invalid image', 'details': str(e)}), 400
         student_id = data.get('studentId')
         class_id = data.get('ClassId') or data.get('classId')
-        if not image_base64 or not student_id or not class_id:
-            print(f"[ERROR] Missing data: imageBase64={bool(image_base64)}, studentId={student_id}, classId={class_id}")
+        print(f"[INFO] API /attendance payload: studentId={student_id}, classId={class_id}, image={len(raw_image or b'')} bytes, content_type={request.mimetype}")
+        if not raw_image or not student_id or not class_id:
+            print(f"[ERROR] Missing data: image={bool(raw_image)}, studentId={student_id}, classId={class_id}")
             return jsonify({'error': 'Missing data'}), 400
 
-        # Lưu ảnh điểm danh vào GCS
+        # Request trùng (bấm hai lần, mạng gửi lại) nhận lại kết quả cũ, không so khớp và không ghi thêm bản ghi
+        client_key = request.headers.get('Idempotency-Key') or data.get('idempotencyKey')
+        idempotency_keys = attendance_idempotency_keys(client_key, student_id, class_id, raw_image)
+        idempotency_key = idempotency_keys[0]
+        run_async = is_truthy(data.get('async')) or request.args.get('async') == '1'
+
+        def run():
+            image_bytes = prepare_attendance_image(raw_image)
+
+            # Chế độ bất đồng bộ: đẩy vào hàng đợi, trả job_id ngay để client hỏi trạng thái sau
+            if run_async:
+                job_id = job_queue.submit('attendance', {
+                    'student_id': student_id,
+                    'class_id': class_id,
+                    'image_bytes': image_bytes
+                })
+                print(f"[INFO] Attendance job queued: job_id={job_id}, studentId={student_id}, classId={class_id}")
+                return 202, {'job_id': job_id, 'status': 'queued', 'status_url': f'/attendance/jobs/{job_id}'}
+
+            try:
+                recognized, similarity, doc_ref = process_attendance(student_id, class_id, image_bytes)
+            except AttendanceError as e:
+                return e.status_code, e.body()
+            print(f"[INFO] Attendance API response: recognized={recognized}, similarity={similarity}, doc_ref={doc_ref}")
+            return 200, {'recognized': recognized, 'similarity': similarity, 'doc_ref': str(doc_ref)}
+
+        status_code, body, replayed = idempotency_store.run_once(idempotency_keys, run)
+        if replayed:
+            print(f"[INFO] Duplicate attendance submission: studentId={student_id}, classId={class_id}, key={idempotency_key[:12]}")
+        response = jsonify(body)
+        response.status_code = status_code
+        response.headers['Idempotency-Key'] = client_key or idempotency_key
+        if replayed:
+            response.headers['Idempotent-Replay'] = 'true'
+        elif status_code == 409:
+            response.headers['Retry-After'] = str(IDEMPOTENCY_RETRY_AFTER_SECONDS)
+        return response
+    except Exception as e:
+        import traceback
+        print(f"[FATAL] Unknown error: {e}\nTraceback: {traceback.format_exc()}")
+        return jsonify({'error': 'Unknown error', 'details': str(e), 'trace': traceback.format_exc()}), 500
+
+# Trạng thái job điểm danh bất đồng bộ
+@attendance_api.route('/attendance/jobs/<job_id>', methods=['GET'])
+def attendance_job_status(job_id):
+    job = job_queue.status(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+
+# Điểm danh cả lớp từ một ảnh chụp lớp học
+@attendance_api.route('/attendance/class', methods=['POST'])
+def class_photo_attendance():
+    try:
         try:
-            attendance_file_name = save_attendance_image(student_id, image_base64)
+            data, raw_image = read_image_request(request, 'imageBase64')
         except Exception as e:
-            print(f"[ERROR] Lỗi lưu ảnh điểm danh: {e}")
-            return jsonify({'error': 'Save image error', 'details': str(e)}), 500
+            return jsonify({'error': 'Invalid image', 'details': str(e)}), 400
+        class_id = data.get('ClassId') or data.get('classId')
+        if not raw_image or not class_id:
+            print(f"[ERROR] Missing data: image={bool(raw_image)}, classId={class_id}")
+            return jsonify({'error': 'Missing data'}), 400
+        # Ảnh cả lớp giữ độ phân giải cao hơn và không cắt theo một khuôn mặt
+        image_bytes = normalize_image(raw_image, label='class photo',
+                                      max_dimension=IMAGE_GROUP_MAX_DIMENSION, crop_to_face=False)
+        del raw_image
 
-        # So sánh bằng Rekognition
+        db = get_firestore()
+        class_data = classes_cache.get(db, class_id)
+        if class_data is None:
+            return jsonify({'error': 'Class not found'}), 404
+        roster = list(dict.fromkeys(class_data.get('students', [])))
+        if not roster:
+            return jsonify({'error': 'Class has no students'}), 400
+
+        # Nhận diện toàn bộ khuôn mặt trong ảnh và đối chiếu với face collection
         try:
-            recognized, similarity = compare_faces_with_rekognition(student_id, attendance_file_name)
+            with stage('roster_index'):
+                ensure_roster_indexed(roster)
+            with stage('group_match'):
+                matched, faces_detected, faces_searched, unmatched_faces = match_group_photo(get_rekognition(), image_bytes, roster)
         except Exception as e:
             print(f"[ERROR] Rekognition error: {e}")
             return jsonify({'error': 'Rekognition error', 'details': str(e)}), 500
 
-        # Lưu kết quả vào collection 'attendance' với schema mới
+        # Ghi toàn bộ bản ghi điểm danh của lớp bằng batch
+        file_name = f'attendance_photos/class_{class_id}_{int(datetime.utcnow().timestamp())}.jpg'
+        created_at = datetime.utcnow()
+        records = {}
+        doc_refs = []
         try:
-            attendance_doc = {
-                'classId': class_id,
-                'studentId': student_id,
-                'image_url': f'https://storage.googleapis.com/{os.environ.get("GCS_BUCKET_NAME")}/{attendance_file_name}',
-                'similarity': similarity,
-                'status': 'present' if recognized else 'absent',
-                'createdAt': datetime.utcnow(),
-                'verifiedBy': 'rekognition'
-            }
-            doc_ref = db.collection('attendance').add(attendance_doc)[1]
-            print(f"[INFO] Firestore log success: doc_ref={doc_ref}")
+            attendance_ref = db.collection('attendance')
+            # Mỗi sinh viên tốn 2 lệnh ghi (bản ghi + rollup theo sinh viên), cộng 2 rollup theo ngày mỗi batch
+            chunk = (FIRESTORE_BATCH_SIZE - 2) // 2
+            for i in range(0, len(roster), chunk):
+                batch = db.batch()
+                batch_records = []
+                for sid in roster[i:i + chunk]:
+                    recognized = sid in matched
+                    doc_ref = attendance_ref.document()
+                    record = {
+                        'classId': class_id,
+                        'studentId': sid,
+                        'image_url': None,
+                        'image_status': 'pending',
+                        'similarity': matched.get(sid, 0),
+                        'status': 'present' if recognized else 'absent',
+                        'createdAt': created_at,
+                        'verifiedBy': 'rekognition-collection'
+                    }
+                    batch.set(doc_ref, record)
+                    batch_records.append(record)
+                    doc_refs.append(doc_ref)
+                    records[sid] = {'recognized': recognized, 'similarity': matched.get(sid, 0), 'doc_ref': doc_ref.id}
+                add_rollups(batch, db, batch_records)
+                with stage('firestore_write', service='firestore'):
+                    batch.commit()
+                versions.bump('attendance')
         except Exception as e:
-            print(f"[ERROR] Firestore log error: {e}")
+            print(f"[ERROR] Firestore batch error: {e}")
             return jsonify({'error': 'Firestore log error', 'details': str(e)}), 500
 
-        print(f"[INFO] Attendance success: studentId={student_id}, classId={class_id}, recognized={recognized}, similarity={similarity}")
-        print(f"[INFO] Attendance API response: recognized={recognized}, similarity={similarity}, doc_ref={doc_ref}")
-        return jsonify({'recognized': recognized, 'similarity': similarity, 'doc_ref': str(doc_ref)})
+        archive_executor.submit(archive_group_image, doc_refs, file_name, image_bytes)
+
+        print(f"[INFO] Class attendance success: classId={class_id}, faces={faces_detected}, searched={faces_searched}, present={len(matched)}/{len(roster)}, unmatched={unmatched_faces}")
+        return jsonify({
+            'classId': class_id,
+            # facesDetected: theo detect_faces; facesSearched: số ảnh cắt thật sự đem so khớp
+            # (unmatchedFaces tính trên facesSearched)
+            'facesDetected': faces_detected,
+            'facesSearched': faces_searched,
+            'unmatchedFaces': unmatched_faces,
+            'present': [sid for sid in roster if sid in matched],
+            'absent': [sid for sid in roster if sid not in matched],
+            'records': records
+        })
     except Exception as e:
         import traceback
         print(f"[FATAL] Unknown error: {e}\nTraceback: {traceback.format_exc()}")
@@ -0,0 +1,208 @@
+# management_api/auth_middleware.py
+# Lớp xác thực dùng chung cho mọi blueprint (before_request):
+# - Firebase ID token (Authorization: Bearer ...) được kiểm tra cục bộ bằng chứng chỉ ký của Google,
+#   chứng chỉ được tải trước và làm mới trong thread nền nên request không phải chờ tải khoá.
+# - Token đã giải mã được giữ trong LRU tới khi hết hạn (exp).
+# - Vai trò (role) của uid lấy từ cache document users (doc_cache), bị xoá khi users/{uid} được ghi.
+# AUTH_REQUIRED=1: mọi đường dẫn ngoài AUTH_PUBLIC_PATHS đều phải có token hợp lệ.
+# Mặc định chỉ gắn g.user khi có token; endpoint cần quyền dùng decorator require_auth.
+import functools
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from flask import g, jsonify, request
+from clients import FIREBASE_PROJECT_ID, get_firestore
+from doc_cache import users_cache
+
+AUTH_REQUIRED = os.environ.get('AUTH_REQUIRED', '0') == '1'
+AUTH_PUBLIC_PATHS = [p.strip() for p in os.environ.get(
+    'AUTH_PUBLIC_PATHS', '/api/login,/api/register,/debug_,/metrics').split(',') if p.strip()]
+AUTH_TOKEN_CACHE_SIZE = int(os.environ.get('AUTH_TOKEN_CACHE_SIZE', 10000))
+AUTH_CERT_REFRESH_SECONDS = int(os.environ.get('AUTH_CERT_REFRESH_SECONDS', 3600))
+FIREBASE_CERTS_URL = 'https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com'
+# Không làm mới chứng chỉ đồng bộ quá một lần trong khoảng này khi gặp kid lạ
+CERT_FORCED_REFRESH_MIN_SECONDS = 30
+CLOCK_SKEW_SECONDS = 10
+
+
+class CertificateStore:
+    def __init__(self, url, refresh_seconds):
+        self.url = url
+        self.refresh_seconds = refresh_seconds
+        self._lock = threading.Lock()
+        self._certs = {}
+        self._fetched_at = 0
+        self._thread = None
+        self.refreshes = 0
+        self.failures = 0
+
+    def _fetch(self):
+        import requests
+        response = requests.get(self.url, timeout=10)
+        response.raise_for_status()
+        # Dùng max-age của Google nếu có, không thì theo cấu hình
+        max_age = self.refresh_seconds
+        for part in response.headers.get('Cache-Control', '').split(','):
+            part = part.strip()
+            if part.startswith('max-age='):
+                max_age = min(max_age, int(part[len('max-age='):]))
+        with self._lock:
+            self._certs = response.json()
+            self._fetched_at = time.monotonic()
+            self.refreshes += 1
+        return max_age
+
+    def _run(self):
+        while True:
+            try:
+                max_age = self._fetch()
+                # Làm mới trước khi hết hạn
+                delay = max(60, max_age * 0.8)
+            except Exception as e:
+                with self._lock:
+                    self.failures += 1
+                print(f"[ERROR] Refresh Firebase signing certs: {e}")
+                delay = 60
+            time.sleep(delay)
+
+    def start(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='auth-cert-refresh', daemon=True)
+                    self._thread.start()
+
+    def certs(self, kid=None):
+        self.start()
+        with self._lock:
+            certs = self._certs
+            fetched_at = self._fetched_at
+        # Lần đầu (thread nền chưa tải xong) hoặc gặp kid mới do Google vừa xoay khoá: tải đồng bộ
+        if not certs or (kid and kid not in certs and time.monotonic() - fetched_at > CERT_FORCED_REFRESH_MIN_SECONDS):
+            self._fetch()
+            with self._lock:
+                certs = self._certs
+        return certs
+
+
+class TokenCache:
+    # LRU: sha256(token) -> (claims, exp)
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= time.time():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, claims):
+        with self._lock:
+            self._entries[key] = (claims, claims.get('exp', 0))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+cert_store = CertificateStore(FIREBASE_CERTS_URL, AUTH_CERT_REFRESH_SECONDS)
+token_cache = TokenCache(AUTH_TOKEN_CACHE_SIZE)
+
+
+def verify_id_token(id_token):
+    # Tương đương firebase_admin.auth.verify_id_token (không kiểm tra thu hồi), nhưng dùng chứng chỉ đã tải sẵn
+    key = hashlib.sha256(id_token.encode('utf-8')).hexdigest()
+    claims = token_cache.get(key)
+    if claims is not None:
+        return claims
+    from google.auth import jwt
+    header = jwt.decode_header(id_token)
+    claims = jwt.decode(id_token, certs=cert_store.certs(header.get('kid')), audience=FIREBASE_PROJECT_ID,
+                        clock_skew_in_seconds=CLOCK_SKEW_SECONDS)
+    if claims.get('iss') != f'https://securetoken.google.com/{FIREBASE_PROJECT_ID}':
+        raise ValueError('Invalid token issuer')
+    if not claims.get('sub'):
+        raise ValueError('Invalid token subject')
+    claims['uid'] = claims['sub']
+    token_cache.put(key, claims)
+    return claims
+
+
+def _bearer_token():
+    auth_header = request.headers.get('Authorization', '')
+    if not auth_header.startswith('Bearer '):
+        return None
+    return auth_header.split(' ', 1)[1].strip() or None
+
+
+def _is_public(path):
+    return any(path == p or path.startswith(p) for p in AUTH_PUBLIC_PATHS)
+
+
+def authenticate():
+    g.user = None
+    token = _bearer_token()
+    if token:
+        try:
+            g.user = verify_id_token(token)
+        except Exception as e:
+            print(f"[AUTH] Invalid token on {request.path}: {e}")
+    if AUTH_REQUIRED and g.user is None and request.method != 'OPTIONS' and not _is_public(request.path):
+        return jsonify({'error': 'Unauthorized'}), 401
+
+
+def current_user():
+    return getattr(g, 'user', None)
+
+
+def current_profile():
+    # Hồ sơ users/{uid} đọc qua cache document users (kèm role), chỉ đọc một lần mỗi request
+    user = current_user()
+    if user is None:
+        return None
+    if 'profile' not in g:
+        g.profile = users_cache.get(get_firestore(), user['uid'])
+    return g.profile
+
+
+def require_auth(*roles):
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if current_user() is None:
+                return jsonify({'error': 'Unauthorized'}), 401
+            if roles:
+                profile = current_profile()
+                if profile is None:
+                    return jsonify({'error': 'User not found'}), 404
+                if profile.get('role') not in roles:
+                    return jsonify({'error': 'Forbidden'}), 403
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def init_auth(app):
+    app.before_request(authenticate)
+    # Tải chứng chỉ ký ngay trong thread nền để request đầu tiên có token không phải chờ
+    cert_store.start()
+
+
+def auth_stats():
+    return {'required': AUTH_REQUIRED, 'tokens': token_cache.stats(),
+            'cert_refreshes': cert_store.refreshes, 'cert_failures': cert_store.failures}
@@ -0,0 +1,83 @@
+# management_api/bench_login_storm.py
+# Giả lập "bão đăng nhập" buổi sáng: nhiều client cùng gọi /api/login, đồng thời đo độ trễ
+# của một endpoint khác (probe) để xem việc kiểm tra password có làm nghẽn cả server không.
+#   python bench_login_storm.py --url http://localhost:8080 --email a@b.c --password secret \
+#       --concurrency 50 --requests 500 --probe /debug_clients
+# Chạy một lần với code cũ và một lần với code mới rồi so sánh p50/p95 và throughput.
+import argparse
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+def percentile(values, pct):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def summary(name, timings, statuses, elapsed=None):
+    line = (f"[BENCH] {name}: n={len(timings)} p50={percentile(timings, 50) * 1000:.0f}ms "
+            f"p95={percentile(timings, 95) * 1000:.0f}ms p99={percentile(timings, 99) * 1000:.0f}ms "
+            f"mean={statistics.mean(timings) * 1000:.0f}ms" if timings else f"[BENCH] {name}: n=0")
+    if elapsed:
+        line += f" throughput={len(timings) / elapsed:.1f}/s"
+    codes = {}
+    for status in statuses:
+        codes[status] = codes.get(status, 0) + 1
+    print(f"{line} status={codes}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Login storm benchmark')
+    parser.add_argument('--url', default='http://localhost:8080')
+    parser.add_argument('--email', required=True)
+    parser.add_argument('--password', required=True)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--probe', default='/debug_clients', help='Endpoint đo song song trong lúc bão đăng nhập')
+    args = parser.parse_args()
+
+    local = threading.local()
+
+    def session():
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        return local.session
+
+    def login(_):
+        start = time.perf_counter()
+        response = session().post(f'{args.url}/api/login', json={'email': args.email, 'password': args.password})
+        return time.perf_counter() - start, response.status_code
+
+    probe_timings, probe_statuses = [], []
+    stop = threading.Event()
+
+    def probe():
+        probe_session = requests.Session()
+        while not stop.is_set():
+            start = time.perf_counter()
+            response = probe_session.get(f'{args.url}{args.probe}')
+            probe_timings.append(time.perf_counter() - start)
+            probe_statuses.append(response.status_code)
+            time.sleep(0.05)
+
+    probe_thread = threading.Thread(target=probe, daemon=True)
+    probe_thread.start()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(login, range(args.requests)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    probe_thread.join()
+
+    summary('login', [r[0] for r in results], [r[1] for r in results], elapsed)
+    summary(f'probe {args.probe}', probe_timings, probe_statuses)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+# management_api/bench_report_class.py
+# So sánh độ trễ /api/reports/class: cách cũ (stream attendance từng lớp) và cách mới (count aggregation song song).
+# Chạy với Firestore emulator để có dữ liệu giả lập:
+#   FIRESTORE_EMULATOR_HOST=localhost:8080 python bench_report_class.py --seed 200 50
+# hoặc chạy trên project thật (chỉ đọc):
+#   python bench_report_class.py --runs 3
+import argparse
+import os
+import random
+import statistics
+import time
+from datetime import datetime
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from clients import get_firestore
+from report_api import build_class_report
+
+
+def legacy_class_report(db):
+    # Cách cũ: mỗi lớp một lần stream toàn bộ attendance chỉ để đếm
+    data = []
+    for class_doc in db.collection('classes').stream():
+        class_data = class_doc.to_dict()
+        present, total = 0, 0
+        for att_doc in db.collection('attendance').where('classId', '==', class_doc.id).stream():
+            if att_doc.to_dict().get('status') == 'present':
+                present += 1
+            total += 1
+        data.append({
+            "class": class_data.get('name', ''),
+            "attendanceRate": round(100 * present / total, 2) if total else 0,
+            "studentCount": len(class_data.get('students', []))
+        })
+    return data
+
+
+def seed(db, classes, records_per_class):
+    if not os.environ.get('FIRESTORE_EMULATOR_HOST'):
+        raise SystemExit('--seed chỉ được dùng với FIRESTORE_EMULATOR_HOST')
+    batch = db.batch()
+    pending = 0
+    for c in range(classes):
+        class_id = f'BENCH{c:04d}'
+        students = [f'bench_student_{c}_{i}' for i in range(40)]
+        batch.set(db.collection('classes').document(class_id), {'name': f'Bench class {c}', 'students': students})
+        pending += 1
+        for _ in range(records_per_class):
+            batch.set(db.collection('attendance').document(), {
+                'classId': class_id,
+                'studentId': random.choice(students),
+                'status': random.choice(['present', 'present', 'present', 'absent']),
+                'createdAt': datetime.utcnow()
+            })
+            pending += 1
+            if pending >= 450:
+                batch.commit()
+                batch = db.batch()
+                pending = 0
+    if pending:
+        batch.commit()
+    print(f"[BENCH] Seeded {classes} classes x {records_per_class} attendance records")
+
+
+def measure(name, fn, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - start)
+    print(f"[BENCH] {name}: classes={len(result)} runs={runs} "
+          f"mean={statistics.mean(timings):.3f}s min={min(timings):.3f}s max={max(timings):.3f}s")
+    return statistics.mean(timings), result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark /api/reports/class')
+    parser.add_argument('--seed', nargs=2, type=int, metavar=('CLASSES', 'RECORDS_PER_CLASS'))
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    db = get_firestore()
+    if args.seed:
+        seed(db, *args.seed)
+    legacy_time, legacy = measure('legacy stream per class', lambda: legacy_class_report(db), args.runs)
+    new_time, new = measure('parallel count aggregation', lambda: build_class_report(db), args.runs)
+    if sorted(map(str, legacy)) != sorted(map(str, new)):
+        print("[BENCH] WARNING: kết quả hai cách khác nhau")
+    print(f"[BENCH] Speedup: {legacy_time / new_time:.1f}x (chưa tính cache, request lặp lại trong REPORT_CACHE_SECONDS không truy vấn Firestore)")
@@ -1,42 +1,59 @@
 from flask import Blueprint, request, jsonify
-from google.cloud import firestore
 from datetime import datetime
 import os
+from google.api_core.exceptions import NotFound
+from class_roster import clear_members, remove_class_info, reset_class_count, set_class_info, update_roster
+from clients import get_firestore
+from user_lookup import resolve_users
+from doc_cache import invalidate_class
+from etag import conditional
+from metrics import counted, get_document
+from pagination import fetch_page, page_args, project, select_fields
 
 class_api = Blueprint('class_api', __name__)
 
-# Đường dẫn mới tới file service account key
-SERVICE_ACCOUNT_KEY_PATH = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS")
-FIREBASE_PROJECT_ID = os.environ.get("FIREBASE_PROJECT_ID")
-db = firestore.Client.from_service_account_json(SERVICE_ACCOUNT_KEY_PATH, project=FIREBASE_PROJECT_ID)
+# Số mã sinh viên tối đa trong một lần ghi danh/huỷ ghi danh theo lô
+ENROLL_MAX_IDS = int(os.environ.get('ENROLL_MAX_IDS', 1000))
+
+# Trường trả về -> trường lưu trong Firestore (None: lấy từ doc.id); instructorName suy ra từ instructor
+CLASS_LIST_FIELDS = {'id': None, 'name': 'name', 'code': 'code', 'room': 'room', 'schedule': 'schedule',
+                     'instructor': 'instructor', 'instructorName': 'instructor', 'numberStudent': 'numberStudent',
+                     'students': 'students', 'createdAt': 'createdAt'}
+
 
 # Lấy danh sách lớp
 @class_api.route('/api/classes', methods=['GET'])
+@conditional('classes', 'users')
 def get_classes():
     try:
+        db = get_firestore()
+        try:
+            limit, cursor, fields = page_args(request.args)
+            names, stored = select_fields(fields, CLASS_LIST_FIELDS)
+        except ValueError as e:
+            return jsonify(success=False, error=str(e)), 400
         classes_ref = db.collection('classes')
-        docs = classes_ref.stream()
+        # Không truyền fields: trả nguyên document như trước
+        if fields is not None:
+            classes_ref = classes_ref.select(stored)
+        page, next_cursor = fetch_page(classes_ref, limit, cursor)
+        docs = [(doc.id, doc.to_dict()) for doc in page]
+        # Tên giảng viên (instructor là uid) được đọc theo lô một lần cho cả danh sách
+        instructors = resolve_users(db, [c.get('instructor') for _, c in docs]) if 'instructorName' in names else {}
         classes = []
-        user_cache = {}
-        for doc in docs:
-            c = doc.to_dict()
-            c['id'] = doc.id
+        for doc_id, c in docs:
+            c['id'] = doc_id
             instructor = c.get('instructor')
             if isinstance(instructor, str):
                 # Nếu instructor là uid, lấy tên từ users
-                if instructor not in user_cache:
-                    user_doc = db.collection('users').document(instructor).get()
-                    if user_doc.exists:
-                        user_cache[instructor] = user_doc.to_dict().get('name', instructor)
-                    else:
-                        user_cache[instructor] = instructor
-                c['instructorName'] = user_cache[instructor]
+                user = instructors.get(instructor)
+                c['instructorName'] = (user.get('name') or instructor) if user else instructor
             elif isinstance(instructor, dict):
                 c['instructorName'] = instructor.get('name', '')
             else:
                 c['instructorName'] = ''
-            classes.append(c)
-        return jsonify(success=True, classes=classes)
+            classes.append(project(c, names) if fields is not None else c)
+        return jsonify(success=True, classes=classes, next_cursor=next_cursor)
     except Exception as e:
         import traceback
         print(traceback.format_exc())
@@ -45,8 +62,10 @@ def get_classes():
 # Thêm lớp mới
 @class_api.route('/api/classes', methods=['POST'])
 def add_class():
+    db = get_firestore()
     data = request.json
     class_id = data.get("code")  # Dùng code làm classId
+    students = list(dict.fromkeys(data.get("students", [])))
     new_class = {
         "name": data.get("name"),
         "code": class_id,
@@ -54,13 +73,21 @@ def add_class():
         "schedule": data.get("schedule", {}),
         "instructor": data.get("instructor", {}),
         "numberStudent": data.get("numberStudent", 0),
-        "students": data.get("students", []),
+        "students": students,
+        "totalStudents": len(students),
         "createdAt": datetime.utcnow()
     }
     try:
         doc_ref = db.collection('classes').document(class_id)
         new_class['id'] = class_id
-        doc_ref.set(new_class)
+        # Mã lớp có thể đã dùng trước đó: bỏ document đánh dấu và sĩ số cũ, tạo lớp rỗng rồi ghi danh như bình thường
+        clear_members(db, class_id)
+        reset_class_count(db, class_id)
+        doc_ref.set(dict(new_class, students=[], totalStudents=0))
+        set_class_info(db, class_id, name=new_class['name'], code=class_id)
+        if students:
+            update_roster(db, class_id, add=students)
+        invalidate_class(class_id)
         return jsonify({"success": True, "class": new_class})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
@@ -68,15 +95,23 @@ def add_class():
 # Sửa thông tin lớp
 @class_api.route('/api/classes/<class_id>', methods=['PUT'])
 def update_class(class_id):
+    db = get_firestore()
     data = request.json
     try:
         class_ref = db.collection('classes').document(class_id)
         update_data = {}
-        for field in ["name", "room", "schedule", "instructor", "numberStudent", "students"]:
+        for field in ["name", "room", "schedule", "instructor", "numberStudent"]:
             if field in data:
                 update_data[field] = data[field]
         if update_data:
             class_ref.update(update_data)
+            if "name" in update_data:
+                set_class_info(db, class_id, name=update_data["name"])
+        # Thay cả danh sách sinh viên: thêm/xoá phần chênh lệch, totalStudents tăng/giảm theo đó
+        if "students" in data:
+            update_roster(db, class_id, replace=data["students"])
+        if update_data or "students" in data:
+            invalidate_class(class_id)
         return jsonify({"success": True})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
@@ -85,8 +120,12 @@ def update_class(class_id):
 @class_api.route('/api/classes/<class_id>', methods=['DELETE'])
 def delete_class(class_id):
     try:
+        db = get_firestore()
         class_ref = db.collection('classes').document(class_id)
         class_ref.delete()
+        clear_members(db, class_id)
+        remove_class_info(db, class_id)
+        invalidate_class(class_id)
         return jsonify({"success": True})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
@@ -95,9 +134,10 @@ def delete_class(class_id):
 @class_api.route('/api/classes/student/<studentId>', methods=['GET'])
 def get_classes_of_student(studentId):
     try:
+        db = get_firestore()
         # studentId phải là mã sinh viên, không phải email/uid
         classes_ref = db.collection('classes').where('students', 'array_contains', studentId)
-        docs = classes_ref.stream()
+        docs = counted(classes_ref.stream())
         classes = []
         for doc in docs:
             c = doc.to_dict()
@@ -118,18 +158,54 @@ def add_student_to_class(class_id):
     if not studentId:
         return jsonify({'success': False, 'error': 'Missing studentId'}), 400
     try:
-        db = firestore.Client.from_service_account_json(SERVICE_ACCOUNT_KEY_PATH, project=FIREBASE_PROJECT_ID)
-        class_ref = db.collection('classes').document(class_id)
-        class_doc = class_ref.get()
-        if not class_doc.exists:
+        db = get_firestore()
+        # ArrayUnion: không đọc cả mảng; totalStudents chỉ tăng khi sinh viên chưa có trong lớp
+        try:
+            update_roster(db, class_id, add=[studentId])
+        except NotFound:
             return jsonify({'success': False, 'error': 'Class not found'}), 404
-        class_data = class_doc.to_dict()
-        students_list = class_data.get('students', [])
-        if studentId not in students_list:
-            students_list.append(studentId)
-            class_ref.update({'students': students_list})
+        invalidate_class(class_id)
         return jsonify({'success': True, 'class_id': class_id, 'student_id': studentId})
     except Exception as e:
         import traceback
         print(f"[ERROR /api/classes/<class_id>/add_student]: {e}\nTraceback: {traceback.format_exc()}")
-        return jsonify({'success': False, 'error': str(e), 'trace': traceback.format_exc()}), 500
\ No newline at end of file
+        return jsonify({'success': False, 'error': str(e), 'trace': traceback.format_exc()}), 500
+
+def parse_student_ids(value):
+    if value is None:
+        return []
+    if not isinstance(value, list) or not all(isinstance(sid, str) and sid for sid in value):
+        raise ValueError('Student ids must be a list of non-empty strings')
+    return list(dict.fromkeys(value))
+
+# Ghi danh/huỷ ghi danh nhiều sinh viên trong một lần gọi: {"add": [...], "remove": [...]}
+@class_api.route('/api/classes/<class_id>/students', methods=['POST'])
+def bulk_enroll_students(class_id):
+    data = request.get_json(silent=True) or {}
+    try:
+        to_add = parse_student_ids(data.get('add'))
+        to_remove = parse_student_ids(data.get('remove'))
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    if not to_add and not to_remove:
+        return jsonify({'success': False, 'error': 'Missing add/remove'}), 400
+    if len(to_add) + len(to_remove) > ENROLL_MAX_IDS:
+        return jsonify({'success': False, 'error': f'At most {ENROLL_MAX_IDS} student ids per call'}), 400
+    try:
+        db = get_firestore()
+        # ArrayUnion/ArrayRemove và totalStudents trong cùng một commit (danh sách dài: mỗi 225 id một commit)
+        try:
+            added, removed = update_roster(db, class_id, add=to_add, remove=to_remove)
+        except NotFound:
+            return jsonify({'success': False, 'error': 'Class not found'}), 404
+        invalidate_class(class_id)
+        # Chỉ đọc trường totalStudents, không tải mảng students
+        class_doc = get_document(db.collection('classes').document(class_id), field_paths=['totalStudents'])
+        total = (class_doc.to_dict() or {}).get('totalStudents')
+        print(f"[INFO] Bulk enroll classId={class_id}: added={len(added)}, removed={len(removed)}, total={total}")
+        return jsonify({'success': True, 'class_id': class_id, 'added': added, 'removed': removed,
+                        'totalStudents': total})
+    except Exception as e:
+        import traceback
+        print(f"[ERROR /api/classes/<class_id>/students]: {e}\nTraceback: {traceback.format_exc()}")
+        return jsonify({'success': False, 'error': str(e), 'trace': traceback.format_exc()}), 500
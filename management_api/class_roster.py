@@ -0,0 +1,186 @@
+# management_api/class_roster.py
+# Ghi danh sinh viên vào lớp bằng ArrayUnion/ArrayRemove trên mảng students (không đọc cả mảng, không transaction).
+# Mỗi sinh viên của lớp có thêm một document đánh dấu classes/{class_id}/members/{student_id}: chỉ đọc các
+# document của những id đang thêm/xoá để biết id nào thật sự mới, rồi tăng/giảm totalStudents bằng Increment.
+# Document đánh dấu được tạo bằng create() và xoá với điều kiện exists, nên hai lệnh ghi danh đồng thời
+# cùng một sinh viên không đếm hai lần (lệnh thua đọc lại rồi ghi lại).
+# Dashboard/báo cáo đọc danh sách lớp và sĩ số từ class_directory thay vì quét collection classes:
+# - class_directory/info: {classes: {class_id: {name, code}}}, ghi khi tạo/sửa/xoá lớp
+# - class_directory/counts__{shard}: {students: {class_id: n}}, cộng dồn cùng commit với totalStudents
+#   (chia ROLLUP_SHARDS shard như rollups.py để ghi danh đồng thời không dồn vào một document)
+#   python class_roster.py backfill   # tạo document đánh dấu, totalStudents và class_directory cho dữ liệu có từ trước
+import argparse
+import random
+from google.api_core.exceptions import AlreadyExists, Conflict, FailedPrecondition, NotFound
+from google.cloud import firestore
+from metrics import counted, get_document
+from rollups import ROLLUP_SHARDS
+
+MEMBERS_COLLECTION = 'members'
+CLASS_DIRECTORY = 'class_directory'
+# Số id mỗi commit (giới hạn 500 lệnh ghi của Firestore, còn chỗ cho các lệnh ghi vào document lớp)
+ROSTER_CHUNK_SIZE = 450
+ROSTER_RETRIES = 3
+
+
+def members_ref(db, class_id):
+    return db.collection('classes').document(class_id).collection(MEMBERS_COLLECTION)
+
+
+def _directory(db):
+    return db.collection(CLASS_DIRECTORY)
+
+
+def _count_shard(db, shard=None):
+    return _directory(db).document(f'counts__{random.randrange(ROLLUP_SHARDS) if shard is None else shard}')
+
+
+def set_class_info(db, class_id, **info):
+    # name/code của lớp trong class_directory/info (merge: chỉ ghi các trường truyền vào)
+    _directory(db).document('info').set({'classes': {class_id: info}}, merge=True)
+
+
+def reset_class_count(db, class_id):
+    # Lớp bị xoá hoặc tạo lại: bỏ sĩ số cũ ở mọi shard
+    batch = db.batch()
+    for shard in range(ROLLUP_SHARDS):
+        batch.set(_count_shard(db, shard), {'students': {class_id: firestore.DELETE_FIELD}}, merge=True)
+    batch.commit()
+
+
+def remove_class_info(db, class_id):
+    _directory(db).document('info').set({'classes': {class_id: firestore.DELETE_FIELD}}, merge=True)
+    reset_class_count(db, class_id)
+
+
+def class_summary(db):
+    # {class_id: {name, code, totalStudents}}: đọc 1 + ROLLUP_SHARDS document bằng một lần get_all.
+    # Chưa chạy backfill (info chưa có ready): quét classes như trước, sĩ số lấy từ mảng students nếu thiếu totalStudents
+    directory = _directory(db)
+    refs = [directory.document('info')] + [_count_shard(db, shard) for shard in range(ROLLUP_SHARDS)]
+    snaps = {snap.id: snap.to_dict() or {} for snap in counted(db.get_all(refs)) if snap.exists}
+    info = snaps.pop('info', {})
+    if info.get('ready'):
+        totals = {}
+        for data in snaps.values():
+            for class_id, n in (data.get('students') or {}).items():
+                totals[class_id] = totals.get(class_id, 0) + (n or 0)
+        return {class_id: {'name': meta.get('name', ''), 'code': meta.get('code', ''),
+                           'totalStudents': totals.get(class_id, 0)}
+                for class_id, meta in sorted((info.get('classes') or {}).items())}
+    print("[INFO] class_directory not built yet, scanning classes (run: python class_roster.py backfill)")
+    summary = {}
+    for doc in counted(db.collection('classes').select(['name', 'code', 'totalStudents', 'students']).stream()):
+        data = doc.to_dict() or {}
+        total = data.get('totalStudents')
+        summary[doc.id] = {'name': data.get('name', ''), 'code': data.get('code', ''),
+                           'totalStudents': total if total is not None else len(set(data.get('students') or []))}
+    return summary
+
+
+def _apply_chunk(db, class_id, add, remove):
+    class_ref = db.collection('classes').document(class_id)
+    members = members_ref(db, class_id)
+    for attempt in range(ROSTER_RETRIES + 1):
+        refs = [members.document(sid) for sid in dict.fromkeys(add + remove)]
+        present = {snap.id for snap in counted(db.get_all(refs, field_paths=['studentId'])) if snap.exists}
+        dropped = set(remove)
+        added = [sid for sid in add if sid not in present and sid not in dropped]
+        removed = [sid for sid in remove if sid in present]
+        batch = db.batch()
+        # Mảng students luôn được ghi mù; totalStudents chỉ đổi theo số id thật sự thêm/xoá
+        if add:
+            batch.update(class_ref, {'students': firestore.ArrayUnion(add)})
+        if remove:
+            batch.update(class_ref, {'students': firestore.ArrayRemove(remove)})
+        if len(added) != len(removed):
+            delta = firestore.Increment(len(added) - len(removed))
+            batch.update(class_ref, {'totalStudents': delta})
+            batch.set(_count_shard(db), {'students': {class_id: delta}}, merge=True)
+        for sid in added:
+            batch.create(members.document(sid), {'studentId': sid})
+        for sid in removed:
+            batch.delete(members.document(sid), option=db.write_option(exists=True))
+        try:
+            batch.commit()
+            return added, removed
+        except (AlreadyExists, Conflict, FailedPrecondition, NotFound) as e:
+            # NotFound: lớp không tồn tại, hoặc document đánh dấu vừa bị lệnh khác xoá
+            if isinstance(e, NotFound):
+                if not get_document(class_ref, field_paths=['code']).exists:
+                    raise NotFound(f'Class {class_id} not found')
+            if attempt == ROSTER_RETRIES:
+                raise
+            print(f"[INFO] Roster write for {class_id} raced with another enrolment, retrying: {e}")
+
+
+def update_roster(db, class_id, add=(), remove=(), replace=None):
+    # add trước, remove sau (id có ở cả hai thì bị xoá); replace: thay cả danh sách (so với các document đánh dấu).
+    # Trả về (added, removed) gồm các id thật sự thay đổi; NotFound nếu lớp không tồn tại.
+    add, remove = list(dict.fromkeys(add)), list(dict.fromkeys(remove))
+    if replace is not None:
+        add = list(dict.fromkeys(replace))
+        wanted = set(add)
+        current = [doc.id for doc in counted(members_ref(db, class_id).select(['studentId']).stream())]
+        remove = [sid for sid in current if sid not in wanted]
+    if not add and not remove:
+        return [], []
+    added, removed = [], []
+    # Danh sách dài được chia thành nhiều commit, mỗi commit tự giữ totalStudents đúng
+    for i in range(0, max(len(add), len(remove)), ROSTER_CHUNK_SIZE // 2):
+        chunk_added, chunk_removed = _apply_chunk(
+            db, class_id, add[i:i + ROSTER_CHUNK_SIZE // 2], remove[i:i + ROSTER_CHUNK_SIZE // 2])
+        added += chunk_added
+        removed += chunk_removed
+    return added, removed
+
+
+def clear_members(db, class_id):
+    # Lớp bị xoá hoặc tạo lại: bỏ các document đánh dấu cũ để không bị đếm vào lớp mới cùng mã
+    writer = db.bulk_writer()
+    for doc in counted(members_ref(db, class_id).select(['studentId']).stream()):
+        writer.delete(doc.reference)
+    writer.close()
+
+
+def backfill(db):
+    # Chạy một lần khi triển khai (và bất cứ lúc nào cần sửa lại, lúc không có ai ghi danh): đồng bộ
+    # document đánh dấu, totalStudents và class_directory theo mảng students hiện có
+    updated = 0
+    classes = {}
+    counts = {}
+    for snap in db.collection('classes').select(['name', 'code', 'students', 'totalStudents']).stream():
+        data = snap.to_dict() or {}
+        students = set(data.get('students') or [])
+        classes[snap.id] = {'name': data.get('name', ''), 'code': data.get('code', '')}
+        counts[snap.id] = len(students)
+        members = members_ref(db, snap.id)
+        current = {doc.id for doc in members.select(['studentId']).stream()}
+        writer = db.bulk_writer()
+        for sid in students - current:
+            writer.set(members.document(sid), {'studentId': sid})
+        for sid in current - students:
+            writer.delete(members.document(sid))
+        if data.get('totalStudents') != len(students):
+            writer.update(snap.reference, {'totalStudents': len(students)})
+        writer.close()
+        if students != current or data.get('totalStudents') != len(students):
+            updated += 1
+    # Ghi đè toàn bộ class_directory: sĩ số dồn vào shard 0, các shard khác về rỗng
+    batch = db.batch()
+    batch.set(_directory(db).document('info'), {'classes': classes, 'ready': True})
+    for shard in range(ROLLUP_SHARDS):
+        batch.set(_count_shard(db, shard), {'students': counts if shard == 0 else {}})
+    batch.commit()
+    return updated
+
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+    load_dotenv()
+    from clients import get_firestore
+
+    parser = argparse.ArgumentParser(description='Class roster maintenance')
+    parser.add_argument('command', choices=['backfill'])
+    args = parser.parse_args()
+    print(f"[ROSTER] members/totalStudents updated for {backfill(get_firestore())} classes")
@@ -0,0 +1,171 @@
+# management_api/clients.py
+# Registry dùng chung cho các client Firestore, GCS và Rekognition của mọi blueprint.
+# Client chỉ được tạo ở lần dùng đầu tiên (thread-safe), file key chỉ đọc một lần,
+# và được tái sử dụng cho mọi request thay vì dựng kênh gRPC/HTTP mới mỗi lần.
+import itertools
+import os
+import threading
+import time
+from metrics import instrument_boto3_client, instrument_http_session
+
+SERVICE_ACCOUNT_KEY_PATH = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS")
+FIREBASE_PROJECT_ID = os.environ.get("FIREBASE_PROJECT_ID")
+# Số kênh gRPC Firestore (mỗi client một kênh), các request được chia vòng tròn
+FIRESTORE_CHANNEL_POOL_SIZE = int(os.environ.get('FIRESTORE_CHANNEL_POOL_SIZE', 1))
+# Số kết nối HTTP giữ sẵn cho GCS và Rekognition
+GCS_HTTP_POOL_SIZE = int(os.environ.get('GCS_HTTP_POOL_SIZE', 32))
+REKOGNITION_MAX_POOL_CONNECTIONS = int(os.environ.get('REKOGNITION_MAX_POOL_CONNECTIONS', 32))
+
+
+class ClientRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._credentials = None
+        self._firestore_pool = []
+        self._firestore_cycle = None
+        self._storage = None
+        self._rekognition = None
+        self._firebase_app = None
+        self._created = {'firestore': 0, 'storage': 0, 'rekognition': 0, 'firebase_app': 0}
+        self._init_seconds = {}
+
+    def _timed(self, name, factory):
+        start = time.perf_counter()
+        client = factory()
+        self._init_seconds[name] = round(self._init_seconds.get(name, 0) + time.perf_counter() - start, 4)
+        return client
+
+    def _get_credentials(self):
+        # Gọi khi đang giữ self._lock
+        if self._credentials is None:
+            if SERVICE_ACCOUNT_KEY_PATH:
+                from google.oauth2 import service_account
+                self._credentials = service_account.Credentials.from_service_account_file(
+                    SERVICE_ACCOUNT_KEY_PATH,
+                    scopes=['https://www.googleapis.com/auth/cloud-platform']
+                )
+            else:
+                import google.auth
+                self._credentials, _ = google.auth.default(scopes=['https://www.googleapis.com/auth/cloud-platform'])
+        return self._credentials
+
+    def firestore(self):
+        if self._firestore_cycle is None:
+            with self._lock:
+                if self._firestore_cycle is None:
+                    from google.cloud import firestore
+                    credentials = self._get_credentials()
+                    for _ in range(max(1, FIRESTORE_CHANNEL_POOL_SIZE)):
+                        self._firestore_pool.append(self._timed(
+                            'firestore', lambda: firestore.Client(project=FIREBASE_PROJECT_ID, credentials=credentials)))
+                        self._created['firestore'] += 1
+                    self._firestore_cycle = itertools.cycle(self._firestore_pool)
+        if len(self._firestore_pool) == 1:
+            return self._firestore_pool[0]
+        with self._lock:
+            return next(self._firestore_cycle)
+
+    def storage(self):
+        if self._storage is None:
+            with self._lock:
+                if self._storage is None:
+                    from google.cloud import storage
+                    from google.auth.transport.requests import AuthorizedSession
+                    from requests.adapters import HTTPAdapter
+                    credentials = self._get_credentials()
+
+                    def build():
+                        session = AuthorizedSession(credentials)
+                        adapter = HTTPAdapter(pool_connections=GCS_HTTP_POOL_SIZE, pool_maxsize=GCS_HTTP_POOL_SIZE)
+                        session.mount('https://', adapter)
+                        instrument_http_session(session, 'gcs')
+                        return storage.Client(project=FIREBASE_PROJECT_ID, credentials=credentials, _http=session)
+
+                    self._storage = self._timed('storage', build)
+                    self._created['storage'] += 1
+        return self._storage
+
+    def rekognition(self):
+        if self._rekognition is None:
+            with self._lock:
+                if self._rekognition is None:
+                    import boto3
+                    from botocore.config import Config
+
+                    def build():
+                        client = boto3.client(
+                            'rekognition',
+                            region_name=os.environ.get('AWS_REGION'),
+                            aws_access_key_id=os.environ.get('AWS_ACCESS_KEY_ID'),
+                            aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY'),
+                            config=Config(max_pool_connections=REKOGNITION_MAX_POOL_CONNECTIONS)
+                        )
+                        instrument_boto3_client(client, 'rekognition')
+                        return client
+
+                    self._rekognition = self._timed('rekognition', build)
+                    self._created['rekognition'] += 1
+        return self._rekognition
+
+    def firebase_app(self):
+        if self._firebase_app is None:
+            with self._lock:
+                if self._firebase_app is None:
+                    import firebase_admin
+                    from firebase_admin import credentials
+
+                    def build():
+                        try:
+                            return firebase_admin.get_app()
+                        except ValueError:
+                            cred = credentials.Certificate(SERVICE_ACCOUNT_KEY_PATH) if SERVICE_ACCOUNT_KEY_PATH \
+                                else credentials.ApplicationDefault()
+                            return firebase_admin.initialize_app(cred)
+
+                    self._firebase_app = self._timed('firebase_app', build)
+                    self._created['firebase_app'] += 1
+        return self._firebase_app
+
+    def warm_up(self):
+        # Tạo sẵn các client trong thread nền ngay sau khi khởi động (WARM_CLIENTS=1)
+        for name, factory in (('firestore', self.firestore), ('storage', self.storage),
+                              ('rekognition', self.rekognition), ('firebase_app', self.firebase_app)):
+            try:
+                factory()
+            except Exception as e:
+                print(f"[ERROR] Warm up {name} client: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'firestore_channels': len(self._firestore_pool),
+                'storage_clients': 1 if self._storage is not None else 0,
+                'storage_http_pool_size': GCS_HTTP_POOL_SIZE if self._storage is not None else 0,
+                'rekognition_clients': 1 if self._rekognition is not None else 0,
+                'rekognition_max_pool_connections': REKOGNITION_MAX_POOL_CONNECTIONS if self._rekognition is not None else 0,
+                'firebase_apps': 1 if self._firebase_app is not None else 0,
+                'created': dict(self._created),
+                'init_seconds': dict(self._init_seconds),
+            }
+
+
+registry = ClientRegistry()
+
+
+def get_firestore():
+    return registry.firestore()
+
+
+def get_storage():
+    return registry.storage()
+
+
+def get_rekognition():
+    return registry.rekognition()
+
+
+def get_firebase_auth():
+    # Khởi tạo firebase_admin ở lần dùng đầu tiên thay vì lúc import register_api
+    registry.firebase_app()
+    from firebase_admin import auth
+    return auth
@@ -2,44 +2,73 @@
 from flask import Blueprint, request, jsonify
 import os
 from google.cloud import firestore
+from class_roster import class_summary
+from clients import get_firestore
+from metrics import counted, get_document
+from rollups import daily_totals, dashboard_day, local_time, student_totals, today
+from ttl_cache import TTLCache
+from user_lookup import display_name, resolve_users
+from doc_cache import users_cache
 
 
 dashboard_api = Blueprint('dashboard_api', __name__)
 
-# Đường dẫn mới tới file service account key
-SERVICE_ACCOUNT_KEY_PATH = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS")
-FIREBASE_PROJECT_ID = os.environ.get("FIREBASE_PROJECT_ID")
+DASHBOARD_CACHE_SECONDS = int(os.environ.get('DASHBOARD_CACHE_SECONDS', 15))
+RECENT_ATTENDANCE_LIMIT = int(os.environ.get('RECENT_ATTENDANCE_LIMIT', 20))
+STUDENT_HISTORY_LIMIT = 20
+STUDENT_HISTORY_MAX_LIMIT = 100
+dashboard_cache = TTLCache(DASHBOARD_CACHE_SECONDS, max_entries=64)
 
-# Khởi tạo Firestore client (chỉ cần 1 lần ở đầu file)
-db = firestore.Client.from_service_account_json(SERVICE_ACCOUNT_KEY_PATH, project=FIREBASE_PROJECT_ID)
+def recent_attendance(db):
+    # Danh sách sự kiện gần nhất: truy vấn theo index createdAt giảm dần, giới hạn số bản ghi
+    query = db.collection('attendance').order_by('createdAt', direction=firestore.Query.DESCENDING) \
+        .limit(RECENT_ATTENDANCE_LIMIT).select(['classId', 'studentId', 'status', 'similarity', 'createdAt'])
+    events = [(doc.id, doc.to_dict()) for doc in counted(query.stream())]
+    users = resolve_users(db, [e.get('studentId') for _, e in events])
+    return [{
+        "id": doc_id,
+        "studentId": e.get('studentId'),
+        "name": display_name(users.get(e.get('studentId')), e.get('studentId')),
+        "classId": e.get('classId'),
+        "status": e.get('status'),
+        "similarity": e.get('similarity'),
+        "createdAt": e['createdAt'].isoformat() if e.get('createdAt') else None
+    } for doc_id, e in events]
+
+def build_teacher_dashboard(db):
+    day = today()
+    # Số liệu trong ngày đọc từ bộ đếm đã tổng hợp sẵn, không quét attendance
+    totals = dashboard_day(db, day)
+    present_by_class = {class_id: counts['present'] for (class_id, _), counts in daily_totals(db, day=day).items()}
+    # Danh sách lớp và sĩ số đọc từ class_directory (class_roster.py), không quét collection classes
+    classes = []
+    total_students = 0
+    for class_id, info in class_summary(db).items():
+        total_students += info['totalStudents']
+        classes.append({
+            "id": class_id,
+            "name": info['name'],
+            "code": info['code'],
+            "totalStudents": info['totalStudents'],
+            "presentToday": present_by_class.get(class_id, 0),
+        })
+    return {
+        "success": True,
+        "date": day,
+        "total_students": total_students,
+        "present_today": totals['present'],
+        "absent_today": totals['absent'],
+        "attendance_rate": round(100 * totals['present'] / totals['total'], 2) if totals['total'] else 0,
+        "classes": classes,
+        "recent_attendance": recent_attendance(db)
+    }
 
 @dashboard_api.route('/api/dashboard/teacher', methods=['GET'])
 def dashboard_teacher():
     try:
-        # Lấy danh sách lớp từ Firestore
-        classes_ref = db.collection('classes')
-        docs = classes_ref.stream()
-        classes = []
-        total_students = 0
-        for doc in docs:
-            data = doc.to_dict()
-            total_students += data.get('totalStudents', 0)
-            classes.append({
-                "id": doc.id,
-                "name": data.get("name", ""),
-                "code": data.get("code", ""),
-                "totalStudents": data.get("totalStudents", 0),
-                "presentToday": data.get("presentToday", 0),
-            })
-        # Bạn có thể bổ sung các trường khác tùy ý
-        result = {
-            "total_students": total_students,
-            "present_today": 0,  # Tùy bạn xử lý
-            "absent_today": 0,   # Tùy bạn xử lý
-            "attendance_rate": 0, # Tùy bạn xử lý
-            "classes": classes,
-            "recent_attendance": []  # Có thể lấy thêm từ Firestore nếu muốn
-        }
+        db = get_firestore()
+        # Snapshot dùng lại trong DASHBOARD_CACHE_SECONDS giây cho mọi lần tải trang
+        result, _ = dashboard_cache.get_or_load('teacher', lambda: build_teacher_dashboard(db))
         return jsonify(result)
     except Exception as e:
         import traceback
@@ -49,25 +78,26 @@ def dashboard_teacher():
 @dashboard_api.route('/api/dashboard/student', methods=['GET'])
 def dashboard_student():
     try:
+        db = get_firestore()
         # Lấy uid từ query param hoặc header (tùy frontend truyền lên)
         uid = request.args.get('uid') or request.headers.get('X-User-Id')
         if not uid:
             return jsonify({'error': 'Missing user id'}), 400
 
         # Lấy thông tin user từ Firestore
-        user_ref = db.collection('users').document(uid)
-        user_doc = user_ref.get()
-        if not user_doc.exists:
+        user_data = users_cache.get(db, uid)
+        if user_data is None:
             return jsonify({'error': 'User not found'}), 404
-        user_data = user_doc.to_dict()
 
         # Lấy danh sách lớp mà sinh viên này tham gia
         classes_ref = db.collection('classes')
-        classes_query = classes_ref.where('students', 'array_contains', uid)
-        classes_docs = classes_query.stream()
+        classes_query = classes_ref.where('students', 'array_contains', uid).select(['name', 'code'])
+        classes_docs = counted(classes_query.stream())
         classes = []
+        class_names = {}
         for doc in classes_docs:
             data = doc.to_dict()
+            class_names[doc.id] = data.get('name', '')
             classes.append({
                 'id': doc.id,
                 'name': data.get('name', ''),
@@ -75,18 +105,61 @@ def dashboard_student():
                 # Thêm trường khác nếu cần
             })
 
+        # Lịch sử điểm danh: index (studentId, createdAt desc), phân trang bằng cursor
+        try:
+            limit = min(max(int(request.args.get('limit', STUDENT_HISTORY_LIMIT)), 1), STUDENT_HISTORY_MAX_LIMIT)
+        except ValueError:
+            return jsonify({'error': 'Invalid limit'}), 400
+        history_query = db.collection('attendance').where('studentId', '==', uid) \
+            .order_by('createdAt', direction=firestore.Query.DESCENDING) \
+            .select(['classId', 'status', 'createdAt'])
+        cursor = request.args.get('start_after')
+        if cursor:
+            cursor_doc = get_document(db.collection('attendance').document(cursor))
+            # Cursor phải là bản ghi của chính sinh viên này; cùng một lỗi cho mọi trường hợp
+            # để không lộ việc id của người khác có tồn tại hay không
+            if not cursor_doc.exists or cursor_doc.get('studentId') != uid:
+                return jsonify({'error': 'Invalid cursor'}), 400
+            history_query = history_query.start_after(cursor_doc)
+        # Lấy dư một bản ghi để biết còn trang sau hay không
+        history_docs = list(counted(history_query.limit(limit + 1).stream()))
+        next_cursor = history_docs[limit - 1].id if len(history_docs) > limit else None
+        attendance_history = []
+        for doc in history_docs[:limit]:
+            record = doc.to_dict()
+            attendance_history.append({
+                'id': doc.id,
+                'date': local_time(record['createdAt']) if record.get('createdAt') else '',
+                'className': class_names.get(record.get('classId')) or record.get('classId', ''),
+                'status': record.get('status', '')
+            })
+
+        # Thống kê theo lớp từ bộ đếm tổng hợp (không đọc bản ghi attendance)
+        by_class = []
+        present_total, attendance_total = 0, 0
+        for (class_id, _), counts in student_totals(db, student_id=uid).items():
+            present_total += counts['present']
+            attendance_total += counts['total']
+            by_class.append({
+                'classId': class_id,
+                'className': class_names.get(class_id) or class_id,
+                'attendance_rate': round(100 * counts['present'] / counts['total'], 2) if counts['total'] else 0,
+                'present': counts['present'],
+                'absent': counts['absent']
+            })
+
         # Thống kê
         total_classes = len(classes)
-        attendance_rate = 0  # Có thể tính toán nếu có bảng điểm danh
+        attendance_rate = round(100 * present_total / attendance_total, 2) if attendance_total else 0
         next_class = classes[0] if classes else None  # Demo: lấy lớp đầu tiên
-        attendance_history = []  # Có thể lấy từ bảng attendance nếu có
-        by_class = []  # Có thể tổng hợp theo lớp nếu có dữ liệu
 
         data = {
+            'success': True,
             'total_classes': total_classes,
             'attendance_rate': attendance_rate,
             'next_class': next_class,
             'attendance_history': attendance_history,
+            'next_cursor': next_cursor,
             'by_class': by_class
         }
         return jsonify(data)
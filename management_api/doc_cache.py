@@ -0,0 +1,133 @@
+# management_api/doc_cache.py
+# Cache read-through cho document users/{uid} và classes/{id}: giới hạn số mục (LRU) và TTL.
+# Các handler PUT/POST/DELETE gọi invalidate_user/invalidate_class sau khi ghi.
+# Chạy nhiều instance: đặt DOC_CACHE_INVALIDATION=listener, mỗi lần xoá cache sẽ ghi một sự kiện
+# vào collection cache_invalidations và mọi instance nghe collection này (on_snapshot) để xoá theo.
+# Sửa trực tiếp trên console không đi qua handler nên chỉ hết hạn theo TTL.
+import os
+import threading
+import uuid
+from datetime import datetime, timedelta
+from clients import get_firestore
+from metrics import get_document
+from ttl_cache import TTLCache
+from user_lookup import invalidate_user as invalidate_user_name
+
+DOC_CACHE_TTL_SECONDS = int(os.environ.get('DOC_CACHE_TTL_SECONDS', 60))
+DOC_CACHE_MAX_ENTRIES = int(os.environ.get('DOC_CACHE_MAX_ENTRIES', 5000))
+# 'local': chỉ xoá trong tiến trình này; 'listener': phát và nghe sự kiện qua Firestore
+DOC_CACHE_INVALIDATION = os.environ.get('DOC_CACHE_INVALIDATION', 'local')
+INVALIDATION_COLLECTION = 'cache_invalidations'
+# Sự kiện cũ được Firestore TTL policy (trường expiresAt) tự xoá
+INVALIDATION_EVENT_TTL_HOURS = 24
+INSTANCE_ID = uuid.uuid4().hex
+
+
+class DocumentCache:
+    def __init__(self, collection, ttl_seconds, max_entries):
+        self.collection = collection
+        self._cache = TTLCache(ttl_seconds, max_entries)
+        self._on_invalidate = []
+
+    def on_invalidate(self, callback):
+        # Cache phụ thuộc (tên người dùng, ma trận embedding của lớp...) xoá theo cùng lúc
+        self._on_invalidate.append(callback)
+
+    def _load(self, db, doc_id):
+        snap = get_document(db.collection(self.collection).document(doc_id))
+        # Bọc trong tuple để cache được cả trường hợp document không tồn tại
+        return (snap.to_dict() if snap.exists else None,)
+
+    def get(self, db, doc_id):
+        # Trả về bản sao dict của document (hoặc None), caller sửa thoải mái không ảnh hưởng cache
+        invalidation_feed.ensure_started()
+        value, _ = self._cache.get_or_load(doc_id, lambda: self._load(db, doc_id))
+        return dict(value[0]) if value[0] is not None else None
+
+    def put(self, doc_id, data):
+        self._cache.put(doc_id, (dict(data) if data is not None else None,))
+
+    def invalidate(self, doc_id, publish=True):
+        self._cache.invalidate(doc_id)
+        for callback in self._on_invalidate:
+            try:
+                callback(doc_id)
+            except Exception as e:
+                print(f"[ERROR] Cache invalidation callback for {self.collection}/{doc_id}: {e}")
+        if publish:
+            invalidation_feed.publish(self.collection, doc_id)
+
+    def stats(self):
+        return self._cache.stats()
+
+
+class InvalidationFeed:
+    def __init__(self, mode, caches):
+        self.mode = mode
+        self.caches = caches
+        self._lock = threading.Lock()
+        self._watch = None
+        self.received = 0
+        self.published = 0
+
+    def ensure_started(self):
+        # Listener chỉ được mở ở lần dùng cache đầu tiên, không làm chậm khởi động
+        if self.mode != 'listener' or self._watch is not None:
+            return
+        with self._lock:
+            if self._watch is None:
+                # Lùi vài giây để không lỡ sự kiện do lệch đồng hồ giữa các instance
+                since = datetime.utcnow() - timedelta(seconds=5)
+                query = get_firestore().collection(INVALIDATION_COLLECTION).where('at', '>=', since)
+                self._watch = query.on_snapshot(self._on_snapshot)
+                print(f"[INFO] Cache invalidation listener started (instance {INSTANCE_ID[:8]})")
+
+    def _on_snapshot(self, docs, changes, read_time):
+        for change in changes:
+            if change.type.name != 'ADDED':
+                continue
+            data = change.document.to_dict()
+            cache = self.caches.get(data.get('collection'))
+            if cache is None or data.get('instance') == INSTANCE_ID:
+                continue
+            cache.invalidate(data.get('docId'), publish=False)
+            self.received += 1
+
+    def publish(self, collection, doc_id):
+        if self.mode != 'listener':
+            return
+        try:
+            get_firestore().collection(INVALIDATION_COLLECTION).add({
+                'collection': collection,
+                'docId': doc_id,
+                'instance': INSTANCE_ID,
+                'at': datetime.utcnow(),
+                'expiresAt': datetime.utcnow() + timedelta(hours=INVALIDATION_EVENT_TTL_HOURS)
+            })
+            self.published += 1
+        except Exception as e:
+            # Các instance khác vẫn hết hạn theo TTL
+            print(f"[ERROR] Publish cache invalidation {collection}/{doc_id}: {e}")
+
+
+users_cache = DocumentCache('users', DOC_CACHE_TTL_SECONDS, DOC_CACHE_MAX_ENTRIES)
+classes_cache = DocumentCache('classes', DOC_CACHE_TTL_SECONDS, DOC_CACHE_MAX_ENTRIES)
+users_cache.on_invalidate(invalidate_user_name)
+invalidation_feed = InvalidationFeed(DOC_CACHE_INVALIDATION, {'users': users_cache, 'classes': classes_cache})
+
+
+def invalidate_user(user_id):
+    users_cache.invalidate(user_id)
+
+
+def invalidate_class(class_id):
+    classes_cache.invalidate(class_id)
+
+
+def cache_stats():
+    return {
+        'users': users_cache.stats(),
+        'classes': classes_cache.stats(),
+        'invalidation': {'mode': DOC_CACHE_INVALIDATION, 'published': invalidation_feed.published,
+                         'received': invalidation_feed.received},
+    }
@@ -0,0 +1,87 @@
+# management_api/etag.py
+# ETag + GET có điều kiện (If-None-Match -> 304) cho các endpoint đọc nhiều.
+# - ETag mạnh = hash nội dung JSON trả về.
+# - Mỗi loại dữ liệu (users, classes, attendance) có một số phiên bản trong tiến trình, tăng khi
+#   handler ghi dữ liệu (qua doc_cache invalidation hoặc khi ghi attendance).
+#   ETag đã sinh được nhớ theo (URL, phiên bản): nếu phiên bản chưa đổi và client gửi đúng ETag
+#   thì trả 304 ngay, không đọc Firestore.
+# Thay đổi ngoài API (console, instance khác ở chế độ local) được nhận ra sau tối đa ETAG_MAX_STALENESS_SECONDS.
+import functools
+import hashlib
+import threading
+import time
+import os
+import uuid
+from flask import make_response, request
+from doc_cache import classes_cache, users_cache
+from ttl_cache import TTLCache
+
+ETAG_MAX_STALENESS_SECONDS = int(os.environ.get('ETAG_MAX_STALENESS_SECONDS', 30))
+ETAG_CACHE_MAX_ENTRIES = int(os.environ.get('ETAG_CACHE_MAX_ENTRIES', 128))
+_BOOT_ID = uuid.uuid4().hex[:8]
+
+
+class VersionTracker:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions = {}
+
+    def bump(self, kind, *_):
+        with self._lock:
+            self._versions[kind] = self._versions.get(kind, 0) + 1
+
+    def token(self, kinds):
+        # Gồm id tiến trình (số phiên bản chỉ có nghĩa trong tiến trình này) và mốc thời gian giới hạn độ cũ
+        with self._lock:
+            parts = '.'.join(f'{k}{self._versions.get(k, 0)}' for k in kinds)
+        return f'{_BOOT_ID}:{parts}:{int(time.time() // ETAG_MAX_STALENESS_SECONDS)}'
+
+
+versions = VersionTracker()
+users_cache.on_invalidate(functools.partial(versions.bump, 'users'))
+classes_cache.on_invalidate(functools.partial(versions.bump, 'classes'))
+etag_cache = TTLCache(ETAG_MAX_STALENESS_SECONDS, ETAG_CACHE_MAX_ENTRIES)
+_stats_lock = threading.Lock()
+_stats = {'not_modified': 0, 'not_modified_without_fetch': 0}
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def stats():
+    with _stats_lock:
+        return dict(_stats)
+
+
+def conditional(*kinds):
+    # Decorator cho view GET trả JSON; kinds là các loại dữ liệu mà response phụ thuộc
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            key = (request.full_path, versions.token(kinds))
+            cached = etag_cache.get(key)
+            if cached is not None and request.if_none_match.contains(cached[0]):
+                _count('not_modified_without_fetch')
+                return _not_modified(cached[0])
+            response = view(*args, **kwargs)
+            if getattr(response, 'status_code', None) != 200:
+                return response
+            etag = hashlib.sha1(response.get_data()).hexdigest()
+            etag_cache.put(key, (etag,))
+            response.set_etag(etag)
+            response.cache_control.no_cache = True
+            if request.if_none_match.contains(etag):
+                _count('not_modified')
+                return _not_modified(etag)
+            return response
+        return wrapper
+    return decorator
+
+
+def _not_modified(etag):
+    response = make_response('', 304)
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
@@ -0,0 +1,124 @@
+# management_api/face_cache.py
+# Cache LRU trong tiến trình cho ảnh gốc (students/{student_id}.jpg) dùng khi so khớp khuôn mặt.
+# Mỗi mục lưu kèm generation của object trên GCS để biết ảnh đã bị thay hay chưa.
+import os
+import threading
+import time
+from collections import OrderedDict
+from metrics import stage
+
+REFERENCE_CACHE_MAX_ENTRIES = int(os.environ.get('REFERENCE_CACHE_MAX_ENTRIES', 2000))
+REFERENCE_CACHE_MAX_BYTES = int(os.environ.get('REFERENCE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+# Sau khoảng thời gian này sẽ hỏi lại generation trên GCS (chỉ đọc metadata, không tải ảnh)
+REFERENCE_CACHE_REVALIDATE_SECONDS = int(os.environ.get('REFERENCE_CACHE_REVALIDATE_SECONDS', 300))
+
+
+class ReferenceFaceCache:
+    def __init__(self, max_entries, max_bytes, revalidate_seconds):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.revalidate_seconds = revalidate_seconds
+        self._lock = threading.Lock()
+        # student_id -> (generation, image_bytes, validated_at)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._revalidations = 0
+        self._evictions = 0
+        self._invalidations = 0
+
+    def get(self, student_id, generation=None):
+        # Trả về (generation, image_bytes, cần_kiểm_tra_lại) hoặc None nếu không có trong cache
+        with self._lock:
+            entry = self._entries.get(student_id)
+            if entry is None or (generation is not None and entry[0] != generation):
+                return None
+            self._entries.move_to_end(student_id)
+            stale = time.monotonic() - entry[2] > self.revalidate_seconds
+            return entry[0], entry[1], stale
+
+    def put(self, student_id, generation, image_bytes):
+        size = len(image_bytes)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(student_id, None)
+            if old is not None:
+                self._bytes -= len(old[1])
+            self._entries[student_id] = (generation, image_bytes, time.monotonic())
+            self._bytes += size
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted[1])
+                self._evictions += 1
+
+    def touch(self, student_id):
+        # Đánh dấu mục vừa được xác nhận lại là còn đúng generation
+        with self._lock:
+            entry = self._entries.get(student_id)
+            if entry is not None:
+                self._entries[student_id] = (entry[0], entry[1], time.monotonic())
+                self._revalidations += 1
+
+    def invalidate(self, student_id):
+        with self._lock:
+            old = self._entries.pop(student_id, None)
+            if old is not None:
+                self._bytes -= len(old[1])
+                self._invalidations += 1
+
+    def record_hit(self):
+        with self._lock:
+            self._hits += 1
+
+    def record_miss(self):
+        with self._lock:
+            self._misses += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': round(self._hits / lookups, 4) if lookups else 0,
+                'revalidations': self._revalidations,
+                'evictions': self._evictions,
+                'invalidations': self._invalidations,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+            }
+
+
+reference_cache = ReferenceFaceCache(
+    REFERENCE_CACHE_MAX_ENTRIES,
+    REFERENCE_CACHE_MAX_BYTES,
+    REFERENCE_CACHE_REVALIDATE_SECONDS
+)
+
+
+def load_reference_image(bucket, student_id):
+    # Lấy ảnh gốc của sinh viên, ưu tiên cache; chỉ tải lại khi generation trên GCS thay đổi
+    path = f'students/{student_id}.jpg'
+    cached = reference_cache.get(student_id)
+    if cached is not None:
+        generation, image_bytes, stale = cached
+        if not stale:
+            reference_cache.record_hit()
+            return image_bytes
+        blob = bucket.get_blob(path)
+        if blob is not None and blob.generation == generation:
+            reference_cache.touch(student_id)
+            reference_cache.record_hit()
+            return image_bytes
+        reference_cache.invalidate(student_id)
+    reference_cache.record_miss()
+    blob = bucket.blob(path)
+    with stage('gcs_reference_download'):
+        image_bytes = blob.download_as_bytes()
+    # download_as_bytes đã điền generation từ header phản hồi
+    reference_cache.put(student_id, blob.generation, image_bytes)
+    return image_bytes
@@ -0,0 +1,117 @@
+# management_api/face_index.py
+# Quản lý face collection trên Rekognition để điểm danh cả lớp từ một ảnh.
+# Mỗi sinh viên được index một lần (ExternalImageId = student_id), FaceId lưu ở users/{id}.face_id
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+REKOGNITION_COLLECTION_ID = os.environ.get('REKOGNITION_COLLECTION_ID', 'face-attendance-students')
+FACE_MATCH_THRESHOLD = float(os.environ.get('FACE_MATCH_THRESHOLD', 80))
+GROUP_SEARCH_WORKERS = int(os.environ.get('GROUP_SEARCH_WORKERS', 8))
+# Nới khung mặt ra một chút để search_faces_by_image vẫn detect được khuôn mặt trong ảnh cắt
+FACE_CROP_PADDING = 0.25
+
+_collection_ready = False
+
+
+def ensure_collection(rekognition):
+    global _collection_ready
+    if _collection_ready:
+        return
+    try:
+        rekognition.create_collection(CollectionId=REKOGNITION_COLLECTION_ID)
+        print(f"[INFO] Created Rekognition collection {REKOGNITION_COLLECTION_ID}")
+    except rekognition.exceptions.ResourceAlreadyExistsException:
+        pass
+    _collection_ready = True
+
+
+def index_student_face(rekognition, student_id, image_bytes, old_face_id=None):
+    # Index ảnh gốc của sinh viên, xoá face cũ (nếu có) để collection không giữ ảnh đã bị thay
+    ensure_collection(rekognition)
+    response = rekognition.index_faces(
+        CollectionId=REKOGNITION_COLLECTION_ID,
+        Image={'Bytes': image_bytes},
+        ExternalImageId=student_id,
+        MaxFaces=1,
+        QualityFilter='AUTO',
+        DetectionAttributes=[]
+    )
+    records = response.get('FaceRecords', [])
+    face_id = records[0]['Face']['FaceId'] if records else None
+    if old_face_id and old_face_id != face_id:
+        try:
+            rekognition.delete_faces(CollectionId=REKOGNITION_COLLECTION_ID, FaceIds=[old_face_id])
+        except Exception as e:
+            print(f"[ERROR] Delete old face {old_face_id} of {student_id}: {e}")
+    return face_id
+
+
+def largest_face_box(rekognition, image_bytes):
+    # BoundingBox của khuôn mặt lớn nhất, dùng để cắt sát mặt khi chuẩn hoá ảnh
+    faces = rekognition.detect_faces(Image={'Bytes': image_bytes}, Attributes=['DEFAULT']).get('FaceDetails', [])
+    if not faces:
+        return None
+    return max(faces, key=lambda f: f['BoundingBox']['Width'] * f['BoundingBox']['Height'])['BoundingBox']
+
+
+def crop_faces(image_bytes, face_details):
+    # Cắt từng khuôn mặt theo BoundingBox (toạ độ tỉ lệ) trả về từ detect_faces
+    image = Image.open(io.BytesIO(image_bytes))
+    image = image.convert('RGB')
+    width, height = image.size
+    crops = []
+    for face in face_details:
+        box = face['BoundingBox']
+        pad_w = box['Width'] * FACE_CROP_PADDING
+        pad_h = box['Height'] * FACE_CROP_PADDING
+        left = max(0, int((box['Left'] - pad_w) * width))
+        top = max(0, int((box['Top'] - pad_h) * height))
+        right = min(width, int((box['Left'] + box['Width'] + pad_w) * width))
+        bottom = min(height, int((box['Top'] + box['Height'] + pad_h) * height))
+        if right <= left or bottom <= top:
+            continue
+        buf = io.BytesIO()
+        image.crop((left, top, right, bottom)).save(buf, format='JPEG', quality=90)
+        crops.append(buf.getvalue())
+    return crops
+
+
+def _search_face(rekognition, face_bytes):
+    try:
+        response = rekognition.search_faces_by_image(
+            CollectionId=REKOGNITION_COLLECTION_ID,
+            Image={'Bytes': face_bytes},
+            MaxFaces=5,
+            FaceMatchThreshold=FACE_MATCH_THRESHOLD
+        )
+    except rekognition.exceptions.InvalidParameterException:
+        # Ảnh cắt không còn nhận ra khuôn mặt nào
+        return []
+    return [(m['Face'].get('ExternalImageId'), m['Similarity']) for m in response.get('FaceMatches', [])]
+
+
+def match_group_photo(rekognition, image_bytes, roster):
+    # Trả về ({student_id: similarity}, số khuôn mặt detect_faces phát hiện, số ảnh cắt đã đem đi tìm
+    # (khuôn mặt có khung nằm ngoài ảnh bị bỏ khi cắt), số ảnh cắt không khớp ai trong lớp)
+    ensure_collection(rekognition)
+    roster = set(roster)
+    detected = rekognition.detect_faces(Image={'Bytes': image_bytes}, Attributes=['DEFAULT'])
+    face_details = detected.get('FaceDetails', [])
+    crops = crop_faces(image_bytes, face_details) if face_details else []
+    matched = {}
+    unmatched = 0
+    if crops:
+        with ThreadPoolExecutor(max_workers=min(GROUP_SEARCH_WORKERS, len(crops))) as pool:
+            results = list(pool.map(lambda c: _search_face(rekognition, c), crops))
+        for matches in results:
+            # Mỗi khuôn mặt chỉ gán cho sinh viên khớp nhất thuộc lớp này
+            best = next(((sid, sim) for sid, sim in matches if sid in roster), None)
+            if best is None:
+                unmatched += 1
+                continue
+            sid, sim = best
+            if sim > matched.get(sid, 0):
+                matched[sid] = sim
+    return matched, len(face_details), len(crops), unmatched
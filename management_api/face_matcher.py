@@ -0,0 +1,181 @@
+# management_api/face_matcher.py
+# Bộ so khớp khuôn mặt có thể thay thế, chọn bằng biến môi trường FACE_MATCHER:
+# - 'rekognition': gọi compare_faces của AWS Rekognition (mặc định, như trước)
+# - 'local': tính embedding trên CPU một lần lúc đăng ký ảnh, so khớp bằng cosine trên ma trận của cả lớp
+# Mọi backend đều trả về (recognized, similarity) với similarity theo thang 0-100.
+import io
+import os
+import threading
+import time
+import numpy as np
+from face_index import FACE_MATCH_THRESHOLD, index_student_face
+from metrics import counted, get_document
+from ttl_cache import TTLCache
+
+FACE_MATCHER = os.environ.get('FACE_MATCHER', 'rekognition')
+# Ngưỡng riêng cho backend local (cosine * 100), embedding CPU cho điểm cao hơn Rekognition
+LOCAL_MATCH_THRESHOLD = float(os.environ.get('LOCAL_MATCH_THRESHOLD', 92))
+LOCAL_MATRIX_TTL_SECONDS = int(os.environ.get('LOCAL_MATRIX_TTL_SECONDS', 300))
+FIRESTORE_GET_ALL_CHUNK = 300
+LOCAL_MATRIX_MAX_CLASSES = 512
+# Sinh viên chưa có embedding chỉ được đưa vào hàng đợi lại sau khoảng này (job trước có thể đã bỏ cuộc)
+LOCAL_ENROLL_REQUEUE_SECONDS = 3600
+
+
+class NoFaceError(Exception):
+    pass
+
+
+class RekognitionMatcher:
+    name = 'rekognition'
+
+    def __init__(self, rekognition, reference_loader, threshold=FACE_MATCH_THRESHOLD, **_):
+        # rekognition là hàm trả về client (lấy từ registry khi cần)
+        self._rekognition = rekognition
+        self.reference_loader = reference_loader
+        self.threshold = threshold
+
+    @property
+    def rekognition(self):
+        return self._rekognition()
+
+    def verify(self, student_id, class_id, image_bytes):
+        response = self.rekognition.compare_faces(
+            SourceImage={'Bytes': self.reference_loader(student_id)},
+            TargetImage={'Bytes': image_bytes},
+            SimilarityThreshold=self.threshold
+        )
+        recognized = False
+        similarity = 0
+        if response['FaceMatches']:
+            recognized = True
+            similarity = response['FaceMatches'][0]['Similarity']
+        return recognized, similarity
+
+    def enroll(self, student_id, image_bytes, user_data):
+        # Index vào face collection (dùng cho điểm danh cả lớp), trả về các trường cần lưu vào users
+        face_id = index_student_face(self.rekognition, student_id, image_bytes, (user_data or {}).get('face_id'))
+        return {'face_id': face_id} if face_id else {}
+
+
+def face_recognition_embedder(image_bytes):
+    # Embedding 128 chiều của dlib qua thư viện face_recognition (phụ thuộc tuỳ chọn, chỉ cần khi FACE_MATCHER=local)
+    import face_recognition
+    image = face_recognition.load_image_file(io.BytesIO(image_bytes))
+    locations = face_recognition.face_locations(image)
+    if not locations:
+        raise NoFaceError('No face detected')
+    # Lấy khuôn mặt lớn nhất trong ảnh
+    largest = max(locations, key=lambda box: (box[2] - box[0]) * (box[1] - box[3]))
+    return np.asarray(face_recognition.face_encodings(image, [largest])[0], dtype=np.float32)
+
+
+class LocalEmbeddingMatcher:
+    name = 'local-embedding'
+
+    def __init__(self, db, reference_loader, embedder=face_recognition_embedder, threshold=LOCAL_MATCH_THRESHOLD,
+                 enroll_later=None, **_):
+        # db là hàm trả về Firestore client (lấy từ registry khi cần);
+        # enroll_later(student_id): đưa việc đăng ký khuôn mặt vào hàng đợi job (có thử lại)
+        self._db = db
+        self.reference_loader = reference_loader
+        self.enroll_later = enroll_later
+        self.embedder = embedder
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        # class_id -> (student_ids, ma trận embedding đã chuẩn hoá L2); get_or_load chỉ cho một luồng dựng ma trận
+        self._matrices = TTLCache(LOCAL_MATRIX_TTL_SECONDS, LOCAL_MATRIX_MAX_CLASSES)
+        # student_id -> thời điểm đã đưa job face_enroll vào hàng đợi
+        self._enroll_queued = {}
+
+    @property
+    def db(self):
+        return self._db()
+
+    @staticmethod
+    def _normalize(vectors):
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def enroll(self, student_id, image_bytes, user_data):
+        embedding = self.embedder(image_bytes)
+        self.invalidate_student(student_id)
+        return {'face_embedding': [float(x) for x in embedding]}
+
+    def invalidate_student(self, student_id):
+        # Embedding vừa ghi: sinh viên có thể thuộc nhiều lớp, dựng lại toàn bộ (ít khi xảy ra)
+        with self._lock:
+            self._enroll_queued.pop(student_id, None)
+        self._matrices.invalidate()
+
+    def invalidate_class(self, class_id):
+        self._matrices.invalidate(class_id)
+
+    def _queue_enrollment(self, student_ids):
+        # Sinh viên đăng ký trước khi có backend local: tính embedding trong job face_enroll,
+        # không chạy trên luồng điểm danh
+        now = time.monotonic()
+        with self._lock:
+            due = [sid for sid in student_ids
+                   if now - self._enroll_queued.get(sid, -LOCAL_ENROLL_REQUEUE_SECONDS) >= LOCAL_ENROLL_REQUEUE_SECONDS]
+            for sid in due:
+                self._enroll_queued[sid] = now
+        for sid in due:
+            try:
+                self.enroll_later(sid)
+            except Exception as e:
+                print(f"[ERROR] Queue local embedding for {sid}: {e}")
+
+    def _build_matrix(self, class_id):
+        db = self.db
+        class_doc = get_document(db.collection('classes').document(class_id))
+        roster = list(dict.fromkeys(class_doc.to_dict().get('students', []))) if class_doc.exists else []
+        users_ref = db.collection('users')
+        embeddings = {}
+        missing = []
+        for i in range(0, len(roster), FIRESTORE_GET_ALL_CHUNK):
+            refs = [users_ref.document(sid) for sid in roster[i:i + FIRESTORE_GET_ALL_CHUNK]]
+            for snap in counted(db.get_all(refs, field_paths=['face_embedding'])):
+                vector = (snap.to_dict() or {}).get('face_embedding') if snap.exists else None
+                if vector:
+                    embeddings[snap.id] = np.asarray(vector, dtype=np.float32)
+                elif snap.exists:
+                    missing.append(snap.id)
+        # Chưa có embedding: bỏ qua khỏi ma trận cho tới khi job đăng ký xong (invalidate_student dựng lại)
+        if missing and self.enroll_later:
+            self._queue_enrollment(missing)
+        ids = [sid for sid in roster if sid in embeddings]
+        matrix = self._normalize(np.stack([embeddings[sid] for sid in ids])) if ids else np.zeros((0, 128), dtype=np.float32)
+        return ids, matrix
+
+    def class_matrix(self, class_id):
+        # Nhiều lượt điểm danh cùng lúc của một lớp chờ chung một lần dựng ma trận
+        (ids, matrix), _ = self._matrices.get_or_load(class_id, lambda: self._build_matrix(class_id))
+        return ids, matrix
+
+    def verify(self, student_id, class_id, image_bytes):
+        ids, matrix = self.class_matrix(class_id)
+        if student_id not in ids:
+            return False, 0
+        try:
+            probe = self._normalize(self.embedder(image_bytes))
+        except NoFaceError:
+            return False, 0
+        # Một phép nhân ma trận cho cả lớp; chỉ công nhận khi sinh viên là người giống nhất và vượt ngưỡng
+        scores = matrix @ probe
+        best = int(np.argmax(scores))
+        similarity = round(float(max(scores[ids.index(student_id)], 0)) * 100, 2)
+        recognized = ids[best] == student_id and similarity >= self.threshold
+        return recognized, similarity
+
+
+MATCHERS = {
+    'rekognition': RekognitionMatcher,
+    'local': LocalEmbeddingMatcher,
+}
+
+
+def create_matcher(name, **deps):
+    if name not in MATCHERS:
+        raise ValueError(f'Unknown FACE_MATCHER {name}, expected one of {sorted(MATCHERS)}')
+    return MATCHERS[name](**deps)
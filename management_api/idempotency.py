@@ -0,0 +1,153 @@
+# management_api/idempotency.py
+# Chống gửi trùng điểm danh (bấm hai lần, mạng di động tự gửi lại).
+# Mỗi lần điểm danh có một idempotency key; request trùng key nhận lại kết quả đã lưu
+# mà không chạy lại so khớp khuôn mặt và không ghi thêm bản ghi attendance.
+import hashlib
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from metrics import get_document
+
+IDEMPOTENCY_BACKEND = os.environ.get('IDEMPOTENCY_BACKEND', 'memory')
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', 900))
+IDEMPOTENCY_MAX_KEYS = int(os.environ.get('IDEMPOTENCY_MAX_KEYS', 50000))
+# Khi client không gửi key: các ảnh giống hệt nhau trong cùng một cửa sổ thời gian được coi là một lần điểm danh
+ATTENDANCE_SESSION_WINDOW_SECONDS = int(os.environ.get('ATTENDANCE_SESSION_WINDOW_SECONDS', 900))
+# Request trùng đến khi request đầu còn đang chạy sẽ chờ tối đa chừng này giây,
+# quá thời gian thì trả 409 kèm Retry-After thay vì chạy lại
+IDEMPOTENCY_WAIT_SECONDS = 30
+IDEMPOTENCY_RETRY_AFTER_SECONDS = 5
+
+
+def _hash_key(raw):
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def attendance_idempotency_keys(client_key, student_id, class_id, image_bytes):
+    # Trả về list key: key đầu dùng để lưu kết quả, mọi key đều được dùng để tìm request trùng.
+    # Key tự sinh theo cửa sổ thời gian: kiểm tra cả cửa sổ hiện tại và cửa sổ trước để hai lần gửi
+    # nằm hai bên ranh giới cửa sổ vẫn được nhận ra là một.
+    if client_key:
+        return [_hash_key(f'client|{student_id}|{client_key}')]
+    window = int(time.time() // ATTENDANCE_SESSION_WINDOW_SECONDS)
+    image_hash = hashlib.sha256(image_bytes).hexdigest()
+    return [_hash_key(f'derived|{student_id}|{class_id}|{w}|{image_hash}') for w in (window, window - 1)]
+
+
+class MemoryBackend:
+    def __init__(self, ttl_seconds, max_keys):
+        self.ttl_seconds = ttl_seconds
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        # key -> (expires_at, result); dict giữ thứ tự chèn nên mục cũ nhất nằm đầu
+        self._results = {}
+
+    def get(self, key):
+        with self._lock:
+            entry = self._results.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._results[key]
+                return None
+            return entry[1]
+
+    def put(self, key, result):
+        with self._lock:
+            self._results.pop(key, None)
+            self._results[key] = (time.monotonic() + self.ttl_seconds, result)
+            while len(self._results) > self.max_keys:
+                del self._results[next(iter(self._results))]
+
+
+class FirestoreBackend:
+    # Dùng chung giữa nhiều instance Cloud Run. Bật TTL policy của Firestore trên trường expiresAt
+    # cho collection idempotency_keys để tài liệu hết hạn tự bị xoá.
+    def __init__(self, db, ttl_seconds, collection='idempotency_keys'):
+        # db là hàm trả về Firestore client, gọi khi cần
+        self.db = db
+        self.ttl_seconds = ttl_seconds
+        self.collection = collection
+        self._local = MemoryBackend(ttl_seconds, IDEMPOTENCY_MAX_KEYS)
+
+    def get(self, key):
+        result = self._local.get(key)
+        if result is not None:
+            return result
+        snap = get_document(self.db().collection(self.collection).document(key))
+        if not snap.exists:
+            return None
+        data = snap.to_dict()
+        expires_at = data.get('expiresAt')
+        if expires_at is not None and expires_at.timestamp() < time.time():
+            return None
+        result = (data.get('status_code', 200), data.get('body'))
+        self._local.put(key, result)
+        return result
+
+    def put(self, key, result):
+        self._local.put(key, result)
+        self.db().collection(self.collection).document(key).set({
+            'status_code': result[0],
+            'body': result[1],
+            'expiresAt': datetime.utcnow() + timedelta(seconds=self.ttl_seconds)
+        })
+
+
+class IdempotencyStore:
+    def __init__(self, backend):
+        self.backend = backend
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self.replays = 0
+
+    def _cached(self, keys):
+        for key in keys:
+            cached = self.backend.get(key)
+            if cached is not None:
+                with self._lock:
+                    self.replays += 1
+                return cached
+        return None
+
+    def run_once(self, keys, fn):
+        # fn() -> (status_code, body). Chỉ kết quả thành công (2xx) mới được lưu để lần gửi lại còn chạy được.
+        # keys: một key hoặc list key (key đầu để lưu kết quả). Trả về (status_code, body, replayed)
+        if isinstance(keys, str):
+            keys = [keys]
+        key = keys[0]
+        while True:
+            cached = self._cached(keys)
+            if cached is not None:
+                return cached[0], cached[1], True
+            with self._lock:
+                event = next((self._inflight[k] for k in keys if k in self._inflight), None)
+                if event is None:
+                    event = threading.Event()
+                    self._inflight[key] = event
+                    break
+            # Request đầu tiên cùng key đang chạy: chờ nó xong rồi đọc kết quả
+            if not event.wait(IDEMPOTENCY_WAIT_SECONDS):
+                # Không chạy lại (sẽ ghi trùng); client thử lại sau khi request đầu xong
+                return 409, {'error': 'Attendance still processing',
+                             'retry_after': IDEMPOTENCY_RETRY_AFTER_SECONDS}, False
+            cached = self._cached(keys)
+            if cached is not None:
+                return cached[0], cached[1], True
+            # Request đầu bị lỗi, kết quả không được lưu: quay lại vòng lặp để tự chạy
+        try:
+            status_code, body = fn()
+            if 200 <= status_code < 300:
+                self.backend.put(key, (status_code, body))
+            return status_code, body, False
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            event.set()
+
+
+def create_store(db=None):
+    if IDEMPOTENCY_BACKEND == 'firestore':
+        return IdempotencyStore(FirestoreBackend(db, IDEMPOTENCY_TTL_SECONDS))
+    return IdempotencyStore(MemoryBackend(IDEMPOTENCY_TTL_SECONDS, IDEMPOTENCY_MAX_KEYS))
@@ -0,0 +1,115 @@
+# management_api/image_utils.py
+# Chuẩn hoá ảnh trước khi lưu GCS / gửi đi so khớp: xoay theo EXIF, thu nhỏ, nén lại JPEG,
+# có thể cắt sát khuôn mặt. Dùng chung cho ảnh điểm danh và ảnh gốc của sinh viên.
+import base64
+import io
+import os
+import re
+import threading
+from PIL import Image, ImageOps
+
+IMAGE_MAX_DIMENSION = int(os.environ.get('IMAGE_MAX_DIMENSION', 1280))
+# Ảnh chụp cả lớp cần giữ độ phân giải cao hơn để khuôn mặt nhỏ vẫn nhận ra được
+IMAGE_GROUP_MAX_DIMENSION = int(os.environ.get('IMAGE_GROUP_MAX_DIMENSION', 2560))
+IMAGE_JPEG_QUALITY = int(os.environ.get('IMAGE_JPEG_QUALITY', 85))
+IMAGE_CROP_TO_FACE = os.environ.get('IMAGE_CROP_TO_FACE', '0') == '1'
+FACE_CROP_MARGIN = 0.4
+
+_stats_lock = threading.Lock()
+_stats = {'images': 0, 'bytes_in': 0, 'bytes_out': 0, 'failures': 0}
+
+
+def decode_base64_image(image_base64):
+    # Bỏ tiền tố data:image/...;base64, nếu có
+    base64_str = re.sub('^data:image/.+;base64,', '', image_base64.strip())
+    return base64.b64decode(base64_str.encode('ascii'))
+
+
+def is_truthy(value):
+    return str(value).lower() in ('1', 'true', 'yes')
+
+
+def read_image_request(req, base64_field, file_field='image'):
+    # Đọc ảnh từ request theo một trong ba dạng, trả về (các trường khác, bytes ảnh gốc hoặc None):
+    # - multipart/form-data: file ở trường `file_field`, các trường khác trong form
+    # - body nhị phân image/* hoặc application/octet-stream: các trường nằm trên query string
+    # - JSON: ảnh base64 ở trường `base64_field` (dạng cũ, giữ để tương thích)
+    content_type = (req.mimetype or '').lower()
+    if content_type == 'multipart/form-data':
+        fields = req.form.to_dict()
+        upload = req.files.get(file_field)
+        if upload is None:
+            image_b64 = fields.pop(base64_field, None)
+            return fields, decode_base64_image(image_b64) if image_b64 else None
+        return fields, upload.stream.read() or None
+    if content_type.startswith('image/') or content_type == 'application/octet-stream':
+        # Đọc thẳng từ stream, không để werkzeug giữ thêm một bản body trong request
+        return req.args.to_dict(), req.stream.read() or None
+    data = req.get_json(silent=True) or {}
+    fields = {k: v for k, v in data.items() if k != base64_field}
+    image_b64 = data.get(base64_field)
+    return fields, decode_base64_image(image_b64) if image_b64 else None
+
+
+def _encode_jpeg(image, quality):
+    buf = io.BytesIO()
+    image.save(buf, format='JPEG', quality=quality, optimize=True)
+    return buf.getvalue()
+
+
+def _crop_to_box(image, box):
+    # box là BoundingBox tỉ lệ (Left, Top, Width, Height) như Rekognition trả về
+    width, height = image.size
+    margin_w = box['Width'] * FACE_CROP_MARGIN
+    margin_h = box['Height'] * FACE_CROP_MARGIN
+    left = max(0, int((box['Left'] - margin_w) * width))
+    top = max(0, int((box['Top'] - margin_h) * height))
+    right = min(width, int((box['Left'] + box['Width'] + margin_w) * width))
+    bottom = min(height, int((box['Top'] + box['Height'] + margin_h) * height))
+    if right <= left or bottom <= top:
+        return image
+    return image.crop((left, top, right, bottom))
+
+
+def normalize_image(image_bytes, label='image', max_dimension=IMAGE_MAX_DIMENSION, quality=IMAGE_JPEG_QUALITY,
+                    crop_to_face=IMAGE_CROP_TO_FACE, face_locator=None):
+    # face_locator(jpeg_bytes) -> BoundingBox hoặc None, chỉ dùng khi crop_to_face bật
+    try:
+        image = Image.open(io.BytesIO(image_bytes))
+        original_size = image.size
+        orientation = image.getexif().get(0x0112)
+        image = ImageOps.exif_transpose(image)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+        changed = image.size != original_size or orientation not in (None, 1)
+        output = _encode_jpeg(image, quality)
+        if crop_to_face and face_locator is not None:
+            box = face_locator(output)
+            if box:
+                image = _crop_to_box(image, box)
+                output = _encode_jpeg(image, quality)
+                changed = True
+    except Exception as e:
+        # Định dạng lạ hoặc ảnh hỏng: giữ nguyên bytes gốc, để bước sau tự báo lỗi
+        with _stats_lock:
+            _stats['failures'] += 1
+        print(f"[ERROR] Normalize {label} failed, keeping original ({len(image_bytes)} bytes): {e}")
+        return image_bytes
+    # Ảnh đã nhỏ và nén sẵn thì bản re-encode có thể lớn hơn, khi đó giữ nguyên bản gốc
+    if not changed and len(output) >= len(image_bytes):
+        output = image_bytes
+    saved = len(image_bytes) - len(output)
+    with _stats_lock:
+        _stats['images'] += 1
+        _stats['bytes_in'] += len(image_bytes)
+        _stats['bytes_out'] += len(output)
+    print(f"[INFO] Normalized {label}: {len(image_bytes)} -> {len(output)} bytes (saved {saved}), size={image.size}")
+    return output
+
+
+def image_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+    stats['bytes_saved'] = stats['bytes_in'] - stats['bytes_out']
+    return stats
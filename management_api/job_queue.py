@@ -0,0 +1,292 @@
+# management_api/job_queue.py
+# Hàng đợi job nền: request chỉ đẩy job vào broker rồi trả job_id ngay,
+# một pool worker lấy job ra xử lý và ghi lại trạng thái để client hỏi sau.
+# Broker có thể thay thế: 'memory' (một tiến trình) hoặc 'sqlite' (nhiều worker gunicorn trên cùng máy).
+# Payload ghi xuống SQLite dạng JSON (bytes -> base64, datetime -> ISO), không dùng pickle để file DB
+# không thành đường chạy code tuỳ ý.
+import base64
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+
+JOB_BROKER = os.environ.get('JOB_BROKER', 'memory')
+# Mặc định nằm trong thư mục riêng của ứng dụng (quyền 0700), không dùng /tmp ai cũng ghi được
+JOB_BROKER_SQLITE_PATH = os.environ.get('JOB_BROKER_SQLITE_PATH') or \
+    os.path.join(os.path.expanduser('~'), '.attendance', 'jobs.sqlite3')
+# Job đã xong được giữ lại bao lâu để client còn hỏi được trạng thái
+JOB_RESULT_TTL_SECONDS = int(os.environ.get('JOB_RESULT_TTL_SECONDS', 3600))
+# SQLite: job 'running' quá hạn này (worker chết giữa chừng) được đưa lại vào hàng đợi khi claim
+JOB_LEASE_SECONDS = int(os.environ.get('JOB_LEASE_SECONDS', 900))
+# Job đăng ký với retries > 0: lần thử thứ n chờ JOB_RETRY_DELAY_SECONDS * 2^(n-1) giây
+JOB_RETRY_DELAY_SECONDS = float(os.environ.get('JOB_RETRY_DELAY_SECONDS', 30))
+
+
+def _encode_value(value):
+    if isinstance(value, (bytes, bytearray)):
+        return {'__bytes__': base64.b64encode(value).decode('ascii')}
+    if isinstance(value, datetime):
+        return {'__datetime__': value.isoformat()}
+    raise TypeError(f'Job payload value of type {type(value).__name__} is not serializable')
+
+
+def _decode_value(obj):
+    if '__bytes__' in obj:
+        return base64.b64decode(obj['__bytes__'])
+    if '__datetime__' in obj:
+        return datetime.fromisoformat(obj['__datetime__'])
+    return obj
+
+
+def encode_payload(payload):
+    return json.dumps(payload, default=_encode_value)
+
+
+def decode_payload(raw):
+    return json.loads(raw, object_hook=_decode_value)
+
+
+class InMemoryBroker:
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def put(self, job_id, kind, payload):
+        now = time.time()
+        with self._lock:
+            self._jobs[job_id] = {'job_id': job_id, 'kind': kind, 'status': 'queued', 'result': None,
+                                  'error': None, 'created_at': now, 'updated_at': now}
+        self._queue.put((job_id, kind, payload))
+
+    def claim(self, timeout):
+        try:
+            job_id, kind, payload = self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        self.set_status(job_id, 'running')
+        return job_id, kind, payload
+
+    def retry(self, job_id, kind, payload, delay, error=None):
+        self.set_status(job_id, 'queued', error=error)
+        timer = threading.Timer(delay, self._queue.put, ((job_id, kind, payload),))
+        timer.daemon = True
+        timer.start()
+
+    def set_status(self, job_id, status, result=None, error=None):
+        now = time.time()
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            job.update({'status': status, 'result': result, 'error': error, 'updated_at': now})
+            # Dọn các job đã xong quá hạn
+            expired = [jid for jid, j in self._jobs.items()
+                       if j['status'] in ('done', 'failed') and now - j['updated_at'] > JOB_RESULT_TTL_SECONDS]
+            for jid in expired:
+                del self._jobs[jid]
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+
+class SQLiteBroker:
+    def __init__(self, path=JOB_BROKER_SQLITE_PATH, poll_interval=0.2):
+        self.path = path
+        self.poll_interval = poll_interval
+        self._local = threading.local()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        # Chỉ tiến trình ứng dụng được đọc/ghi hàng đợi
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        os.close(fd)
+        os.chmod(path, 0o600)
+        with self._connect() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                ' job_id TEXT PRIMARY KEY, kind TEXT NOT NULL, payload TEXT, status TEXT NOT NULL,'
+                ' result TEXT, error TEXT, created_at REAL NOT NULL, updated_at REAL NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created_at)')
+            # DB tạo trước khi có lease
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(jobs)')}
+            if 'claimed_at' not in columns:
+                conn.execute('ALTER TABLE jobs ADD COLUMN claimed_at REAL')
+            if 'available_at' not in columns:
+                conn.execute('ALTER TABLE jobs ADD COLUMN available_at REAL')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def put(self, job_id, kind, payload):
+        now = time.time()
+        self._connect().execute(
+            'INSERT INTO jobs (job_id, kind, payload, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)',
+            (job_id, kind, encode_payload(payload), 'queued', now, now)
+        )
+
+    def claim(self, timeout):
+        deadline = time.monotonic() + timeout
+        conn = self._connect()
+        while True:
+            # BEGIN IMMEDIATE giữ khoá ghi để hai worker không lấy trùng một job
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                now = time.time()
+                # Lease hết hạn: worker giữ job đã chết, trả job về hàng đợi (payload vẫn còn trong DB)
+                requeued = conn.execute(
+                    "UPDATE jobs SET status = 'queued', claimed_at = NULL, updated_at = ?"
+                    " WHERE status = 'running' AND claimed_at < ?",
+                    (now, now - JOB_LEASE_SECONDS)
+                ).rowcount
+                if requeued:
+                    print(f"[INFO] Requeued {requeued} jobs with expired lease")
+                row = conn.execute(
+                    "SELECT job_id, kind, payload FROM jobs WHERE status = 'queued'"
+                    " AND (available_at IS NULL OR available_at <= ?) ORDER BY created_at LIMIT 1",
+                    (now,)
+                ).fetchone()
+                if row:
+                    conn.execute("UPDATE jobs SET status = 'running', claimed_at = ?, updated_at = ? WHERE job_id = ?",
+                                 (now, now, row[0]))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            if row:
+                try:
+                    return row[0], row[1], decode_payload(row[2])
+                except (TypeError, ValueError) as e:
+                    # Payload không phải JSON hợp lệ (vd. bản ghi cũ): đánh dấu lỗi, không giải mã
+                    self.set_status(row[0], 'failed', error=f'Invalid job payload: {e}')
+                    continue
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(self.poll_interval)
+
+    def retry(self, job_id, kind, payload, delay, error=None):
+        now = time.time()
+        self._connect().execute(
+            "UPDATE jobs SET status = 'queued', payload = ?, error = ?, claimed_at = NULL, available_at = ?,"
+            " updated_at = ? WHERE job_id = ?",
+            (encode_payload(payload), error, now + delay, now, job_id)
+        )
+
+    def set_status(self, job_id, status, result=None, error=None):
+        now = time.time()
+        conn = self._connect()
+        # Payload chỉ xoá khi job kết thúc: job 'running' cần giữ lại để chạy lại nếu lease hết hạn
+        conn.execute('UPDATE jobs SET status = ?, result = ?, error = ?, updated_at = ?,'
+                     " payload = CASE WHEN ? IN ('done', 'failed') THEN NULL ELSE payload END WHERE job_id = ?",
+                     (status, json.dumps(result, default=str) if result is not None else None, error, now,
+                      status, job_id))
+        conn.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?",
+                     (now - JOB_RESULT_TTL_SECONDS,))
+
+    def get(self, job_id):
+        row = self._connect().execute(
+            'SELECT job_id, kind, status, result, error, created_at, updated_at FROM jobs WHERE job_id = ?',
+            (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {'job_id': row[0], 'kind': row[1], 'status': row[2],
+                'result': json.loads(row[3]) if row[3] else None, 'error': row[4],
+                'created_at': row[5], 'updated_at': row[6]}
+
+
+BROKERS = {
+    'memory': InMemoryBroker,
+    'sqlite': SQLiteBroker,
+}
+
+
+def register_broker(name, factory):
+    # Cho phép cắm broker khác (Cloud Tasks, Pub/Sub, Redis...) mà không sửa JobQueue
+    BROKERS[name] = factory
+
+
+class JobQueue:
+    def __init__(self, broker_name, workers):
+        self.broker_name = broker_name
+        self.workers = workers
+        self._broker = None
+        self._handlers = {}
+        self._retries = {}
+        self._threads = []
+        self._lock = threading.Lock()
+
+    @property
+    def broker(self):
+        if self._broker is None:
+            with self._lock:
+                if self._broker is None:
+                    self._broker = BROKERS[self.broker_name]()
+        return self._broker
+
+    def register(self, kind, handler, retries=0):
+        # retries: số lần chạy lại khi handler lỗi (broker cần có retry(); cách nhau theo JOB_RETRY_DELAY_SECONDS)
+        self._handlers[kind] = handler
+        self._retries[kind] = retries
+
+    def _ensure_workers(self):
+        # Worker chỉ khởi động khi có job đầu tiên, tránh tạo thread lúc import
+        if self._threads:
+            return
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                t = threading.Thread(target=self._run, name=f'job-worker-{i}', daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def submit(self, kind, payload):
+        if kind not in self._handlers:
+            raise ValueError(f'No handler registered for job kind {kind}')
+        job_id = uuid.uuid4().hex
+        self.broker.put(job_id, kind, payload)
+        self._ensure_workers()
+        return job_id
+
+    def status(self, job_id):
+        return self.broker.get(job_id)
+
+    def _run(self):
+        while True:
+            try:
+                claimed = self.broker.claim(timeout=1.0)
+            except Exception as e:
+                print(f"[ERROR] Job broker claim error: {e}")
+                time.sleep(1.0)
+                continue
+            if claimed is None:
+                continue
+            job_id, kind, payload = claimed
+            try:
+                result = self._handlers[kind](payload)
+                self.broker.set_status(job_id, 'done', result=result)
+            except Exception as e:
+                # Số lần đã thử nằm trong payload để broker nào cũng giữ được qua các lần chạy lại
+                attempt = payload.get('_attempt', 1) if isinstance(payload, dict) else 1
+                if attempt <= self._retries.get(kind, 0) and hasattr(self.broker, 'retry'):
+                    delay = JOB_RETRY_DELAY_SECONDS * 2 ** (attempt - 1)
+                    print(f"[ERROR] Job {job_id} ({kind}) attempt {attempt} failed, retry in {delay:.0f}s: {e}")
+                    self.broker.retry(job_id, kind, dict(payload, _attempt=attempt + 1), delay, error=str(e))
+                    continue
+                print(f"[ERROR] Job {job_id} ({kind}) failed: {e}")
+                self.broker.set_status(job_id, 'failed', error=str(e))
+
+
+job_queue = JobQueue(JOB_BROKER, int(os.environ.get('JOB_WORKERS', 4)))
@@ -1,17 +1,45 @@
 from flask import Blueprint, request, jsonify
 from flask_cors import CORS
-from google.cloud import firestore
 from werkzeug.security import check_password_hash
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+import os
+import threading
+from clients import get_firestore
+from user_emails import credential_cache
 
 
 login_api = Blueprint('login_api', __name__)
 CORS(login_api)
 
-db = firestore.Client(project="face-attendance-463704")
+# Kiểm tra password hash tốn CPU: chạy trên pool riêng có giới hạn để các endpoint khác không bị nghẽn.
+# Hàng đợi đầy thì trả 503 cho client thử lại thay vì dồn thêm việc.
+LOGIN_HASH_WORKERS = int(os.environ.get('LOGIN_HASH_WORKERS', 2))
+LOGIN_HASH_QUEUE_MAX = int(os.environ.get('LOGIN_HASH_QUEUE_MAX', 64))
+LOGIN_HASH_TIMEOUT_SECONDS = float(os.environ.get('LOGIN_HASH_TIMEOUT_SECONDS', 10))
+hash_executor = ThreadPoolExecutor(max_workers=LOGIN_HASH_WORKERS, thread_name_prefix='login-hash')
+hash_slots = threading.BoundedSemaphore(LOGIN_HASH_WORKERS + LOGIN_HASH_QUEUE_MAX)
+
+
+def verify_password(password_hash, password):
+    # Trả về True/False, hoặc None nếu pool đang quá tải
+    if not hash_slots.acquire(blocking=False):
+        return None
+    try:
+        future = hash_executor.submit(check_password_hash, password_hash, password)
+    except Exception:
+        hash_slots.release()
+        raise
+    future.add_done_callback(lambda _: hash_slots.release())
+    try:
+        return future.result(timeout=LOGIN_HASH_TIMEOUT_SECONDS)
+    except TimeoutError:
+        return None
+
 
 # Đăng nhập
 @login_api.route('/api/login', methods=['POST'])
 def login():
+    db = get_firestore()
     data = request.get_json()
     email = data.get('email')
     password = data.get('password')
@@ -19,15 +47,20 @@ def login():
     if not email or not password:
         return jsonify({'error': 'Missing email or password'}), 400
 
-    users_ref = db.collection('users')
-    user_docs = users_ref.where('email', '==', email).get()
-    if not user_docs:
+    # Tra email qua chỉ mục user_emails + cache ngắn hạn thay vì truy vấn users mỗi lần
+    uid, user = credential_cache.get(db, email)
+    if user is None:
         return jsonify({'error': 'Email not found'}), 404
 
-    user = user_docs[0].to_dict()
-    if not check_password_hash(user['password'], password):
+    verified = verify_password(user.get('password', ''), password)
+    if verified is None:
+        response = jsonify({'error': 'Login is busy, please retry'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '1'
+        return response
+    if not verified:
         return jsonify({'error': 'Incorrect password'}), 401
 
     # Trả về thông tin user (bạn có thể loại bỏ password trước khi trả về)
     user.pop('password', None)
-    return jsonify({'success': True, 'user': user})
\ No newline at end of file
+    return jsonify({'success': True, 'user': user})
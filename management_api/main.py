@@ -1,51 +1,68 @@
 import os
+import threading
 from dotenv import load_dotenv
-from google.cloud import firestore
 
+# Nạp .env trước mọi import đọc biến môi trường lúc import (startup.py đọc STARTUP_WARN_SECONDS)
 load_dotenv()
 
-from flask import Flask
-from flask_cors import CORS
-from report_api import report_api
-from profile_api import profile_api
-from dashboard_api import dashboard_api
-from class_api import class_api
-from students_api import students_api
-from register_api import register_api
-from login_api import login_api
-from attendance_api import attendance_api
-from teachers_api import teachers_api
+from startup import startup_report
+
+with startup_report.phase('import flask'):
+    from flask import Flask, Response
+    from flask_cors import CORS
+from auth_middleware import auth_stats, init_auth
+from clients import get_firestore, registry
+from doc_cache import cache_stats
+from etag import stats as etag_stats
+from face_cache import reference_cache
+from image_utils import image_stats
+import metrics
+from user_emails import credential_cache
+
+# (module, tên blueprint) theo đúng thứ tự đăng ký; các route trùng nhau thì blueprint đăng ký trước được dùng
+BLUEPRINTS = [
+    ('report_api', 'report_api'),
+    ('profile_api', 'profile_api'),
+    ('dashboard_api', 'dashboard_api'),
+    ('class_api', 'class_api'),
+    ('students_api', 'students_api'),
+    ('teachers_api', 'teachers_api'),
+    ('register_api', 'register_api'),
+    ('login_api', 'login_api'),
+    ('attendance_api', 'attendance_api'),
+]
 
 app = Flask(__name__)
 CORS(app, supports_credentials=True, origins="*")
+# Giới hạn kích thước body (ảnh gửi dạng multipart / image/jpeg / JSON base64)
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_BYTES', 16 * 1024 * 1024))
+# Đo độ trễ theo route / theo bước (metrics.py), đăng ký trước xác thực để tính cả thời gian kiểm tra token
+metrics.init_metrics(app)
+# Xác thực Firebase ID token dùng chung cho mọi blueprint (auth_middleware.py)
+init_auth(app)
 
 # Lấy đường dẫn file key và project_id từ biến môi trường
 SERVICE_ACCOUNT_KEY_PATH = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS")
 FIREBASE_PROJECT_ID = os.environ.get("FIREBASE_PROJECT_ID")
 
 # KHÔNG khởi tạo db toàn cục ở đây
-# db = firestore.Client.from_service_account_json(...)
-
-# Trong mỗi route, khi cần mới khởi tạo db:
-# db = firestore.Client.from_service_account_json(SERVICE_ACCOUNT_KEY_PATH, project=FIREBASE_PROJECT_ID)
-
-# Đăng ký các blueprint
-app.register_blueprint(report_api)
-app.register_blueprint(profile_api)
-app.register_blueprint(dashboard_api)
-app.register_blueprint(class_api)
-app.register_blueprint(students_api)
-app.register_blueprint(teachers_api)
-app.register_blueprint(register_api)
-app.register_blueprint(login_api)
-app.register_blueprint(attendance_api)
+# Trong mỗi route lấy client dùng chung từ registry (clients.py), chỉ tạo ở lần dùng đầu:
+# db = get_firestore()
+
+# Đăng ký các blueprint (đo thời gian import từng module cho báo cáo khởi động)
+for module_name, blueprint_name in BLUEPRINTS:
+    module = startup_report.import_module(module_name)
+    app.register_blueprint(getattr(module, blueprint_name))
+
+@app.before_request
+def mark_first_request():
+    startup_report.mark_first_request()
 
 # Route debug_env để kiểm tra project id runtime
 @app.route("/debug_env")
 def debug_env():
     try:
-        from google.cloud import firestore
-        db = firestore.Client()
+        db = get_firestore()
         return {
             "runtime_project_id": db.project
         }, 200
@@ -56,5 +73,26 @@ def debug_env():
             "trace": traceback.format_exc()
         }, 500
 
+# Số client / kênh kết nối đang mở trong registry dùng chung
+@app.route("/debug_clients")
+def debug_clients():
+    return dict(registry.stats(), doc_cache=cache_stats(), etag=etag_stats(), login=credential_cache.stats(), auth=auth_stats(),
+                reference_faces=reference_cache.stats(), images=image_stats()), 200
+
+# Chỉ số dạng Prometheus (độ trễ p50/p95/p99 theo route và theo bước, số lệnh gọi ngoài, số document đọc)
+@app.route("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# Báo cáo cold start: thời gian import, tạo client và tới request đầu tiên
+@app.route("/debug_startup")
+def debug_startup():
+    return startup_report.as_dict(registry.stats()['init_seconds']), 200
+
+startup_report.mark_ready()
+# Tuỳ chọn: tạo sẵn client trong nền để request đầu không phải chờ
+if os.environ.get('WARM_CLIENTS', '0') == '1':
+    threading.Thread(target=registry.warm_up, name='warm-clients', daemon=True).start()
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 8080)), debug=True)
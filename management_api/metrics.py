@@ -0,0 +1,207 @@
+# management_api/metrics.py
+# Đo thời gian theo route và theo từng bước (stage), xuất dạng Prometheus tại /metrics.
+# - rollcall_http_request_duration_seconds{route,method}: độ trễ mỗi route (p50/p95/p99)
+# - rollcall_stage_duration_seconds{route,stage}: từng bước trong handler (upload GCS, so khớp, ghi Firestore...)
+# - rollcall_external_calls_total / rollcall_external_call_duration_seconds{service}: GCS, Rekognition
+#   (đếm tự động qua hook của client trong clients.py) và Firestore (đếm ở chỗ đọc/ghi)
+# - rollcall_external_calls_per_request{route,service}, rollcall_firestore_documents_read_per_request{route}
+# Phân vị tính trên METRICS_WINDOW mẫu gần nhất của mỗi chuỗi.
+# Lệnh gọi trong thread nền (archive ảnh, pool truy vấn, hàng đợi job) được tính với route="background".
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from flask import g, has_app_context, has_request_context, request
+
+METRICS_WINDOW = int(os.environ.get('METRICS_WINDOW', 1024))
+METRICS_PREFIX = 'rollcall_'
+QUANTILES = (0.5, 0.95, 0.99)
+
+HELP = {
+    'http_request_duration_seconds': 'Request latency by route',
+    'http_requests_total': 'Requests by route and status',
+    'stage_duration_seconds': 'Latency of a stage inside a handler',
+    'external_calls_total': 'Calls to Firestore, GCS and Rekognition',
+    'external_call_duration_seconds': 'Latency of a single external call',
+    'external_calls_per_request': 'External calls made by one request',
+    'firestore_documents_read_total': 'Firestore documents read',
+    'firestore_documents_read_per_request': 'Firestore documents read by one request',
+}
+
+
+class Summary:
+    def __init__(self, window):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.samples.append(value)
+        self.count += 1
+        self.sum += value
+
+    def quantiles(self):
+        values = sorted(self.samples)
+        if not values:
+            return {q: 0 for q in QUANTILES}
+        return {q: values[min(len(values) - 1, int(round(q * (len(values) - 1))))] for q in QUANTILES}
+
+
+class MetricsRegistry:
+    def __init__(self, window):
+        self.window = window
+        self._lock = threading.Lock()
+        # tên -> {tuple nhãn: Summary | số đếm}
+        self._summaries = {}
+        self._counters = {}
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._summaries.setdefault(name, {})
+            summary = series.get(key)
+            if summary is None:
+                summary = series[key] = Summary(self.window)
+            summary.observe(value)
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name in sorted(self._counters):
+                full = METRICS_PREFIX + name
+                lines += [f'# HELP {full} {HELP.get(name, name)}', f'# TYPE {full} counter']
+                for key, value in sorted(self._counters[name].items()):
+                    lines.append(f'{full}{_labels(key)} {value}')
+            for name in sorted(self._summaries):
+                full = METRICS_PREFIX + name
+                lines += [f'# HELP {full} {HELP.get(name, name)}', f'# TYPE {full} summary']
+                for key, summary in sorted(self._summaries[name].items()):
+                    for q, value in summary.quantiles().items():
+                        lines.append(f'{full}{_labels(key + (("quantile", str(q)),))} {value:.6g}')
+                    lines.append(f'{full}_sum{_labels(key)} {summary.sum:.6g}')
+                    lines.append(f'{full}_count{_labels(key)} {summary.count}')
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(key):
+    if not key:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in key)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(key, escaped)) + '}'
+
+
+registry = MetricsRegistry(METRICS_WINDOW)
+
+
+def current_route():
+    if not has_request_context():
+        return 'background'
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+
+def _request_stats():
+    if has_app_context():
+        return g.get('metrics')
+    return None
+
+
+def record_call(service, seconds=None):
+    registry.inc('external_calls_total', service=service, route=current_route())
+    if seconds is not None:
+        registry.observe('external_call_duration_seconds', seconds, service=service)
+    stats = _request_stats()
+    if stats is not None:
+        stats['calls'][service] = stats['calls'].get(service, 0) + 1
+
+
+def count_reads(n, seconds=None):
+    # Một lệnh đọc Firestore (get / get_all / query) trả về n document
+    record_call('firestore', seconds)
+    registry.inc('firestore_documents_read_total', n, route=current_route())
+    stats = _request_stats()
+    if stats is not None:
+        stats['reads'] += n
+
+
+def get_document(ref, field_paths=None):
+    # DocumentReference.get() có đếm (document không tồn tại vẫn tính một lượt đọc)
+    snap = ref.get(field_paths=field_paths)
+    count_reads(1)
+    return snap
+
+
+def counted(docs):
+    # Bọc iterator của query.stream()/get_all(): đếm số document khi duyệt xong
+    n = 0
+    try:
+        for doc in docs:
+            n += 1
+            yield doc
+    finally:
+        count_reads(n)
+
+
+@contextmanager
+def stage(name, service=None):
+    # service: tên dịch vụ ngoài nếu bước này là một lệnh gọi (vd. 'firestore' khi commit)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        registry.observe('stage_duration_seconds', elapsed, route=current_route(), stage=name)
+        if service:
+            record_call(service, elapsed)
+
+
+def instrument_http_session(session, service):
+    # GCS: mỗi phản hồi HTTP của AuthorizedSession là một lệnh gọi
+    session.hooks['response'].append(
+        lambda response, *args, **kwargs: record_call(service, response.elapsed.total_seconds()))
+
+
+def instrument_boto3_client(client, service):
+    def before_call(context=None, **kwargs):
+        if context is not None:
+            context['metrics_start'] = time.perf_counter()
+
+    def after_call(context=None, **kwargs):
+        start = (context or {}).get('metrics_start')
+        record_call(service, time.perf_counter() - start if start else None)
+
+    client.meta.events.register('before-call', before_call)
+    client.meta.events.register('after-call', after_call)
+
+
+def _before_request():
+    g.metrics = {'start': time.perf_counter(), 'calls': {}, 'reads': 0}
+
+
+def _after_request(response):
+    stats = g.get('metrics')
+    if stats is None:
+        return response
+    route, method = current_route(), request.method
+    registry.observe('http_request_duration_seconds', time.perf_counter() - stats['start'], route=route, method=method)
+    registry.inc('http_requests_total', route=route, method=method, status=str(response.status_code))
+    for service in ('firestore', 'gcs', 'rekognition'):
+        registry.observe('external_calls_per_request', stats['calls'].get(service, 0), route=route, service=service)
+    registry.observe('firestore_documents_read_per_request', stats['reads'], route=route)
+    return response
+
+
+def init_metrics(app):
+    # Đăng ký trước các before_request khác để tính cả thời gian xác thực
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+
+
+def render():
+    return registry.render()
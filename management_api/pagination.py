@@ -0,0 +1,57 @@
+# management_api/pagination.py
+# Phân trang bằng cursor và chọn trường cho các API danh sách.
+# - limit: số bản ghi mỗi trang (không truyền: LIST_DEFAULT_LIMIT); luôn trả next_cursor, null ở trang cuối
+# - cursor: id của document cuối trang trước (lấy từ next_cursor)
+# - fields: danh sách trường client cần, ví dụ fields=id,name; Firestore chỉ trả về các trường đó
+import os
+from metrics import counted
+
+LIST_MAX_LIMIT = int(os.environ.get('LIST_MAX_LIMIT', 500))
+LIST_DEFAULT_LIMIT = int(os.environ.get('LIST_DEFAULT_LIMIT', 100))
+
+
+def page_args(args, max_limit=LIST_MAX_LIMIT):
+    # Trả về (limit, cursor, fields); ValueError nếu tham số sai
+    limit = args.get('limit')
+    if limit is None:
+        # Không bao giờ trả cả collection trong một response
+        limit = min(LIST_DEFAULT_LIMIT, max_limit)
+    else:
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise ValueError('Invalid limit')
+        if limit < 1:
+            raise ValueError('Invalid limit')
+        limit = min(limit, max_limit)
+    cursor = args.get('cursor') or args.get('start_after') or None
+    fields = [f.strip() for f in args.get('fields', '').split(',') if f.strip()] or None
+    return limit, cursor, fields
+
+
+def select_fields(fields, available):
+    # available: {tên trường trả về: trường lưu trong Firestore (hoặc None nếu lấy từ doc.id)}
+    # Trả về (các trường trả về, các trường cần select trên Firestore)
+    if fields is None:
+        names = list(available)
+    else:
+        unknown = [f for f in fields if f not in available]
+        if unknown:
+            raise ValueError(f'Unknown fields: {", ".join(unknown)}')
+        names = ['id'] + [f for f in fields if f != 'id']
+    stored = sorted({available[n] for n in names if available.get(n)})
+    return names, stored
+
+
+def project(item, names):
+    return {k: item[k] for k in names if k in item}
+
+
+def fetch_page(query, limit, cursor):
+    # Sắp theo id document để cursor ổn định; lấy dư một bản ghi để biết còn trang sau không
+    query = query.order_by('__name__')
+    if cursor:
+        query = query.start_after({'__name__': cursor})
+    docs = list(counted(query.limit(limit + 1).stream()))
+    next_cursor = docs[limit - 1].id if len(docs) > limit else None
+    return docs[:limit], next_cursor
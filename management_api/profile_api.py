@@ -1,7 +1,9 @@
 from flask import Flask, request, jsonify, Blueprint
 from flask_cors import CORS
 import os
-from google.cloud import firestore
+from clients import get_firestore
+from doc_cache import invalidate_user, users_cache
+from metrics import get_document
 
 
 app = Flask(__name__)
@@ -10,20 +12,15 @@ CORS(app)
 profile_api = Blueprint('profile_api', __name__)
 CORS(profile_api)
 
-# Đường dẫn mới tới file service account key
-SERVICE_ACCOUNT_KEY_PATH = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS")
-FIREBASE_PROJECT_ID = os.environ.get("FIREBASE_PROJECT_ID")
-# Khởi tạo Firestore client
-db = firestore.Client.from_service_account_json(SERVICE_ACCOUNT_KEY_PATH, project=FIREBASE_PROJECT_ID)
 
 # Lấy thông tin profile theo user id (uid)
 @profile_api.route('/api/profile/<user_id>', methods=['GET'])
 def get_profile(user_id):
     try:
-        user_ref = db.collection('users').document(user_id)
-        user_doc = user_ref.get()
-        if user_doc.exists:
-            return jsonify({"success": True, "profile": user_doc.to_dict()})
+        db = get_firestore()
+        profile = users_cache.get(db, user_id)
+        if profile is not None:
+            return jsonify({"success": True, "profile": profile})
         return jsonify({"success": False, "error": "User not found"}), 404
     except Exception as e:
         import traceback
@@ -34,9 +31,10 @@ def get_profile(user_id):
 @profile_api.route('/api/profile/<user_id>', methods=['PUT'])
 def update_profile(user_id):
     try:
+        db = get_firestore()
         data = request.json
         user_ref = db.collection('users').document(user_id)
-        user_doc = user_ref.get()
+        user_doc = get_document(user_ref)
         if not user_doc.exists:
             return jsonify({"success": False, "error": "User not found"}), 404
         # Chỉ cập nhật một số trường cho demo
@@ -46,9 +44,11 @@ def update_profile(user_id):
                 update_fields[field] = data[field]
         if update_fields:
             user_ref.update(update_fields)
-        # Lấy lại profile mới
-        new_doc = user_ref.get()
-        return jsonify({"success": True, "profile": new_doc.to_dict()})
+            invalidate_user(user_id)
+        # Profile mới = document vừa đọc + các trường vừa ghi, không cần đọc lại
+        profile = user_doc.to_dict()
+        profile.update(update_fields)
+        return jsonify({"success": True, "profile": profile})
     except Exception as e:
         import traceback
         print(f"[ERROR /api/profile/<user_id> PUT]: {e}\nTraceback: {traceback.format_exc()}")
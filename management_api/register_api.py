@@ -1,38 +1,21 @@
-import firebase_admin
-from firebase_admin import auth, credentials
 from flask import Blueprint, request, jsonify
 from flask_cors import CORS
 from google.cloud import firestore
 from werkzeug.security import generate_password_hash
 import os
+from auth_middleware import current_profile, current_user, require_auth
+from clients import get_firebase_auth, get_firestore
+from doc_cache import invalidate_user, users_cache
+from user_emails import email_index_ref
 
 register_api = Blueprint('register_api', __name__)
 CORS(register_api)
 
-cred = credentials.Certificate(os.environ.get("GOOGLE_APPLICATION_CREDENTIALS"))
-firebase_admin.initialize_app(cred)
-
-# Đường dẫn mới tới file service account key
-SERVICE_ACCOUNT_KEY_PATH = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS")
-FIREBASE_PROJECT_ID = os.environ.get("FIREBASE_PROJECT_ID")
-# Khi khởi tạo Firestore client:
-db = firestore.Client.from_service_account_json(SERVICE_ACCOUNT_KEY_PATH, project=FIREBASE_PROJECT_ID)
-
-def verify_firebase_token():
-    auth_header = request.headers.get('Authorization')
-    if not auth_header or not auth_header.startswith('Bearer '):
-        return None
-    id_token = auth_header.split(' ')[1]
-    try:
-        decoded_token = auth.verify_id_token(id_token)
-        return decoded_token
-    except Exception:
-        return None
-
 # Đăng ký tài khoản mới
 @register_api.route('/api/register', methods=['POST'])
 def register():
     try:
+        db = get_firestore()
         data = request.get_json()
         full_name = data.get('fullName')
         email = data.get('email')
@@ -44,6 +27,7 @@ def register():
             return jsonify({'error': 'Missing required fields', 'detail': f"fullName={full_name}, email={email}, user_id={user_id}, role={role}, password={'yes' if password else 'no'}"}), 400
 
         # Kiểm tra email đã tồn tại
+        auth = get_firebase_auth()
         try:
             auth.get_user_by_email(email)
             return jsonify({'error': 'Email already registered'}), 409
@@ -89,7 +73,12 @@ def register():
 
         print(f"[REGISTER] New user: uid={uid}, data={user_data}")
         try:
-            db.collection('users').document(uid).set(user_data)
+            # Hồ sơ và chỉ mục email -> uid (dùng khi đăng nhập) ghi trong cùng một commit
+            batch = db.batch()
+            batch.set(db.collection('users').document(uid), user_data)
+            batch.set(email_index_ref(db, email), {'uid': uid})
+            batch.commit()
+            invalidate_user(uid)
         except Exception as e:
             return jsonify({'error': 'Firestore error', 'detail': str(e)}), 500
         return jsonify({'success': True, 'message': 'Đăng ký thành công!'})
@@ -99,23 +88,15 @@ def register():
 
 # API cần xác thực
 @register_api.route('/some-protected-api', methods=['GET'])
+@require_auth('teacher')
 def protected_api():
     try:
-        user = verify_firebase_token()
-        if not user:
-            return jsonify({'error': 'Unauthorized'}), 401
-        uid = user['uid']
-
-        user_doc = db.collection('users').document(uid).get()
-        if not user_doc.exists:
-            return jsonify({'error': 'User not found'}), 404
-        user_data = user_doc.to_dict()
+        # Token và role đã được kiểm tra bởi auth_middleware
+        uid = current_user()['uid']
+        user_data = current_profile()
 
         print(f"[PROTECTED_API] Current user: uid={uid}, data={user_data}")
 
-        if user_data.get('role') != 'teacher':
-            return jsonify({'error': 'Forbidden'}), 403
-
         return jsonify({'success': True, 'role': user_data['role']})
     except Exception as e:
         import traceback
@@ -1,48 +1,44 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, Response, request, jsonify, send_file, stream_with_context
 import os
-from google.cloud import firestore
+import tempfile
+from class_roster import class_summary
+from clients import get_firestore
+from concurrent.futures import ThreadPoolExecutor
+from image_utils import is_truthy
+from job_queue import job_queue
+from report_export import (EXPORT_FORMATS, EXPORT_STREAM_MAX_ROWS, count_rows, export_file_name, export_query,
+                           iter_csv, iter_rows, parse_day, write_xlsx)
+from rollups import student_totals
+from ttl_cache import TTLCache
+from etag import conditional
+from user_lookup import display_name, resolve_users
 
 report_api = Blueprint('report_api', __name__)
 
+# Số truy vấn đếm chạy đồng thời và thời gian tối đa dùng lại báo cáo tổng quan các lớp
+REPORT_QUERY_WORKERS = int(os.environ.get('REPORT_QUERY_WORKERS', 16))
+REPORT_CACHE_SECONDS = int(os.environ.get('REPORT_CACHE_SECONDS', 60))
+class_report_cache = TTLCache(REPORT_CACHE_SECONDS, max_entries=1)
+
 # Lấy báo cáo điểm danh từng sinh viên trong lớp
 @report_api.route('/api/reports/attendance', methods=['GET'])
+@conditional('attendance', 'users')
 def get_attendance_report():
     try:
         class_id = request.args.get('class')
-        SERVICE_ACCOUNT_KEY_PATH = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS")
-        FIREBASE_PROJECT_ID = os.environ.get("FIREBASE_PROJECT_ID")
-        db = firestore.Client.from_service_account_json(SERVICE_ACCOUNT_KEY_PATH, project=FIREBASE_PROJECT_ID)
-        attendance_ref = db.collection('attendance')
-        query = attendance_ref
-        if class_id:
-            query = query.where('classId', '==', class_id)
-        docs = query.stream()
-
-        # Gom theo studentId
+        db = get_firestore()
+        # Đọc bộ đếm đã tổng hợp sẵn (vài document mỗi sinh viên) thay vì quét collection attendance
         student_stats = {}
-        for doc in docs:
-            data = doc.to_dict()
-            sid = data.get('studentId')
-            status = data.get('status')
-            if not sid:
-                continue
-            if sid not in student_stats:
-                student_stats[sid] = {'present': 0, 'absent': 0, 'late': 0, 'total': 0}
-            if status == 'present':
-                student_stats[sid]['present'] += 1
-            elif status == 'absent':
-                student_stats[sid]['absent'] += 1
-            elif status == 'late':
-                student_stats[sid]['late'] += 1
-            student_stats[sid]['total'] += 1
+        for (_, sid), counts in student_totals(db, class_id).items():
+            stats = student_stats.setdefault(sid, {'present': 0, 'absent': 0, 'late': 0, 'total': 0})
+            for field in stats:
+                stats[field] += counts[field]
 
-        # Lấy tên sinh viên từ users
-        db_users = db.collection('users')
+        # Lấy tên sinh viên từ users theo lô (get_all + cache)
+        users = resolve_users(db, list(student_stats))
         data = []
         for sid, stats in student_stats.items():
-            user_doc = db_users.document(sid).get()
-            user_data = user_doc.to_dict() if user_doc.exists else {}
-            name = user_data.get('displayName') or user_data.get('name') or sid
+            name = display_name(users.get(sid), sid)
             attendance_rate = round(100 * stats['present'] / stats['total'], 2) if stats['total'] else 0
             data.append({
                 "studentId": sid,
@@ -58,37 +54,39 @@ def get_attendance_report():
         print(f"[ERROR /api/reports/attendance]: {e}\nTraceback: {traceback.format_exc()}")
         return jsonify({"success": False, "error": str(e), "trace": traceback.format_exc()}), 500
 
+def class_attendance_summary(db, class_id, class_info):
+    attendance_ref = db.collection('attendance').where('classId', '==', class_id)
+    total = count_rows(attendance_ref)
+    present = count_rows(attendance_ref.where('status', '==', 'present')) if total else 0
+    return {
+        "class": class_info['name'],
+        "attendanceRate": round(100 * present / total, 2) if total else 0,
+        "studentCount": class_info['totalStudents']
+    }
+
+def build_class_report(db):
+    # Tên lớp và totalStudents lấy từ class_directory (class_roster.py), không tải mảng students
+    classes = list(class_summary(db).items())
+    if not classes:
+        return []
+    # Các lớp được đếm song song, pool.map giữ nguyên thứ tự lớp
+    with ThreadPoolExecutor(max_workers=min(REPORT_QUERY_WORKERS, len(classes))) as pool:
+        return list(pool.map(lambda c: class_attendance_summary(db, c[0], c[1]), classes))
+
 # Lấy báo cáo tổng quan các lớp
 @report_api.route('/api/reports/class', methods=['GET'])
+@conditional('attendance', 'classes')
 def get_class_attendance():
     try:
-        SERVICE_ACCOUNT_KEY_PATH = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS")
-        FIREBASE_PROJECT_ID = os.environ.get("FIREBASE_PROJECT_ID")
-        db = firestore.Client.from_service_account_json(SERVICE_ACCOUNT_KEY_PATH, project=FIREBASE_PROJECT_ID)
-        classes_ref = db.collection('classes')
-        attendance_ref = db.collection('attendance')
-        classes_docs = classes_ref.stream()
-        data = []
-        for class_doc in classes_docs:
-            class_data = class_doc.to_dict()
-            class_id = class_doc.id
-            class_name = class_data.get('name', '')
-            students = class_data.get('students', [])
-            # Đếm số lần present/absent của lớp
-            attendance_docs = attendance_ref.where('classId', '==', class_id).stream()
-            present, total = 0, 0
-            for att_doc in attendance_docs:
-                att_data = att_doc.to_dict()
-                if att_data.get('status') == 'present':
-                    present += 1
-                total += 1
-            attendance_rate = round(100 * present / total, 2) if total else 0
-            data.append({
-                "class": class_name,
-                "attendanceRate": attendance_rate,
-                "studentCount": len(students)
-            })
-        return jsonify({"success": True, "data": data})
+        db = get_firestore()
+        # Kết quả được dùng lại tối đa REPORT_CACHE_SECONDS giây; ?refresh=1 để tính lại ngay
+        if request.args.get('refresh') == '1':
+            class_report_cache.invalidate('all')
+        data, age = class_report_cache.get_or_load('all', lambda: build_class_report(db))
+        # Tuổi của bản cache nằm ở header Age, không nằm trong body được hash làm ETag
+        response = jsonify({"success": True, "data": data})
+        response.headers['Age'] = str(int(age))
+        return response
     except Exception as e:
         import traceback
         print(f"[ERROR /api/reports/class]: {e}\nTraceback: {traceback.format_exc()}")
@@ -97,17 +95,48 @@ def get_class_attendance():
 @report_api.route('/api/reports/export', methods=['POST'])
 def export_report():
     try:
-        req = request.json
+        req = request.get_json(silent=True) or {}
         export_type = req.get('type')
-        # TODO: Thực tế: sinh file, trả về link tải hoặc file trực tiếp
-        # Ở đây trả về link giả lập
-        if export_type == 'pdf':
-            return jsonify({"success": True, "url": "/static/report.pdf"})
-        elif export_type == 'excel':
-            return jsonify({"success": True, "url": "/static/report.xlsx"})
-        else:
-            return jsonify({"success": False, "error": "Invalid export type"}), 400
+        if export_type not in EXPORT_FORMATS:
+            return jsonify({"success": False, "error": "Invalid export type, expected csv or excel"}), 400
+        class_id = req.get('class') or req.get('classId')
+        try:
+            start = parse_day(req.get('from'), 'from')
+            end = parse_day(req.get('to'), 'to')
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
+        file_name = export_file_name(export_type, class_id, req.get('from'), req.get('to'))
+        db = get_firestore()
+        query = export_query(db, class_id, start, end)
+
+        # Khoảng lớn: sinh file trong job nền, client hỏi trạng thái để lấy signed URL
+        rows = count_rows(query)
+        if is_truthy(req.get('async')) or rows > EXPORT_STREAM_MAX_ROWS:
+            job_id = job_queue.submit('report_export', {
+                'format': export_type, 'class_id': class_id, 'start': start, 'end': end, 'file_name': file_name
+            })
+            print(f"[INFO] Report export queued: job_id={job_id}, rows={rows}, file={file_name}")
+            return jsonify({"success": True, "job_id": job_id, "rows": rows,
+                            "status_url": f'/api/reports/export/jobs/{job_id}'}), 202
+
+        # Khoảng nhỏ: stream thẳng về response
+        mimetype, extension = EXPORT_FORMATS[export_type]
+        headers = {'Content-Disposition': f'attachment; filename="{file_name}"'}
+        if extension == 'csv':
+            return Response(stream_with_context(iter_csv(iter_rows(db, query))), mimetype=mimetype, headers=headers)
+        # XLSX là file zip, phải ghi xong mới gửi: ghi ra file tạm rồi gửi từ đĩa
+        tmp = tempfile.TemporaryFile()
+        write_xlsx(iter_rows(db, query), tmp)
+        tmp.seek(0)
+        return send_file(tmp, mimetype=mimetype, as_attachment=True, download_name=file_name)
     except Exception as e:
         import traceback
         print(f"[ERROR /api/reports/export]: {e}\nTraceback: {traceback.format_exc()}")
-        return jsonify({"success": False, "error": str(e), "trace": traceback.format_exc()}), 500
\ No newline at end of file
+        return jsonify({"success": False, "error": str(e), "trace": traceback.format_exc()}), 500
+
+@report_api.route('/api/reports/export/jobs/<job_id>', methods=['GET'])
+def export_job_status(job_id):
+    job = job_queue.status(job_id)
+    if job is None or job.get('kind') != 'report_export':
+        return jsonify({"success": False, "error": "Job not found"}), 404
+    return jsonify(dict(job, success=True))
@@ -0,0 +1,147 @@
+# management_api/report_export.py
+# Xuất báo cáo điểm danh ra CSV/XLSX với bộ nhớ cố định:
+# đọc attendance theo từng trang (cursor start_after), ghi từng dòng ra stream/file tạm.
+# Khoảng dữ liệu nhỏ được stream thẳng về response; khoảng lớn chạy thành job nền,
+# file được upload lên GCS và trả về signed URL.
+import csv
+import io
+import os
+import tempfile
+from datetime import datetime, timedelta
+from clients import get_firestore, get_storage
+from job_queue import job_queue
+from metrics import count_reads, counted
+from rollups import ROLLUP_UTC_OFFSET_HOURS, local_time
+from user_lookup import display_name, resolve_users
+
+EXPORT_PAGE_SIZE = int(os.environ.get('EXPORT_PAGE_SIZE', 500))
+# Quá số dòng này (hoặc khi client yêu cầu async) thì chuyển sang job nền
+EXPORT_STREAM_MAX_ROWS = int(os.environ.get('EXPORT_STREAM_MAX_ROWS', 5000))
+EXPORT_URL_EXPIRATION_SECONDS = int(os.environ.get('EXPORT_URL_EXPIRATION_SECONDS', 3600))
+EXPORT_PREFIX = 'exports'
+EXPORT_COLUMNS = ['date', 'classId', 'studentId', 'name', 'status', 'similarity', 'verifiedBy']
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'excel': ('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'xlsx'),
+    'xlsx': ('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'xlsx'),
+}
+
+
+def parse_day(value, name):
+    # Ngày 'YYYY-MM-DD' theo giờ địa phương -> mốc UTC đầu ngày
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d') - timedelta(hours=ROLLUP_UTC_OFFSET_HOURS)
+    except ValueError:
+        raise ValueError(f'Invalid {name}, expected YYYY-MM-DD')
+
+
+def export_query(db, class_id=None, start=None, end=None):
+    query = db.collection('attendance')
+    if class_id:
+        query = query.where('classId', '==', class_id)
+    if start:
+        query = query.where('createdAt', '>=', start)
+    if end:
+        # end là đầu ngày "to", lấy trọn ngày đó
+        query = query.where('createdAt', '<', end + timedelta(days=1))
+    return query
+
+
+def count_rows(query):
+    # Aggregation query: Firestore chỉ trả về con số, không tải document
+    result = query.count(alias='total').get()
+    count_reads(1)
+    return int(result[0][0].value)
+
+
+def iter_rows(db, query, page_size=EXPORT_PAGE_SIZE):
+    # Mỗi lần chỉ giữ một trang trong bộ nhớ
+    query = query.order_by('createdAt').select(['classId', 'studentId', 'status', 'similarity', 'verifiedBy', 'createdAt'])
+    last = None
+    while True:
+        page_query = query.start_after(last) if last is not None else query
+        docs = list(counted(page_query.limit(page_size).stream()))
+        if not docs:
+            return
+        records = [doc.to_dict() for doc in docs]
+        users = resolve_users(db, [r.get('studentId') for r in records])
+        for r in records:
+            yield [
+                local_time(r['createdAt']) if r.get('createdAt') else '',
+                r.get('classId', ''),
+                r.get('studentId', ''),
+                display_name(users.get(r.get('studentId')), r.get('studentId', '')),
+                r.get('status', ''),
+                r.get('similarity', ''),
+                r.get('verifiedBy', ''),
+            ]
+        if len(docs) < page_size:
+            return
+        last = docs[-1]
+
+
+def iter_csv(rows):
+    # Sinh CSV từng dòng, không dựng cả file trong bộ nhớ
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    # BOM để Excel đọc đúng tiếng Việt
+    buffer.write('\ufeff')
+    writer.writerow(EXPORT_COLUMNS)
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() > 64 * 1024:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+    yield buffer.getvalue()
+
+
+def write_xlsx(rows, path):
+    # write_only: openpyxl ghi thẳng từng dòng ra file, không giữ cả sheet trong bộ nhớ
+    from openpyxl import Workbook
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('attendance')
+    sheet.append(EXPORT_COLUMNS)
+    for row in rows:
+        sheet.append(row)
+    workbook.save(path)
+
+
+def write_export(fmt, rows, path):
+    if EXPORT_FORMATS[fmt][1] == 'xlsx':
+        write_xlsx(rows, path)
+    else:
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            for chunk in iter_csv(rows):
+                f.write(chunk)
+
+
+def export_file_name(fmt, class_id, start_day, end_day):
+    parts = ['attendance', class_id or 'all', start_day or 'begin', end_day or 'now']
+    return '_'.join(parts) + '.' + EXPORT_FORMATS[fmt][1]
+
+
+def run_export_job(payload):
+    # Job nền: ghi ra file tạm, upload GCS rồi trả signed URL
+    fmt = payload['format']
+    db = get_firestore()
+    query = export_query(db, payload.get('class_id'), payload.get('start'), payload.get('end'))
+    fd, path = tempfile.mkstemp(suffix='.' + EXPORT_FORMATS[fmt][1])
+    os.close(fd)
+    try:
+        write_export(fmt, iter_rows(db, query), path)
+        blob_name = f"{EXPORT_PREFIX}/{datetime.utcnow().strftime('%Y%m%d%H%M%S')}_{payload['file_name']}"
+        blob = get_storage().bucket(os.environ.get('GCS_BUCKET_NAME')).blob(blob_name)
+        blob.upload_from_filename(path, content_type=EXPORT_FORMATS[fmt][0])
+        url = blob.generate_signed_url(version='v4', method='GET',
+                                       expiration=timedelta(seconds=EXPORT_URL_EXPIRATION_SECONDS),
+                                       response_disposition=f'attachment; filename="{payload["file_name"]}"')
+        print(f"[INFO] Report export uploaded: {blob_name} ({os.path.getsize(path)} bytes)")
+        return {'url': url, 'file_name': payload['file_name'], 'expires_in': EXPORT_URL_EXPIRATION_SECONDS}
+    finally:
+        os.remove(path)
+
+
+job_queue.register('report_export', run_export_job)
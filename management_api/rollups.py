@@ -0,0 +1,211 @@
+# management_api/rollups.py
+# Bộ đếm điểm danh tổng hợp sẵn, cập nhật trong cùng batch với bản ghi attendance:
+# - attendance_rollups:       theo (lớp, sinh viên)
+# - attendance_daily_rollups: theo (lớp, ngày)
+# - dashboard_daily:          theo ngày cho toàn hệ thống (dashboard giảng viên)
+# Mỗi bộ đếm chia thành ROLLUP_SHARDS shard (mỗi shard một document) để tránh tranh chấp ghi
+# trên một document nóng; khi đọc thì cộng các shard lại.
+#
+# Dựng lại toàn bộ từ collection attendance (nên chạy khi không có điểm danh mới):
+#   python rollups.py rebuild [--class CLASS_ID]
+import argparse
+import random
+from datetime import datetime, timedelta
+import os
+from metrics import counted
+
+ROLLUP_SHARDS = int(os.environ.get('ROLLUP_SHARDS', 4))
+# Ngày của bản ghi tính theo giờ địa phương (mặc định UTC+7)
+ROLLUP_UTC_OFFSET_HOURS = int(os.environ.get('ROLLUP_UTC_OFFSET_HOURS', 7))
+STUDENT_ROLLUPS = 'attendance_rollups'
+DAILY_ROLLUPS = 'attendance_daily_rollups'
+DASHBOARD_DAILY = 'dashboard_daily'
+STATUSES = ('present', 'absent', 'late')
+FIRESTORE_BATCH_SIZE = 500
+
+
+def local_day(created_at):
+    return (created_at + timedelta(hours=ROLLUP_UTC_OFFSET_HOURS)).strftime('%Y-%m-%d')
+
+
+def local_time(created_at):
+    return (created_at + timedelta(hours=ROLLUP_UTC_OFFSET_HOURS)).strftime('%Y-%m-%d %H:%M')
+
+
+def today():
+    return local_day(datetime.utcnow())
+
+
+def _empty_counts():
+    return {'present': 0, 'absent': 0, 'late': 0, 'total': 0}
+
+
+def _count(counts, status, n=1):
+    if status in STATUSES:
+        counts[status] += n
+    counts['total'] += n
+
+
+def aggregate(records):
+    # Gom các bản ghi attendance thành số cần cộng cho từng bộ đếm
+    students = {}
+    days = {}
+    dashboard = {}
+    for record in records:
+        class_id = record.get('classId')
+        student_id = record.get('studentId')
+        created_at = record.get('createdAt')
+        if not class_id or not student_id or created_at is None:
+            continue
+        _count(students.setdefault((class_id, student_id), _empty_counts()), record.get('status'))
+        day = local_day(created_at)
+        _count(days.setdefault((class_id, day), _empty_counts()), record.get('status'))
+        _count(dashboard.setdefault(day, _empty_counts()), record.get('status'))
+    return students, days, dashboard
+
+
+def add_rollups(batch, db, records):
+    # Thêm các lệnh cộng dồn (Increment) vào batch; trả về số lệnh ghi đã thêm.
+    # Mỗi bộ đếm chỉ ghi một lần cho mỗi batch, vào một shard ngẫu nhiên.
+    from google.cloud import firestore
+    students, days, dashboard = aggregate(records)
+    writes = 0
+    for (class_id, student_id), counts in students.items():
+        shard = random.randrange(ROLLUP_SHARDS)
+        data = {'classId': class_id, 'studentId': student_id, 'shard': shard,
+                'updatedAt': firestore.SERVER_TIMESTAMP}
+        data.update({k: firestore.Increment(v) for k, v in counts.items() if v})
+        batch.set(db.collection(STUDENT_ROLLUPS).document(f'{class_id}__{student_id}__{shard}'), data, merge=True)
+        writes += 1
+    for (class_id, day), counts in days.items():
+        shard = random.randrange(ROLLUP_SHARDS)
+        data = {'classId': class_id, 'date': day, 'shard': shard, 'updatedAt': firestore.SERVER_TIMESTAMP}
+        data.update({k: firestore.Increment(v) for k, v in counts.items() if v})
+        batch.set(db.collection(DAILY_ROLLUPS).document(f'{class_id}__{day}__{shard}'), data, merge=True)
+        writes += 1
+    for day, counts in dashboard.items():
+        shard = random.randrange(ROLLUP_SHARDS)
+        data = {'date': day, 'shard': shard, 'updatedAt': firestore.SERVER_TIMESTAMP}
+        data.update({k: firestore.Increment(v) for k, v in counts.items() if v})
+        batch.set(db.collection(DASHBOARD_DAILY).document(f'{day}__{shard}'), data, merge=True)
+        writes += 1
+    return writes
+
+
+def write_attendance(db, record):
+    # Ghi một bản ghi attendance cùng các bộ đếm trong một commit
+    batch = db.batch()
+    doc_ref = db.collection('attendance').document()
+    batch.set(doc_ref, record)
+    add_rollups(batch, db, [record])
+    batch.commit()
+    return doc_ref
+
+
+def _sum_shards(docs, key_fields):
+    totals = {}
+    for doc in docs:
+        data = doc.to_dict()
+        key = tuple(data.get(f) for f in key_fields)
+        counts = totals.setdefault(key if len(key) > 1 else key[0], _empty_counts())
+        for field in counts:
+            counts[field] += data.get(field, 0) or 0
+    return totals
+
+
+def student_totals(db, class_id=None, student_id=None):
+    # {(classId, studentId): counts}, đọc vài document nhỏ thay vì quét attendance
+    query = db.collection(STUDENT_ROLLUPS)
+    if class_id:
+        query = query.where('classId', '==', class_id)
+    if student_id:
+        query = query.where('studentId', '==', student_id)
+    return _sum_shards(counted(query.stream()), ('classId', 'studentId'))
+
+
+def daily_totals(db, class_id=None, day=None):
+    # {(classId, date): counts}
+    query = db.collection(DAILY_ROLLUPS)
+    if class_id:
+        query = query.where('classId', '==', class_id)
+    if day:
+        query = query.where('date', '==', day)
+    return _sum_shards(counted(query.stream()), ('classId', 'date'))
+
+
+def dashboard_day(db, day):
+    # Tổng của cả hệ thống trong một ngày: đọc đúng ROLLUP_SHARDS document bằng một lần get_all
+    collection = db.collection(DASHBOARD_DAILY)
+    refs = [collection.document(f'{day}__{shard}') for shard in range(ROLLUP_SHARDS)]
+    return _sum_shards((snap for snap in counted(db.get_all(refs)) if snap.exists), ('date',)).get(day, _empty_counts())
+
+
+def _delete_all(db, query):
+    batch = db.batch()
+    pending = 0
+    deleted = 0
+    for doc in query.stream():
+        batch.delete(doc.reference)
+        pending += 1
+        deleted += 1
+        if pending == FIRESTORE_BATCH_SIZE:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+    if pending:
+        batch.commit()
+    return deleted
+
+
+def rebuild(db, class_id=None):
+    # Tính lại toàn bộ bộ đếm từ collection attendance (dùng cho backfill lần đầu hoặc sửa lệch)
+    attendance = db.collection('attendance')
+    student_query = db.collection(STUDENT_ROLLUPS)
+    daily_query = db.collection(DAILY_ROLLUPS)
+    # Bộ đếm toàn hệ thống chỉ dựng lại được khi rebuild tất cả các lớp
+    dashboard_query = None if class_id else db.collection(DASHBOARD_DAILY)
+    if class_id:
+        attendance = attendance.where('classId', '==', class_id)
+        student_query = student_query.where('classId', '==', class_id)
+        daily_query = daily_query.where('classId', '==', class_id)
+    fields = ['classId', 'studentId', 'status', 'createdAt']
+    students, days, dashboard = aggregate(doc.to_dict() for doc in attendance.select(fields).stream())
+    deleted = _delete_all(db, student_query) + _delete_all(db, daily_query)
+    if dashboard_query is not None:
+        deleted += _delete_all(db, dashboard_query)
+    else:
+        dashboard = {}
+
+    from google.cloud import firestore
+    batch = db.batch()
+    pending = 0
+    docs = [(STUDENT_ROLLUPS, f'{c}__{s}__0', {'classId': c, 'studentId': s}, counts)
+            for (c, s), counts in students.items()]
+    docs += [(DAILY_ROLLUPS, f'{c}__{d}__0', {'classId': c, 'date': d}, counts)
+             for (c, d), counts in days.items()]
+    docs += [(DASHBOARD_DAILY, f'{d}__0', {'date': d}, counts) for d, counts in dashboard.items()]
+    for collection, doc_id, key, counts in docs:
+        batch.set(db.collection(collection).document(doc_id),
+                  dict(key, shard=0, updatedAt=firestore.SERVER_TIMESTAMP, **counts))
+        pending += 1
+        if pending == FIRESTORE_BATCH_SIZE:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+    if pending:
+        batch.commit()
+    return {'deleted': deleted, 'student_rollups': len(students), 'daily_rollups': len(days),
+            'dashboard_days': len(dashboard)}
+
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+    load_dotenv()
+    from clients import get_firestore
+
+    parser = argparse.ArgumentParser(description='Attendance rollup maintenance')
+    parser.add_argument('command', choices=['rebuild'])
+    parser.add_argument('--class', dest='class_id', default=None, help='Chỉ dựng lại cho một lớp')
+    args = parser.parse_args()
+    result = rebuild(get_firestore(), args.class_id)
+    print(f"[ROLLUPS] Rebuilt: {result}")
@@ -0,0 +1,66 @@
+# management_api/startup.py
+# Đo thời gian khởi động (cold start): thời gian import từng module blueprint,
+# thời gian tạo client (lấy từ registry) và thời gian tới request đầu tiên.
+import importlib
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Cảnh báo trong log khi khởi động chậm hơn ngưỡng này (giây) để bắt regression
+STARTUP_WARN_SECONDS = float(os.environ.get('STARTUP_WARN_SECONDS', 3))
+
+
+class StartupReport:
+    def __init__(self):
+        self.started_at = time.time()
+        self._t0 = time.perf_counter()
+        self._lock = threading.Lock()
+        self.modules = {}
+        self.phases = {}
+        self.ready_seconds = None
+        self.first_request_seconds = None
+
+    def _elapsed(self, since):
+        return round(time.perf_counter() - since, 4)
+
+    def import_module(self, name):
+        start = time.perf_counter()
+        module = importlib.import_module(name)
+        self.modules[name] = self._elapsed(start)
+        return module
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self._elapsed(start)
+
+    def mark_ready(self):
+        self.ready_seconds = self._elapsed(self._t0)
+        slowest = sorted(self.modules.items(), key=lambda item: item[1], reverse=True)[:3]
+        print(f"[STARTUP] ready in {self.ready_seconds}s, slowest imports: {slowest}, phases: {self.phases}")
+        if self.ready_seconds > STARTUP_WARN_SECONDS:
+            print(f"[WARN] Startup took {self.ready_seconds}s (> {STARTUP_WARN_SECONDS}s)")
+
+    def mark_first_request(self):
+        if self.first_request_seconds is not None:
+            return
+        with self._lock:
+            if self.first_request_seconds is None:
+                self.first_request_seconds = self._elapsed(self._t0)
+
+    def as_dict(self, client_init_seconds=None):
+        return {
+            'started_at': self.started_at,
+            'ready_seconds': self.ready_seconds,
+            'first_request_seconds': self.first_request_seconds,
+            'import_seconds': dict(self.modules),
+            'phase_seconds': dict(self.phases),
+            'client_init_seconds': client_init_seconds or {},
+        }
+
+
+startup_report = StartupReport()
@@ -0,0 +1,218 @@
+# management_api/student_import.py
+# Nhập sinh viên theo lô: manifest CSV/JSONL + file zip ảnh.
+# - Ảnh được chuẩn hoá, upload GCS và đăng ký khuôn mặt qua một pool giới hạn số luồng
+# - Cập nhật users đi qua BulkWriter của Firestore (tự gom lô, giới hạn tốc độ, thử lại);
+#   danh sách lớp ghi bằng ArrayUnion, totalStudents tăng theo số sinh viên thật sự mới (class_roster.py)
+# - Trả về kết quả cho từng dòng của manifest
+import csv
+import io
+import json
+import os
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from class_roster import update_roster
+from doc_cache import invalidate_class, invalidate_user
+from image_utils import normalize_image
+from metrics import counted
+
+IMPORT_WORKERS = int(os.environ.get('IMPORT_WORKERS', 8))
+IMPORT_MAX_ROWS = int(os.environ.get('IMPORT_MAX_ROWS', 5000))
+# Kích thước tối đa của một ảnh SAU khi giải nén (IMPORT_MAX_UPLOAD_BYTES chỉ giới hạn file zip đã nén)
+IMPORT_MAX_PHOTO_BYTES = int(os.environ.get('IMPORT_MAX_PHOTO_BYTES', 20 * 1024 * 1024))
+IMPORT_GET_ALL_CHUNK = 300
+MANIFEST_FIELDS = ('user_id', 'student_id', 'name', 'email', 'status', 'class_id', 'photo')
+
+
+class ManifestError(ValueError):
+    pass
+
+
+def parse_manifest(raw, filename=''):
+    # CSV có dòng tiêu đề, hoặc JSONL mỗi dòng một object; trả về list dict đã làm sạch
+    text = raw.decode('utf-8-sig')
+    if filename.lower().endswith('.jsonl') or text.lstrip().startswith('{'):
+        rows = []
+        for line_no, line in enumerate(text.splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                rows.append(json.loads(line))
+            except ValueError:
+                raise ManifestError(f'Invalid JSON on manifest line {line_no}')
+    else:
+        rows = list(csv.DictReader(io.StringIO(text)))
+    if len(rows) > IMPORT_MAX_ROWS:
+        raise ManifestError(f'At most {IMPORT_MAX_ROWS} rows per import')
+    cleaned = []
+    for row in rows:
+        if not isinstance(row, dict):
+            raise ManifestError('Each manifest row must be an object')
+        cleaned.append({k: str(row.get(k) or '').strip() for k in MANIFEST_FIELDS})
+    return cleaned
+
+
+class StudentImporter:
+    def __init__(self, db, upload_image, matcher, enroll_later=None, workers=IMPORT_WORKERS):
+        # upload_image(user_id, image_bytes) -> url; matcher.enroll(...) -> các trường cần lưu vào users;
+        # enroll_later(user_id) -> job_id: đăng ký khuôn mặt lại trong hàng đợi khi enroll lỗi
+        self.db = db
+        self.upload_image = upload_image
+        self.matcher = matcher
+        self.enroll_later = enroll_later
+        self.workers = workers
+        self._lock = threading.Lock()
+
+    def _existing_users(self, user_ids):
+        users_ref = self.db.collection('users')
+        existing = {}
+        for i in range(0, len(user_ids), IMPORT_GET_ALL_CHUNK):
+            refs = [users_ref.document(uid) for uid in user_ids[i:i + IMPORT_GET_ALL_CHUNK]]
+            for snap in counted(self.db.get_all(refs, field_paths=['face_id'])):
+                if snap.exists:
+                    existing[snap.id] = snap.to_dict() or {}
+        return existing
+
+    def _process_photo(self, archive_path, member, row, user_data):
+        # Mỗi luồng tự mở file zip (ZipFile không an toàn khi đọc song song trên cùng một đối tượng)
+        with zipfile.ZipFile(archive_path) as archive:
+            # Kiểm tra kích thước khai báo trước khi giải nén, và chỉ đọc tối đa giới hạn + 1 byte
+            # phòng khi header khai báo sai (zip bomb)
+            if archive.getinfo(member).file_size > IMPORT_MAX_PHOTO_BYTES:
+                raise ValueError(f'{member} is larger than {IMPORT_MAX_PHOTO_BYTES} bytes uncompressed')
+            with archive.open(member) as photo:
+                raw = photo.read(IMPORT_MAX_PHOTO_BYTES + 1)
+            if len(raw) > IMPORT_MAX_PHOTO_BYTES:
+                raise ValueError(f'{member} is larger than {IMPORT_MAX_PHOTO_BYTES} bytes uncompressed')
+        image = normalize_image(raw, label='import photo')
+        fields = {'avatar_url': self.upload_image(row['user_id'], image)}
+        try:
+            fields.update(self.matcher.enroll(row['user_id'], image, user_data))
+        except Exception as e:
+            print(f"[ERROR] Enroll face for {row['user_id']}: {e}")
+            fields['_warning'] = f'face enroll failed: {e}'
+            fields['_enroll_later'] = True
+        return fields
+
+    def run(self, rows, archive_path=None):
+        results = [{'row': i + 1, 'user_id': row['user_id'], 'status': 'pending'} for i, row in enumerate(rows)]
+
+        def fail(index, message):
+            with self._lock:
+                results[index]['status'] = 'error'
+                results[index]['error'] = message
+
+        # Kiểm tra dữ liệu và tài khoản trước khi làm việc nặng
+        seen = set()
+        valid = []
+        for i, row in enumerate(rows):
+            if not row['user_id']:
+                fail(i, 'Missing user_id')
+            elif row['user_id'] in seen:
+                fail(i, 'Duplicate user_id in manifest')
+            else:
+                seen.add(row['user_id'])
+                valid.append(i)
+        existing = self._existing_users([rows[i]['user_id'] for i in valid])
+        members = {}
+        if archive_path:
+            with zipfile.ZipFile(archive_path) as archive:
+                for name in archive.namelist():
+                    if not name.endswith('/'):
+                        members[os.path.basename(name)] = name
+        pending = []
+        for i in valid:
+            if rows[i]['user_id'] not in existing:
+                fail(i, 'User has not registered')
+            else:
+                pending.append(i)
+
+        writer = self.db.bulk_writer()
+        user_rows = {}
+        enroll_retry = []
+
+        def on_error(failure, _writer):
+            # Trả False: không thử lại nữa (BulkWriter đã tự thử lại các lỗi tạm thời)
+            reference = failure.operation.reference
+            if reference.id in user_rows:
+                fail(user_rows[reference.id], f'Firestore write failed: {failure.message}')
+            return False
+
+        writer.on_write_error(on_error)
+
+        def user_update(i, extra):
+            row = rows[i]
+            update = {k: row[k] for k in ('student_id', 'name', 'email', 'status') if row[k]}
+            update.update({k: v for k, v in extra.items() if not k.startswith('_')})
+            if not update:
+                return
+            user_rows[row['user_id']] = i
+            writer.update(self.db.collection('users').document(row['user_id']), update)
+            with self._lock:
+                if extra.get('avatar_url'):
+                    results[i]['avatar_url'] = extra['avatar_url']
+                if extra.get('_warning'):
+                    results[i]['warning'] = extra['_warning']
+                if extra.get('_enroll_later'):
+                    enroll_retry.append(i)
+
+        # Ảnh xử lý song song; bản ghi users được đẩy vào BulkWriter ngay khi ảnh tương ứng xong
+        with ThreadPoolExecutor(max_workers=max(1, self.workers)) as pool:
+            futures = {}
+            for i in pending:
+                row = rows[i]
+                photo = row['photo'] or f"{row['user_id']}.jpg"
+                member = members.get(os.path.basename(photo))
+                if member is None:
+                    if row['photo']:
+                        fail(i, f'Photo {photo} not found in archive')
+                        continue
+                    user_update(i, {})
+                    continue
+                futures[pool.submit(self._process_photo, archive_path, member, row, existing[row['user_id']])] = i
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    user_update(i, future.result())
+                except Exception as e:
+                    fail(i, f'Photo processing failed: {e}')
+
+        # close() chờ mọi lệnh ghi users xong (kể cả thử lại) để biết dòng nào lỗi trước khi ghi danh vào lớp
+        writer.close()
+
+        # Danh sách lớp: chỉ gồm các dòng đã cập nhật users thành công
+        by_class = {}
+        for i in pending:
+            if rows[i]['class_id'] and results[i]['status'] != 'error':
+                by_class.setdefault(rows[i]['class_id'], []).append(i)
+        for class_id, indexes in by_class.items():
+            try:
+                update_roster(self.db, class_id, add=[rows[i]['user_id'] for i in indexes])
+            except Exception as e:
+                for i in indexes:
+                    results[i]['class_error'] = f'Enroll into {class_id} failed: {e}'
+        for result in results:
+            if result['status'] == 'pending':
+                result['status'] = 'ok'
+        # Ảnh đã lưu nhưng enroll lỗi: giao cho job face_enroll (có thử lại) thay vì chỉ báo warning
+        if self.enroll_later:
+            for i in enroll_retry:
+                if results[i]['status'] != 'ok':
+                    continue
+                try:
+                    results[i]['face_enroll_job_id'] = self.enroll_later(rows[i]['user_id'])
+                except Exception as e:
+                    print(f"[ERROR] Queue face enroll for {rows[i]['user_id']}: {e}")
+        for i in pending:
+            if results[i]['status'] == 'ok':
+                invalidate_user(rows[i]['user_id'])
+        for class_id in by_class:
+            invalidate_class(class_id)
+        imported = sum(1 for r in results if r['status'] == 'ok')
+        return {
+            'total': len(results),
+            'imported': imported,
+            'failed': len(results) - imported,
+            'classes': sorted(by_class),
+            'results': results,
+        }
@@ -1,36 +1,51 @@
-from google.cloud import firestore, storage
+from google.cloud import firestore
+from google.api_core.exceptions import NotFound
 from datetime import datetime
 import os
 
-import base64
-import re
 from flask import Blueprint, request, jsonify
 from flask_cors import CORS
-
+from face_cache import reference_cache
+from attendance_api import enroll_face_later, face_matcher
+from image_utils import decode_base64_image, normalize_image, read_image_request
+from class_roster import update_roster
+from clients import get_firestore, get_storage
+from doc_cache import invalidate_class, invalidate_user, users_cache
+from etag import conditional
+from metrics import counted, get_document
+from pagination import fetch_page, page_args, project, select_fields
+from job_queue import job_queue
+from student_import import ManifestError, StudentImporter, parse_manifest
+import shutil
+import tempfile
+import zipfile
 
 
 # Config
 BUCKET_NAME = "face-attendance"  # Thay bằng tên bucket thật
-# Đường dẫn mới tới file service account key
-SERVICE_ACCOUNT_KEY_PATH = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS")
-FIREBASE_PROJECT_ID = os.environ.get("FIREBASE_PROJECT_ID")
+# Giới hạn dung lượng riêng cho request nhập theo lô (manifest + zip ảnh)
+IMPORT_MAX_UPLOAD_BYTES = int(os.environ.get('IMPORT_MAX_UPLOAD_BYTES', 1024 * 1024 * 1024))
 
-# Hàm upload ảnh base64 lên GCS
-def upload_student_image(student_id, image_base64):
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(BUCKET_NAME)
+# Giải mã ảnh base64 và chuẩn hoá (xoay EXIF, thu nhỏ, nén lại) trước khi lưu
+def decode_student_image(image_base64):
+    return normalize_image(decode_base64_image(image_base64), label='student photo')
+
+# Upload ảnh gốc (bytes) lên GCS
+def upload_student_image_bytes(student_id, image_data):
+    bucket = get_storage().bucket(BUCKET_NAME)
     blob = bucket.blob(f"students/{student_id}.jpg")
-    # Loại bỏ tiền tố data:image/...;base64, nếu có
-    base64_str = re.sub('^data:image/.+;base64,', '', image_base64)
-    # Đảm bảo là ASCII
-    base64_bytes = base64_str.encode('ascii')
-    image_data = base64.b64decode(base64_bytes)
     blob.upload_from_string(image_data, content_type='image/jpeg')
+    # Ảnh gốc đã bị thay, bỏ bản cũ khỏi cache so khớp khuôn mặt
+    reference_cache.invalidate(student_id)
     return f"https://storage.googleapis.com/{BUCKET_NAME}/students/{student_id}.jpg"
 
+# Hàm upload ảnh base64 lên GCS
+def upload_student_image(student_id, image_base64):
+    return upload_student_image_bytes(student_id, decode_student_image(image_base64))
+
 def add_student(student_id, name, email, class_name, status, image_base64):
     # Khi khởi tạo Firestore client:
-    db = firestore.Client.from_service_account_json(SERVICE_ACCOUNT_KEY_PATH, project=FIREBASE_PROJECT_ID)
+    db = get_firestore()
     image_url = upload_student_image(student_id, image_base64)
     student = {
         'student_id': student_id,
@@ -51,13 +66,24 @@ def add_student(student_id, name, email, class_name, status, image_base64):
 students_api = Blueprint('students_api', __name__)
 CORS(students_api)
 
+# Trường trả về -> trường lưu trong Firestore (None: lấy từ doc.id)
+STUDENT_LIST_FIELDS = {'id': None, 'name': 'name', 'studentId': None, 'email': 'email',
+                       'avatar_url': 'avatar_url', 'status': 'status', 'createdAt': 'createdAt'}
+CLASS_LIST_FIELDS = {'id': None, 'name': 'name', 'teacherId': 'teacherId', 'students': 'students', 'code': 'code'}
+
 # Lấy danh sách sinh viên từ collection users (role=student)
 @students_api.route('/api/students', methods=['GET'])
+@conditional('users')
 def get_students():
     try:
-        db = firestore.Client.from_service_account_json(SERVICE_ACCOUNT_KEY_PATH, project=FIREBASE_PROJECT_ID)
-        users_ref = db.collection('users').where('role', '==', 'student')
-        docs = users_ref.stream()
+        db = get_firestore()
+        try:
+            limit, cursor, fields = page_args(request.args)
+            names, stored = select_fields(fields, STUDENT_LIST_FIELDS)
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
+        users_ref = db.collection('users').where('role', '==', 'student').select(stored)
+        docs, next_cursor = fetch_page(users_ref, limit, cursor)
         students = []
         for doc in docs:
             data = doc.to_dict()
@@ -70,8 +96,8 @@ def get_students():
                 'status': data.get('status', 'active'),
                 'createdAt': data.get('createdAt')
             }
-            students.append(student)
-        return jsonify({"success": True, "students": students})
+            students.append(project(student, names))
+        return jsonify({"success": True, "students": students, "next_cursor": next_cursor})
     except Exception as e:
         import traceback
         print(f"[ERROR /api/students GET]: {e}\nTraceback: {traceback.format_exc()}")
@@ -80,25 +106,34 @@ def get_students():
 # Thêm sinh viên mới vào users và cập nhật mảng students của lớp
 @students_api.route('/api/students', methods=['POST'])
 def add_student_api():
-    data = request.get_json()
-    user_id = data['user_id']  # documentId của user đã đăng ký (uid)
+    # Nhận ảnh dạng multipart (trường image), body image/jpeg hoặc JSON base64 (dạng cũ)
+    try:
+        data, raw_image = read_image_request(request, 'image_base64')
+    except Exception as e:
+        return jsonify({'error': 'Invalid image', 'details': str(e)}), 400
+    user_id = data.get('user_id')  # documentId của user đã đăng ký (uid)
+    if not user_id:
+        return jsonify({'error': 'Missing user_id'}), 400
     student_id = data.get('student_id', '')  # mã sinh viên, chỉ là field
     class_id = data.get('class_id', '')
     status = data.get('status', 'active')
-    image_base64 = data.get('image_base64', '')
     name = data.get('name', '')
     email = data.get('email', '')
     avatar_url = ''
 
     try:
-        db = firestore.Client.from_service_account_json(SERVICE_ACCOUNT_KEY_PATH, project=FIREBASE_PROJECT_ID)
+        db = get_firestore()
 
         # Upload ảnh lên GCS nếu có
-        if image_base64:
-            avatar_url = upload_student_image(user_id, image_base64)
+        image_data = None
+        if raw_image:
+            image_data = normalize_image(raw_image, label='student photo')
+            del raw_image
+            avatar_url = upload_student_image_bytes(user_id, image_data)
 
         # Cập nhật thông tin user (nếu có)
         user_update = {}
+        enroll_job_id = None
         if student_id:
             user_update['student_id'] = student_id
         if avatar_url:
@@ -111,35 +146,117 @@ def add_student_api():
             user_update['email'] = email
         if user_update:
             user_ref = db.collection('users').document(user_id)
-            if not user_ref.get().exists:
+            user_doc = get_document(user_ref)
+            if not user_doc.exists:
                 return jsonify({'error': f'User {user_id} chưa đăng ký tài khoản!'}), 400
+            # Đăng ký ảnh gốc mới với bộ so khớp (face collection hoặc embedding local)
+            enroll_failed = False
+            if image_data:
+                try:
+                    user_update.update(face_matcher.enroll(user_id, image_data, user_doc.to_dict()))
+                except Exception as e:
+                    print(f"[ERROR] Enroll face for {user_id}: {e}")
+                    enroll_failed = True
             user_ref.update(user_update)
+            invalidate_user(user_id)
+            # Ảnh đã lên GCS nhưng chưa đăng ký được khuôn mặt: job face_enroll thử lại từ ảnh đó
+            if enroll_failed:
+                enroll_job_id = enroll_face_later(user_id)
 
         # Thêm user_id vào mảng students của lớp
         if class_id:
-            class_ref = db.collection('classes').document(class_id)
-            class_doc = class_ref.get()
-            if class_doc.exists:
-                class_data = class_doc.to_dict()
-                students_list = class_data.get('students', [])
-                if user_id not in students_list:
-                    students_list.append(user_id)
-                    class_ref.update({'students': students_list})
-
-        return jsonify({'success': True, 'user_id': user_id})
+            try:
+                update_roster(db, class_id, add=[user_id])
+                invalidate_class(class_id)
+            except NotFound:
+                print(f"[ERROR] Class {class_id} not found, skip enrolling {user_id}")
+
+        response = {'success': True, 'user_id': user_id}
+        if enroll_job_id:
+            response['face_enroll_job_id'] = enroll_job_id
+        return jsonify(response)
     except Exception as e:
         import traceback
         print(f"[ERROR /api/students POST]: {e}\nTraceback: {traceback.format_exc()}")
         return jsonify({'error': str(e), 'trace': traceback.format_exc()}), 500
 
+def run_import(rows, archive_path):
+    return StudentImporter(get_firestore(), upload_student_image_bytes, face_matcher,
+                           enroll_later=enroll_face_later).run(rows, archive_path)
+
+def run_import_job(payload):
+    try:
+        return run_import(payload['rows'], payload['archive_path'])
+    finally:
+        shutil.rmtree(payload['work_dir'], ignore_errors=True)
+
+job_queue.register('student_import', run_import_job)
+
+# Nhập sinh viên theo lô: multipart gồm manifest (CSV/JSONL) và photos (zip),
+# hoặc photos_gcs_path là đường dẫn file zip đã upload sẵn lên bucket
+@students_api.route('/api/students/import', methods=['POST'])
+def import_students_api():
+    # Phải đặt trước khi đọc request.files (request.max_content_length cần Flask>=3.1, đã ghim trong requirements.txt)
+    request.max_content_length = IMPORT_MAX_UPLOAD_BYTES
+    work_dir = tempfile.mkdtemp(prefix='student_import_')
+    queued = False
+    try:
+        manifest = request.files.get('manifest')
+        if manifest is None:
+            return jsonify({'success': False, 'error': 'Missing manifest'}), 400
+        try:
+            rows = parse_manifest(manifest.read(), manifest.filename or '')
+        except (ManifestError, UnicodeDecodeError) as e:
+            return jsonify({'success': False, 'error': f'Invalid manifest: {e}'}), 400
+
+        # File zip được lưu ra đĩa (không giữ trong RAM), mỗi luồng đọc ảnh trực tiếp từ file
+        archive_path = None
+        photos = request.files.get('photos')
+        gcs_path = request.form.get('photos_gcs_path')
+        if photos is not None:
+            archive_path = os.path.join(work_dir, 'photos.zip')
+            photos.save(archive_path)
+        elif gcs_path:
+            archive_path = os.path.join(work_dir, 'photos.zip')
+            get_storage().bucket(BUCKET_NAME).blob(gcs_path).download_to_filename(archive_path)
+        if archive_path:
+            if not zipfile.is_zipfile(archive_path):
+                return jsonify({'success': False, 'error': 'photos must be a zip archive'}), 400
+
+        if request.form.get('async') == '1':
+            job_id = job_queue.submit('student_import', {'rows': rows, 'archive_path': archive_path, 'work_dir': work_dir})
+            queued = True
+            print(f"[INFO] Student import queued: job_id={job_id}, rows={len(rows)}")
+            return jsonify({'success': True, 'job_id': job_id, 'rows': len(rows),
+                            'status_url': f'/api/students/import/jobs/{job_id}'}), 202
+
+        report = run_import(rows, archive_path)
+        print(f"[INFO] Student import done: imported={report['imported']}/{report['total']}")
+        return jsonify(dict(report, success=True))
+    except Exception as e:
+        import traceback
+        print(f"[ERROR /api/students/import]: {e}\nTraceback: {traceback.format_exc()}")
+        return jsonify({'success': False, 'error': str(e), 'trace': traceback.format_exc()}), 500
+    finally:
+        if not queued:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+@students_api.route('/api/students/import/jobs/<job_id>', methods=['GET'])
+def import_job_status(job_id):
+    job = job_queue.status(job_id)
+    if job is None or job.get('kind') != 'student_import':
+        return jsonify({'success': False, 'error': 'Job not found'}), 404
+    return jsonify(dict(job, success=True))
+
 # Sửa thông tin sinh viên (users)
 @students_api.route('/api/students/<student_id>', methods=['PUT'])
 def update_student(student_id):
     data = request.json
     try:
-        db = firestore.Client.from_service_account_json(SERVICE_ACCOUNT_KEY_PATH, project=FIREBASE_PROJECT_ID)
+        db = get_firestore()
         user_ref = db.collection('users').document(student_id)
         user_ref.update(data)
+        invalidate_user(student_id)
         return jsonify({"success": True})
     except Exception as e:
         import traceback
@@ -150,9 +267,10 @@ def update_student(student_id):
 @students_api.route('/api/students/<student_id>', methods=['DELETE'])
 def delete_student(student_id):
     try:
-        db = firestore.Client.from_service_account_json(SERVICE_ACCOUNT_KEY_PATH, project=FIREBASE_PROJECT_ID)
+        db = get_firestore()
         user_ref = db.collection('users').document(student_id)
         user_ref.delete()
+        invalidate_user(student_id)
         return jsonify({"success": True})
     except Exception as e:
         import traceback
@@ -161,22 +279,28 @@ def delete_student(student_id):
 
 # Lấy danh sách lớp từ collection classes
 @students_api.route('/api/classes', methods=['GET'])
+@conditional('classes')
 def get_classes():
     try:
-        db = firestore.Client.from_service_account_json(SERVICE_ACCOUNT_KEY_PATH, project=FIREBASE_PROJECT_ID)
-        classes_ref = db.collection('classes')
-        docs = classes_ref.stream()
+        db = get_firestore()
+        try:
+            limit, cursor, fields = page_args(request.args)
+            names, stored = select_fields(fields, CLASS_LIST_FIELDS)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        classes_ref = db.collection('classes').select(stored)
+        docs, next_cursor = fetch_page(classes_ref, limit, cursor)
         classes = []
         for doc in docs:
             data = doc.to_dict()
-            classes.append({
+            classes.append(project({
                 'id': doc.id,
                 'name': data.get('name', ''),
                 'teacherId': data.get('teacherId', ''),
                 'students': data.get('students', []),
                 'code': data.get('code', ''),
-            })
-        return jsonify({'success': True, 'classes': classes})
+            }, names))
+        return jsonify({'success': True, 'classes': classes, 'next_cursor': next_cursor})
     except Exception as e:
         import traceback
         print(f"[ERROR /api/classes GET]: {e}\nTraceback: {traceback.format_exc()}")
@@ -186,9 +310,9 @@ def get_classes():
 @students_api.route('/api/classes/student/<student_id>', methods=['GET'])
 def get_classes_of_student(student_id):
     try:
-        db = firestore.Client.from_service_account_json(SERVICE_ACCOUNT_KEY_PATH, project=FIREBASE_PROJECT_ID)
+        db = get_firestore()
         classes_ref = db.collection('classes').where('students', 'array_contains', student_id)
-        docs = classes_ref.stream()
+        docs = counted(classes_ref.stream())
         classes = []
         for doc in docs:
             data = doc.to_dict()
@@ -208,10 +332,10 @@ def get_classes_of_student(student_id):
 @students_api.route('/api/students/<user_id>/displayName', methods=['GET'])
 def get_student_display_name(user_id):
     try:
-        db = firestore.Client.from_service_account_json(SERVICE_ACCOUNT_KEY_PATH, project=FIREBASE_PROJECT_ID)
-        user_doc = db.collection('users').document(user_id).get()
-        if user_doc.exists and user_doc.to_dict().get('role') == 'student':
-            display_name = user_doc.to_dict().get('displayName', '')
+        db = get_firestore()
+        user_data = users_cache.get(db, user_id)
+        if user_data and user_data.get('role') == 'student':
+            display_name = user_data.get('displayName', '')
             return jsonify({'success': True, 'user_id': user_id, 'displayName': display_name})
         else:
             return jsonify({'success': False, 'error': 'Student not found'}), 404
@@ -1,29 +1,38 @@
-from flask import Blueprint, jsonify
+from flask import Blueprint, jsonify, request
 import os
-from google.cloud import firestore
+from clients import get_firestore
+from pagination import fetch_page, page_args, project, select_fields
+from doc_cache import users_cache
+from etag import conditional
 
 teachers_api = Blueprint('teachers_api', __name__)
 
-# Lấy đường dẫn file service account key và project_id từ biến môi trường
-SERVICE_ACCOUNT_KEY_PATH = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS")
-FIREBASE_PROJECT_ID = os.environ.get("FIREBASE_PROJECT_ID")
+# Trường trả về -> trường lưu trong Firestore (None: lấy từ doc.id)
+TEACHER_LIST_FIELDS = {'id': None, 'name': 'name', 'email': 'email', 'avatar_url': 'avatar_url'}
+
 
 @teachers_api.route('/api/teachers', methods=['GET'])
+@conditional('users')
 def get_teachers():
     try:
-        db = firestore.Client.from_service_account_json(SERVICE_ACCOUNT_KEY_PATH, project=FIREBASE_PROJECT_ID)
-        users_ref = db.collection('users').where('role', '==', 'teacher')
-        docs = users_ref.stream()
+        db = get_firestore()
+        try:
+            limit, cursor, fields = page_args(request.args)
+            names, stored = select_fields(fields, TEACHER_LIST_FIELDS)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        users_ref = db.collection('users').where('role', '==', 'teacher').select(stored)
+        docs, next_cursor = fetch_page(users_ref, limit, cursor)
         teachers = []
         for doc in docs:
             data = doc.to_dict()
-            teachers.append({
+            teachers.append(project({
                 'id': doc.id,
                 'name': data.get('name', ''),
                 'email': data.get('email', ''),
                 'avatar_url': data.get('avatar_url', ''),
-            })
-        return jsonify({'success': True, 'teachers': teachers})
+            }, names))
+        return jsonify({'success': True, 'teachers': teachers, 'next_cursor': next_cursor})
     except Exception as e:
         import traceback
         print(f"[ERROR /api/teachers GET]: {e}\nTraceback: {traceback.format_exc()}")
@@ -33,10 +42,10 @@ def get_teachers():
 @teachers_api.route('/api/teachers/<user_id>/displayName', methods=['GET'])
 def get_teacher_display_name(user_id):
     try:
-        db = firestore.Client.from_service_account_json(SERVICE_ACCOUNT_KEY_PATH, project=FIREBASE_PROJECT_ID)
-        user_doc = db.collection('users').document(user_id).get()
-        if user_doc.exists and user_doc.to_dict().get('role') == 'teacher':
-            display_name = user_doc.to_dict().get('displayName', '')
+        db = get_firestore()
+        user_data = users_cache.get(db, user_id)
+        if user_data and user_data.get('role') == 'teacher':
+            display_name = user_data.get('displayName', '')
             return jsonify({'success': True, 'user_id': user_id, 'displayName': display_name})
         else:
             return jsonify({'success': False, 'error': 'Teacher not found'}), 404
@@ -0,0 +1,87 @@
+# management_api/ttl_cache.py
+# Cache trong tiến trình cho kết quả đọc Firestore chấp nhận được độ trễ có giới hạn (bounded staleness).
+# Mỗi key chỉ có một luồng nạp lại tại một thời điểm; các request khác cùng key chờ kết quả đó
+# thay vì cùng lúc bắn truy vấn giống nhau lên Firestore.
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    def __init__(self, ttl_seconds, max_entries=1024):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # key -> (value, loaded_at)
+        self._entries = OrderedDict()
+        self._loading = {}
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+
+    def _fresh(self, key):
+        # Gọi khi đang giữ self._lock
+        entry = self._entries.get(key)
+        if entry is None or time.monotonic() - entry[1] > self.ttl_seconds:
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def get(self, key):
+        with self._lock:
+            entry = self._fresh(key)
+            return entry[0] if entry else None
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.monotonic())
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_or_load(self, key, loader):
+        # Trả về (value, age_seconds)
+        while True:
+            with self._lock:
+                entry = self._fresh(key)
+                if entry is not None:
+                    self._hits += 1
+                    return entry[0], time.monotonic() - entry[1]
+                event = self._loading.get(key)
+                owner = event is None
+                if owner:
+                    event = threading.Event()
+                    self._loading[key] = event
+                    self._misses += 1
+            if owner:
+                break
+            event.wait()
+        try:
+            value = loader()
+            self.put(key, value)
+            return value, 0.0
+        finally:
+            with self._lock:
+                self._loading.pop(key, None)
+            event.set()
+
+    def invalidate(self, key=None):
+        # key=None: xoá toàn bộ
+        with self._lock:
+            if key is None:
+                self._invalidations += len(self._entries)
+                self._entries.clear()
+            elif self._entries.pop(key, None) is not None:
+                self._invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'entries': len(self._entries),
+                'ttl_seconds': self.ttl_seconds,
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': round(self._hits / lookups, 3) if lookups else 0,
+                'invalidations': self._invalidations,
+            }
@@ -0,0 +1,71 @@
+# management_api/user_emails.py
+# Chỉ mục email -> uid (collection user_emails, document id là email đã chuẩn hoá) cho đăng nhập,
+# cùng cache ngắn hạn cho bản ghi đăng nhập (uid + hồ sơ kèm password hash).
+# Tài khoản cũ chưa có chỉ mục, hoặc chỉ mục đã lệch vì email bị sửa ở nơi khác, được tìm lại bằng
+# truy vấn where('email') một lần rồi ghi chỉ mục.
+# Email so khớp CHÍNH XÁC (phân biệt hoa thường, như truy vấn đăng nhập cũ) ở mọi đường: khoá chỉ mục,
+# kiểm tra chỉ mục và truy vấn dự phòng, nên kết quả không phụ thuộc chỉ mục đã được điền hay chưa.
+import os
+import threading
+from urllib.parse import quote
+from doc_cache import users_cache
+from metrics import counted, get_document
+from ttl_cache import TTLCache
+
+EMAIL_INDEX_COLLECTION = 'user_emails'
+LOGIN_CACHE_SECONDS = int(os.environ.get('LOGIN_CACHE_SECONDS', 60))
+LOGIN_CACHE_MAX_ENTRIES = int(os.environ.get('LOGIN_CACHE_MAX_ENTRIES', 10000))
+
+
+def email_index_ref(db, email):
+    # '/' không được phép trong document id
+    return db.collection(EMAIL_INDEX_COLLECTION).document(quote(email, safe='@+'))
+
+
+class CredentialCache:
+    def __init__(self, ttl_seconds, max_entries):
+        self._cache = TTLCache(ttl_seconds, max_entries)
+        self._lock = threading.Lock()
+        # uid -> email, để xoá cache khi document users/{uid} bị sửa
+        self._emails = {}
+        self.index_misses = 0
+
+    def _load(self, db, email):
+        snap = get_document(email_index_ref(db, email))
+        if snap.exists:
+            uid = snap.to_dict().get('uid')
+            user_snap = get_document(db.collection('users').document(uid)) if uid else None
+            if user_snap is not None and user_snap.exists and user_snap.to_dict().get('email') == email:
+                return (uid, user_snap.to_dict())
+        # Chưa có chỉ mục hoặc chỉ mục lệch: tìm bằng truy vấn rồi sửa chỉ mục
+        with self._lock:
+            self.index_misses += 1
+        docs = list(counted(db.collection('users').where('email', '==', email).limit(1).stream()))
+        if not docs:
+            return (None, None)
+        email_index_ref(db, email).set({'uid': docs[0].id})
+        return (docs[0].id, docs[0].to_dict())
+
+    def get(self, db, email):
+        # Trả về (uid, bản sao dict user) hoặc (None, None)
+        (uid, user), _ = self._cache.get_or_load(email, lambda: self._load(db, email))
+        if uid is None:
+            # Không cache kết quả "không tìm thấy" để người vừa đăng ký đăng nhập được ngay
+            self._cache.invalidate(email)
+            return None, None
+        with self._lock:
+            self._emails[uid] = email
+        return uid, dict(user)
+
+    def invalidate_uid(self, uid):
+        with self._lock:
+            email = self._emails.pop(uid, None)
+        if email:
+            self._cache.invalidate(email)
+
+    def stats(self):
+        return dict(self._cache.stats(), index_misses=self.index_misses)
+
+
+credential_cache = CredentialCache(LOGIN_CACHE_SECONDS, LOGIN_CACHE_MAX_ENTRIES)
+users_cache.on_invalidate(credential_cache.invalidate_uid)
@@ -0,0 +1,44 @@
+# management_api/user_lookup.py
+# Tra tên người dùng theo lô: gom toàn bộ id, đọc bằng get_all theo từng chunk với projection
+# chỉ lấy name/displayName, kết quả giữ trong cache TTL dùng chung cho mọi request.
+import os
+from ttl_cache import TTLCache
+from metrics import counted
+
+USER_LOOKUP_TTL_SECONDS = int(os.environ.get('USER_LOOKUP_TTL_SECONDS', 300))
+USER_LOOKUP_MAX_ENTRIES = int(os.environ.get('USER_LOOKUP_MAX_ENTRIES', 20000))
+USER_LOOKUP_CHUNK = 300
+USER_NAME_FIELDS = ['name', 'displayName']
+
+user_name_cache = TTLCache(USER_LOOKUP_TTL_SECONDS, USER_LOOKUP_MAX_ENTRIES)
+
+
+def resolve_users(db, user_ids):
+    # {uid: {'name': ..., 'displayName': ...}}; uid không tồn tại được trả về None (và cũng được cache)
+    result = {}
+    missing = []
+    for uid in dict.fromkeys(u for u in user_ids if isinstance(u, str) and u):
+        cached = user_name_cache.get(uid)
+        if cached is None:
+            missing.append(uid)
+        else:
+            result[uid] = cached[0]
+    users_ref = db.collection('users')
+    for i in range(0, len(missing), USER_LOOKUP_CHUNK):
+        refs = [users_ref.document(uid) for uid in missing[i:i + USER_LOOKUP_CHUNK]]
+        for snap in counted(db.get_all(refs, field_paths=USER_NAME_FIELDS)):
+            fields = snap.to_dict() if snap.exists else None
+            # Bọc trong tuple để phân biệt "không có user" với "chưa có trong cache"
+            user_name_cache.put(snap.id, (fields,))
+            result[snap.id] = fields
+    return result
+
+
+def display_name(user, fallback):
+    if not user:
+        return fallback
+    return user.get('displayName') or user.get('name') or fallback
+
+
+def invalidate_user(user_id):
+    user_name_cache.invalidate(user_id)
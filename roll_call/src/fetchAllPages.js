@@ -0,0 +1,16 @@
+// src/fetchAllPages.js
+// Các API danh sách (/api/classes, /api/students, /api/teachers) trả từng trang kèm next_cursor:
+// gọi lần lượt tới trang cuối rồi gộp lại thành một danh sách như trước.
+export async function fetchAllPages(url, key) {
+    let items = [];
+    let cursor = null;
+    do {
+        const separator = url.includes('?') ? '&' : '?';
+        const res = await fetch(cursor ? `${url}${separator}cursor=${encodeURIComponent(cursor)}` : url);
+        const data = await res.json();
+        if (!data.success) return data;
+        items = items.concat(data[key] || []);
+        cursor = data.next_cursor;
+    } while (cursor);
+    return { success: true, [key]: items };
+}
@@ -25,6 +25,7 @@ import {
     CalendarOutlined
 } from '@ant-design/icons';
 import { AuthContext } from '../App';
+import { fetchAllPages } from '../fetchAllPages';
 
 const { Title, Text } = Typography;
 const { Option } = Select;
@@ -59,8 +60,7 @@ const ClassesPage = () => {
     // Fetch all classes (for teacher)
     const fetchClasses = async () => {
         try {
-            const res = await fetch(API_URL);
-            const data = await res.json();
+            const data = await fetchAllPages(API_URL, 'classes');
             if (data.success) {
                 setClasses(data.classes);
                 console.log('DEBUG classes:', data.classes);
@@ -105,8 +105,7 @@ const ClassesPage = () => {
     useEffect(() => {
         const fetchTeachers = async () => {
             try {
-                const res = await fetch(`${API_BASE_URL}/api/teachers`);
-                const data = await res.json();
+                const data = await fetchAllPages(`${API_BASE_URL}/api/teachers`, 'teachers');
                 if (data.success) {
                     // Nếu thiếu displayName, fetch từng teacher bổ sung displayName
                     const teachersWithDisplayName = await Promise.all(
@@ -1,5 +1,6 @@
 import React, { useEffect, useState } from "react";
 import { Table, Select, Card, Typography } from "antd";
+import { fetchAllPages } from "../fetchAllPages";
 
 const { Option } = Select;
 const { Title } = Typography;
@@ -16,8 +17,7 @@ const ReportsPage = () => {
     useEffect(() => {
         const fetchClasses = async () => {
             try {
-                const res = await fetch(`${API_BASE_URL}/api/classes`);
-                const data = await res.json();
+                const data = await fetchAllPages(`${API_BASE_URL}/api/classes`, 'classes');
                 if (data.success) setClassList(data.classes);
                 else setClassList([]);
             } catch {
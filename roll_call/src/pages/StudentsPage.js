@@ -27,6 +27,7 @@ import {
     ExportOutlined
 } from '@ant-design/icons';
 import { AuthContext } from '../App';
+import { fetchAllPages } from '../fetchAllPages';
 
 const { Title } = Typography;
 const { Option } = Select;
@@ -52,8 +53,7 @@ const StudentsPage = () => {
     // Fetch students
     const fetchStudents = async () => {
         try {
-            const res = await fetch(API_URL);
-            const data = await res.json();
+            const data = await fetchAllPages(API_URL, 'students');
             if (data.success) setStudents(data.students);
             else message.error("Failed to fetch students");
         } catch (err) {
@@ -64,8 +64,7 @@ const StudentsPage = () => {
     // Fetch classes
     const fetchClasses = async () => {
         try {
-            const res = await fetch(CLASSES_API_URL);
-            const data = await res.json();
+            const data = await fetchAllPages(CLASSES_API_URL, 'classes');
             if (data.success) setClasses(data.classes);
             else message.error("Failed to fetch classes");
         } catch (err) {
@@ -76,8 +75,7 @@ const StudentsPage = () => {
     // Fetch users (role=student)
     const fetchUsers = async () => {
         try {
-            const res = await fetch(USERS_API_URL);
-            const data = await res.json();
+            const data = await fetchAllPages(USERS_API_URL, 'students');
             if (data.success) setUsers(data.students);
             else setUsers([]);
         } catch {